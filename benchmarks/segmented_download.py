@@ -0,0 +1,131 @@
+"""
+Compare single stream and segmented HTTP downloads.
+
+Usage: python benchmarks/segmented_download.py [size in MB] [bandwidth in MB/s]
+
+A local server that limits the bandwidth of every connection serves a sample
+file of `size` MB (8 by default) at `bandwidth` MB/s (2 by default). The file
+is then downloaded in 1, 2 and 4 segments, and the download times are
+reported.
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from teapot.fetchers.http_fetcher import HttpFetcher  # noqa: E402
+from teapot.fetchers.callbacks import NullFetcherCallback  # noqa: E402
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(data, bandwidth):
+    """
+    Make a request handler that serves `data`, and its ranges, at
+    `bandwidth` bytes per second per connection.
+    """
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        chunk_size = 64 * 1024
+
+        def do_GET(self):
+            match = re.match(r'bytes=(\d+)-(\d+)?$', self.headers.get('Range', ''))
+
+            if match:
+                start = int(match.group(1))
+                end = int(match.group(2) or len(data) - 1)
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(data)))
+            else:
+                start, end = 0, len(data) - 1
+                self.send_response(200)
+
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', end - start + 1)
+            self.send_header('ETag', '"sample"')
+            self.end_headers()
+
+            for offset in xrange(start, end + 1, self.chunk_size):
+                chunk = data[offset:min(offset + self.chunk_size, end + 1)]
+                self.wfile.write(chunk)
+                time.sleep(float(len(chunk)) / bandwidth)
+
+        # The first segment closes the initial response once its range was
+        # received.
+        def handle(self):
+            try:
+                BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+
+            except socket.error:
+                pass
+
+        def finish(self):
+            try:
+                BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+            except socket.error:
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class SegmentedFetcher(HttpFetcher):
+
+    """
+    A HTTP fetcher that always downloads in the specified number of segments.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+
+    def get_segments_count(self, response, size):
+        return self.segments
+
+
+def main(size=8, bandwidth=2):
+    data = os.urandom(int(size * 1024 ** 2))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(data, bandwidth * 1024 ** 2))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    root = tempfile.mkdtemp()
+
+    try:
+        fetch_info = {
+            'url': 'http://127.0.0.1:%s/sample.bin' % server.server_address[1],
+            'mimetype': None,
+        }
+
+        print '%.1f MB at %.1f MB/s per connection:' % (size, bandwidth)
+
+        for segments in (1, 2, 4):
+            start = time.time()
+            manifest = SegmentedFetcher(segments).download(fetch_info, root, NullFetcherCallback())
+            print '  %-24s %.2fs' % ('%s segment(s)' % segments, time.time() - start)
+
+            assert os.path.getsize(manifest['archive_path']) == len(data)
+            os.remove(manifest['archive_path'])
+
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*map(float, sys.argv[1:]))
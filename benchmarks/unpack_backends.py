@@ -0,0 +1,130 @@
+"""
+Compare the backends of the tarball unpacker.
+
+Usage: python benchmarks/unpack_backends.py [archive...]
+
+Without arguments, sample archives are generated in every supported
+compression. Every archive is then extracted with every backend available
+on this system, and the extraction times are reported. Archives that are
+transcoded are also extracted from their transcoded copy.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tarfile
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from teapot.unpackers.tarball_unpacker import TarballUnpacker, SERIAL_DECOMPRESSORS, find_program, get_compression  # noqa: E402
+from teapot.unpackers.callbacks import NullUnpackerCallback  # noqa: E402
+
+
+def generate_archives(root, files=2000, words=4000):
+    """
+    Generate sample archives in `root`.
+    """
+
+    random.seed(0)
+    vocabulary = ['int', 'return', 'void', 'static', 'const', 'char', '{', '}', ';', 'if', 'else', 'for', 'x', 'y']
+    source_path = os.path.join(root, 'sample-1.0')
+
+    for index in range(files):
+        path = os.path.join(source_path, 'dir%d' % (index % 20), 'file%d.c' % index)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'w') as f:
+            f.write(' '.join(random.choice(vocabulary) for _ in range(words)))
+
+    archives = []
+
+    for mode, extension in (('w', 'tar'), ('w:gz', 'tar.gz'), ('w:bz2', 'tar.bz2')):
+        archive_path = os.path.join(root, 'sample.%s' % extension)
+
+        with tarfile.open(archive_path, mode) as tar:
+            tar.add(source_path, arcname='sample-1.0')
+
+        archives.append(archive_path)
+
+    if find_program('xz'):
+        archive_path = os.path.join(root, 'sample.tar')
+        subprocess.check_call(['xz', '-T0', '-k', archive_path])
+        archives.append(archive_path + '.xz')
+
+    return archives
+
+
+def main(archives):
+    unpacker = TarballUnpacker()
+    root = tempfile.mkdtemp()
+
+    try:
+        if not archives:
+            archives = generate_archives(root)
+
+        for archive_path in archives:
+            compression = get_compression(archive_path)
+            backends = unpacker.get_backends(compression)
+            serial_command = SERIAL_DECOMPRESSORS.get(compression)
+
+            if serial_command and find_program(serial_command[0]):
+                backends.append(('%s (serial)' % serial_command[0], serial_command))
+
+            if ('tarfile', None) not in backends and compression != 'xz':
+                backends.append(('tarfile', None))
+
+            print '%s (%.1f MB):' % (os.path.basename(archive_path), os.path.getsize(archive_path) / 1024.0 ** 2)
+
+            for backend in backends:
+                target_path = os.path.join(root, 'target')
+                os.mkdir(target_path)
+
+                try:
+                    start = time.time()
+                    unpacker.extract(archive_path, target_path, NullUnpackerCallback(), backend)
+                    print '  %-24s %.2fs' % (backend[0], time.time() - start)
+
+                finally:
+                    shutil.rmtree(target_path)
+
+            if compression in unpacker.transcoded_compressions:
+                # Transcode a copy, so that nothing is written next to the
+                # archive.
+                copy_path = os.path.join(root, 'transcoded', os.path.basename(archive_path))
+                os.makedirs(os.path.dirname(copy_path))
+                shutil.copyfile(archive_path, copy_path)
+
+                try:
+                    start = time.time()
+                    transcoded_path = unpacker.transcode(copy_path, compression)
+
+                    if transcoded_path:
+                        print '  %-24s %.2fs' % ('transcoding', time.time() - start)
+
+                        for backend in unpacker.get_backends(None):
+                            target_path = os.path.join(root, 'target')
+                            os.mkdir(target_path)
+
+                            try:
+                                start = time.time()
+                                unpacker.extract(transcoded_path, target_path, NullUnpackerCallback(), backend)
+                                print '  %-24s %.2fs' % ('%s (transcoded)' % backend[0], time.time() - start)
+
+                            finally:
+                                shutil.rmtree(target_path)
+
+                finally:
+                    shutil.rmtree(os.path.dirname(copy_path))
+
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
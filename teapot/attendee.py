@@ -7,18 +7,26 @@ import json
 import hashlib
 import subprocess
 
-from .memoized import MemoizedObject
+from contextlib import contextmanager
+
+from .memoized import Memoized, MemoizedObject
+from .graph import DependencyGraph
 from .filters import FilteredObject
 from .source import Source
 from .error import TeapotError
 from .log import LOGGER, Highlight as hl
 from .options import get_option
-from .path import mkdir, rmdir, from_user_path, temporary_copy, chdir
+from .path import mkdir, rmdir, write_json, from_user_path, temporary_copy
 from .unpackers import Unpacker
+from .unpackers.unpacker import split_member_path
 from .build import Build
 from .globals import get_party_path
 from .prefix import PrefixedObject
 from .command import Command
+from .digest import DigestCache, get_digest_cache
+from .mirrors import race_sources
+from .extractions import get_extraction_cache
+from .lock import get_file_lock
 
 
 class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
@@ -28,15 +36,39 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
     """
 
     class DependencyCycleError(TeapotError):
-        def __init__(self, cycle):
-            cycle_str = ' -> '.join(map(str, cycle))
+        def __init__(self, cycles):
+            cycles_str = '; '.join(' -> '.join(map(str, cycle)) for cycle in cycles)
 
             super(Attendee.DependencyCycleError, self).__init__(
-                'Dependency cycle found: %s',
-                hl(cycle_str)
+                'Dependency cycle found: %s' if len(cycles) == 1 else 'Dependency cycles found: %s',
+                hl(cycles_str)
+            )
+
+            self.cycles = cycles
+            self.cycle = cycles[0]
+
+    _dependency_graph = None
+
+    @classmethod
+    def get_dependency_graph(cls):
+        """
+        Get the dependency graph of the enabled attendees.
+
+        The graph is computed once and only computed again when the memoized
+        instances or their dependencies change.
+        """
+
+        graph = cls._dependency_graph
+
+        if graph is None or graph.generation != Memoized.generation:
+            graph = DependencyGraph(
+                cls.get_enabled_instances(),
+                get_parents=lambda attendee: attendee.resolve_parents(),
+                generation=Memoized.generation,
             )
+            cls._dependency_graph = graph
 
-            self.cycle = cycle
+        return graph
 
     @classmethod
     def get_dependent_instances(cls, keys_list=None):
@@ -55,51 +87,15 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
                 hl(ex.keys[0]),
             )
 
-        result = []
-        dependency_tree = {
-            attendee: attendee.parents
-            for attendee in cls.get_enabled_instances()
-        }
+        graph = cls.get_dependency_graph()
+        result = graph.topological_order
 
-        while dependency_tree:
-            try:
-                attendee = next(x[0] for x in dependency_tree.iteritems() if not x[1])
-            except StopIteration:
-                # We can't find an attendee that does not depend on any
-                # other. We have a dependency cycle.
-                cycle = []
-                attendee = dependency_tree.keys()[0]
+        if len(result) != len(graph.nodes):
+            raise Attendee.DependencyCycleError(graph.get_cycles())
 
-                while attendee not in cycle:
-                    cycle.append(attendee)
-                    attendee = next(iter(dependency_tree[attendee]))
+        needed_results = graph.get_ancestors(instances)
 
-                # We make sure the dependency cycle starts with the
-                # first repeating element (which is currently in
-                # `attendee`)
-                cycle = cycle[cycle.index(attendee):] + [attendee]
-
-                raise Attendee.DependencyCycleError(cycle)
-
-            else:
-                result.append(attendee)
-                del dependency_tree[attendee]
-
-                dependency_tree = {
-                    key: value - {attendee}
-                    for key, value in dependency_tree.iteritems()
-                }
-
-        unneeded_results = set(result)
-
-        def filter_out(instance):
-            if instance in unneeded_results:
-                unneeded_results.remove(instance)
-                map(filter_out, instance.parents)
-
-        map(filter_out, instances)
-
-        return [x for x in result if x not in unneeded_results]
+        return [x for x in result if x in needed_results]
 
     def __init__(self, *args, **kwargs):
         self.party_path = get_party_path()
@@ -113,6 +109,8 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
         self._builds = set()
         self._builds_manifest = {}
         self._post_unpack_commands = []
+        self._extracted_paths = []
+        self._excluded_paths = []
 
         super(Attendee, self).__init__(*args, **kwargs)
 
@@ -135,12 +133,15 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
         """
 
         self._depends_on.extend(attendees)
+        Memoized.invalidate()
+
         return self
 
-    @property
-    def parents(self):
+    def resolve_parents(self):
         """
-        Get attendees this attendee directly depends on.
+        Resolve the attendees this attendee directly depends on.
+
+        Prefer the `parents` property, which is cached.
         """
 
         try:
@@ -155,16 +156,26 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
                 hl(self),
             )
 
+    @property
+    def parents(self):
+        """
+        Get attendees this attendee directly depends on.
+        """
+
+        graph = self.get_dependency_graph()
+
+        if self in graph.parents:
+            return set(graph.parents[self])
+
+        return self.resolve_parents()
+
     @property
     def children(self):
         """
         Get attendees that directly depends on this attendee.
         """
 
-        return {
-            attendee for attendee in self.get_enabled_instances()
-            if self in attendee.parents
-        }
+        return set(self.get_dependency_graph().children.get(self, set()))
 
     @property
     def cache_path(self):
@@ -178,6 +189,51 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
     def builds_path(self):
         return from_user_path(os.path.join(get_option('builds_root'), self.name))
 
+    # The stages of the pipeline, in order, with the option that holds their
+    # root directory and the manifests they write.
+    stages = (
+        ('fetch', 'cache_root', ('_cache_manifest', '_last_parsed_source')),
+        ('unpack', 'sources_root', ('_sources_manifest', '_last_unpacked_archive_info')),
+        ('build', 'builds_root', ('_builds_manifest',)),
+    )
+
+    @contextmanager
+    def locked(self, stage):
+        """
+        Lock the specified `stage` of the attendee and the stages before it,
+        so that no other thread or teapot process works on them at the same
+        time.
+
+        Locking the previous stages too prevents their results from changing
+        while they are used, and ensures locks are always taken in the same
+        order.
+
+        The manifests of the locked stages are read again, as another process
+        may have changed them.
+        """
+
+        names = [name for name, _, _ in self.stages]
+        acquired = []
+
+        try:
+            for name, root_option, manifests in self.stages[:names.index(stage) + 1]:
+                lock = get_file_lock(os.path.join(
+                    from_user_path(get_option(root_option)),
+                    '.locks',
+                    '%s.lock' % self.name,
+                ))
+                lock.acquire()
+                acquired.append(lock)
+
+                for manifest in manifests:
+                    setattr(self, manifest, {})
+
+            yield
+
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
     @property
     def cache_manifest_path(self):
         return os.path.join(self.cache_path, 'manifest.json')
@@ -215,6 +271,59 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
 
         self._post_unpack_commands = map(make_command, value)
 
+    def add_extracted_path(self, path):
+        """
+        Extract `path` along with the subdirectories of the builds.
+
+        `path` is relative to the extracted sources and can be a shell-style
+        pattern.
+        """
+
+        self._extracted_paths.append(path)
+
+        return self
+
+    def add_excluded_path(self, path):
+        """
+        Do not extract `path`.
+
+        `path` is relative to the extracted sources and can be a shell-style
+        pattern.
+        """
+
+        self._excluded_paths.append(path)
+
+        return self
+
+    @property
+    def extraction_patterns(self):
+        """
+        Get the include and exclude patterns of the paths to extract.
+
+        Unless the `selective_extraction` option is disabled, only the
+        subdirectories of the enabled builds and the extracted paths are
+        included, along with the files at the root of the sources. Everything
+        is included if a build has no subdirectory, if there are no builds
+        nor extracted paths, or if there are post-unpack commands, as they may
+        need any file: the include patterns are None then.
+        """
+
+        if not get_option('selective_extraction'):
+            return None, []
+
+        excludes = sorted(set('/'.join(split_member_path(path)) for path in self._excluded_paths))
+
+        if self.post_unpack_commands:
+            return None, excludes
+
+        paths = [build.subdir for build in self.builds] + self._extracted_paths
+
+        # Paths such as '' or '.' are the root of the sources.
+        if not paths or not all(path and split_member_path(path) for path in paths):
+            return None, excludes
+
+        return sorted(set('/'.join(split_member_path(path)) for path in paths)), excludes
+
     @property
     def builds_manifest_path(self):
         return os.path.join(self.builds_path, 'manifest.json')
@@ -238,7 +347,7 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
         self._cache_manifest = value
 
         mkdir(self.cache_path)
-        json.dump(self._cache_manifest, open(self.cache_manifest_path, 'w'))
+        write_json(self.cache_manifest_path, self._cache_manifest)
 
     @property
     def last_parsed_source(self):
@@ -256,7 +365,7 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
         self._last_parsed_source = value
 
         mkdir(self.cache_path)
-        json.dump(self._last_parsed_source, open(self.cache_last_parsed_source_path, 'w'))
+        write_json(self.cache_last_parsed_source_path, self._last_parsed_source)
 
     @property
     def sources_manifest(self):
@@ -277,7 +386,7 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
         self._sources_manifest = value
 
         mkdir(self.sources_path)
-        json.dump(self._sources_manifest, open(self.sources_manifest_path, 'w'))
+        write_json(self.sources_manifest_path, self._sources_manifest)
 
     @property
     def last_unpacked_archive_info(self):
@@ -295,7 +404,7 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
         self._last_unpacked_archive_info = value
 
         mkdir(self.sources_path)
-        json.dump(self._last_unpacked_archive_info, open(self.sources_last_unpacked_archive_info_path, 'w'))
+        write_json(self.sources_last_unpacked_archive_info_path, self._last_unpacked_archive_info)
 
     @property
     def builds_manifest(self):
@@ -316,7 +425,7 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
         self._builds_manifest = value
 
         mkdir(self.builds_path)
-        json.dump(self._builds_manifest, open(self.builds_manifest_path, 'w'))
+        write_json(self.builds_manifest_path, self._builds_manifest)
 
     @property
     def archive_path(self):
@@ -326,6 +435,45 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
     def archive_type(self):
         return tuple(self.cache_manifest.get('archive_type', []))
 
+    @property
+    def archive_digest(self):
+        """
+        Get the digest of the archive file.
+
+        The digest computed by the fetcher is used as long as the archive did
+        not change since. Otherwise, it comes from the digest cache.
+
+        The digest of a folder is always the one computed by the fetcher, as
+        it keeps it up-to-date while synchronizing the folder.
+        """
+
+        digest = self.cache_manifest.get('archive_digest')
+
+        if os.path.isdir(self.archive_path):
+            return digest
+
+        if digest:
+            stat_key = DigestCache.get_stat_key(os.stat(self.archive_path))
+
+            if self.cache_manifest.get('archive_stat') == stat_key:
+                return digest
+
+        return get_digest_cache().get_digest(self.archive_path)
+
+    @property
+    def archive_members(self):
+        """
+        Get the members of the archive, as listed in its index.
+
+        The archive is only read if it was not indexed yet. Return None if
+        the archive was not fetched or has no members that can be listed.
+        """
+
+        if not self.archive_path or not os.path.isfile(self.archive_path):
+            return None
+
+        return Unpacker.get_instance_or_fail(self.archive_type).get_members(self.archive_path)
+
     @property
     def extracted_sources_path(self):
         return self.sources_manifest.get('extracted_sources_path')
@@ -433,66 +581,69 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
         Clean the cache.
         """
 
-        if os.path.exists(self.cache_path):
-            LOGGER.info("Cleaning cache directory for %s.", hl(self))
-            LOGGER.debug(
-                "Cache directory for %s is at %s.",
-                hl(self),
-                hl(self.cache_path),
-            )
+        with self.locked('fetch'):
+            if os.path.exists(self.cache_path):
+                LOGGER.info("Cleaning cache directory for %s.", hl(self))
+                LOGGER.debug(
+                    "Cache directory for %s is at %s.",
+                    hl(self),
+                    hl(self.cache_path),
+                )
 
-            rmdir(self.cache_path)
-        else:
-            LOGGER.debug(
-                "Cache directory for %s does not exist at %s. Nothing to do.",
-                hl(self),
-                hl(self.cache_path),
-            )
-            LOGGER.info("Cache directory for %s is already cleaned.", hl(self))
+                rmdir(self.cache_path)
+            else:
+                LOGGER.debug(
+                    "Cache directory for %s does not exist at %s. Nothing to do.",
+                    hl(self),
+                    hl(self.cache_path),
+                )
+                LOGGER.info("Cache directory for %s is already cleaned.", hl(self))
 
     def clean_sources(self):
         """
         Clean the sources.
         """
 
-        if os.path.exists(self.sources_path):
-            LOGGER.info("Cleaning sources directory for %s.", hl(self))
-            LOGGER.debug(
-                "Sources directory for %s is at %s.",
-                hl(self),
-                hl(self.sources_path),
-            )
+        with self.locked('unpack'):
+            if os.path.exists(self.sources_path):
+                LOGGER.info("Cleaning sources directory for %s.", hl(self))
+                LOGGER.debug(
+                    "Sources directory for %s is at %s.",
+                    hl(self),
+                    hl(self.sources_path),
+                )
 
-            rmdir(self.sources_path)
-        else:
-            LOGGER.debug(
-                "Sources directory for %s does not exist at %s. Nothing to do.",
-                hl(self),
-                hl(self.sources_path),
-            )
-            LOGGER.info("Sources directory for %s is already cleaned.", hl(self))
+                rmdir(self.sources_path)
+            else:
+                LOGGER.debug(
+                    "Sources directory for %s does not exist at %s. Nothing to do.",
+                    hl(self),
+                    hl(self.sources_path),
+                )
+                LOGGER.info("Sources directory for %s is already cleaned.", hl(self))
 
     def clean_builds(self):
         """
         Clean the builds.
         """
 
-        if os.path.exists(self.builds_path):
-            LOGGER.info("Cleaning builds directory for %s.", hl(self))
-            LOGGER.debug(
-                "Builds directory for %s is at %s.",
-                hl(self),
-                hl(self.builds_path),
-            )
+        with self.locked('build'):
+            if os.path.exists(self.builds_path):
+                LOGGER.info("Cleaning builds directory for %s.", hl(self))
+                LOGGER.debug(
+                    "Builds directory for %s is at %s.",
+                    hl(self),
+                    hl(self.builds_path),
+                )
 
-            rmdir(self.builds_path)
-        else:
-            LOGGER.debug(
-                "Builds directory for %s does not exist at %s. Nothing to do.",
-                hl(self),
-                hl(self.builds_path),
-            )
-            LOGGER.info("Builds directory for %s is already cleaned.", hl(self))
+                rmdir(self.builds_path)
+            else:
+                LOGGER.debug(
+                    "Builds directory for %s does not exist at %s. Nothing to do.",
+                    hl(self),
+                    hl(self.builds_path),
+                )
+                LOGGER.info("Builds directory for %s is already cleaned.", hl(self))
 
     @property
     def source(self):
@@ -515,72 +666,109 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
                     hl(self),
                 )
 
-            for source in self.sources:
-                try:
-                    parsed_source = source.parsed_source
-
-                    if parsed_source:
-                        if self.last_parsed_source != parsed_source:
-                            if self.last_parsed_source:
-                                LOGGER.info(
-                                    (
-                                        "Best source has changed for %s: cleaning "
-                                        "cache to trigger a refetch."
-                                    ),
-                                    hl(self),
-                                )
-                            else:
-                                LOGGER.info(
-                                    (
-                                        "No previous best source found for %s: "
-                                        "making sure the cache is cleaned so a "
-                                        "fetch will occur."
-                                    ),
-                                    hl(self),
-                                )
-
-                            self.clean_cache()
-                            self.last_parsed_source = parsed_source
-
-                        LOGGER.debug(
-                            "Best source for %s is now %s.",
-                            hl(self),
-                            hl(source),
-                        )
-
-                        self._source = source
-                        break
-
-                except TeapotError as ex:
-                    LOGGER.warning("Error parsing source %s: " + ex.msg, hl(source), *ex.msg_args)
-                except Exception as ex:
-                    LOGGER.warning("Error parsing source %s: %s", hl(source), hl(str(ex)))
+            # Changing the best source cleans the cache: other processes must
+            # not see the cache in the meantime.
+            with self.locked('fetch'):
+                for source in self.sources:
+                    try:
+                        parsed_source = source.parsed_source
+
+                        if parsed_source:
+                            if self.last_parsed_source != parsed_source:
+                                if self.last_parsed_source:
+                                    LOGGER.info(
+                                        (
+                                            "Best source has changed for %s: cleaning "
+                                            "cache to trigger a refetch."
+                                        ),
+                                        hl(self),
+                                    )
+                                else:
+                                    LOGGER.info(
+                                        (
+                                            "No previous best source found for %s: "
+                                            "making sure the cache is cleaned so a "
+                                            "fetch will occur."
+                                        ),
+                                        hl(self),
+                                    )
+
+                                self.clean_cache()
+                                self.last_parsed_source = parsed_source
+
+                            LOGGER.debug(
+                                "Best source for %s is now %s.",
+                                hl(self),
+                                hl(source),
+                            )
+
+                            self._source = source
+                            break
+
+                    except TeapotError as ex:
+                        LOGGER.warning("Error parsing source %s: " + ex.msg, hl(source), *ex.msg_args)
+                    except Exception as ex:
+                        LOGGER.warning("Error parsing source %s: %s", hl(source), hl(str(ex)))
 
         return self._source
 
-    def check_archive_signature(self):
+    def get_fastest_source(self):
         """
-        Check the archive signature.
+        Probe all the usable sources concurrently and get the one that
+        responded first, or None if none could be probed.
+
+        The sources are expected to be mirrors of the same archive: the cache
+        is not cleaned when a different source wins.
+        """
+
+        sources = []
+
+        for source in self.sources:
+            try:
+                if source.parsed_source:
+                    sources.append(source)
+
+            except Exception as ex:
+                LOGGER.debug("Ignoring source %s: %s", hl(source), hl(str(ex)))
+
+        if len(sources) < 2:
+            return None
+
+        LOGGER.info("Looking for the fastest source for %s...", hl(self))
+
+        return race_sources(sources)
+
+    @property
+    def archive_signature(self):
+        """
+        Get the signature of the archive, of the extraction patterns and of
+        the post-unpack commands.
+
+        Archive digests come from the download manifest or the digest cache so
+        that unchanged archives are not read again.
         """
 
         m = hashlib.sha1()
+        m.update(self.archive_digest or '')
 
-        def compute_hash(path):
-            if os.path.isfile(path):
-                with open(path) as f:
-                    for s in iter(lambda: f.read(1024 ** 2), ''):
-                        m.update(s)
-            else:
-                for root, dirs, files in os.walk(self.archive_path):
-                    for f in files:
-                        compute_hash(os.path.join(root, f))
+        # Archives that are entirely extracted keep the signature they had
+        # before extraction patterns existed.
+        includes, excludes = self.extraction_patterns
 
-        compute_hash(self.archive_path)
+        if includes is not None or excludes:
+            m.update(json.dumps({'includes': includes, 'excludes': excludes}, sort_keys=True))
 
         for command in self.post_unpack_commands:
             m.update(command)
 
-        archive_signature = m.hexdigest()
+        return m.hexdigest()
+
+    def check_archive_signature(self):
+        """
+        Check the archive signature.
+        """
+
+        archive_signature = self.archive_signature
 
         def update_signature():
             # This has to be done in this order or it won't work.
@@ -636,11 +824,14 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
 
         return True
 
-    def fetch(self, force=False):
+    def fetch(self, force=False, refresh=False):
         """
         Fetch the most appropriate source.
 
         If `force` is truthy, the archive will be force-fetched again.
+
+        If `refresh` is truthy, an already fetched archive is fetched again
+        only if it changed since, provided the fetcher can tell.
         """
 
         source = self.source
@@ -654,6 +845,13 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
                 if force:
                     LOGGER.info("%s was already fetched but force fetching was requested. Will fetch it again.", hl(self))
                     self.cache_manifest = {}
+                elif refresh:
+                    LOGGER.info("%s was already fetched but refreshing was requested. Will check for changes.", hl(self))
+                elif os.path.isdir(self.archive_path):
+                    # Folders are synchronized incrementally: it is cheap to
+                    # do it every time.
+                    LOGGER.info("%s was already fetched but is a folder. Will synchronize it.", hl(self))
+                    refresh = True
                 else:
                     LOGGER.info("%s was already fetched. Nothing to do.", hl(self))
             else:
@@ -662,14 +860,37 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
         else:
             LOGGER.info("No download manifest found for %s. Will fetch it.", hl(self))
 
-        if not self.cache_manifest:
+        if get_option('mirror_racing') and (refresh or not self.cache_manifest):
+            source = self.get_fastest_source() or source
+
+        if self.cache_manifest and refresh:
+            LOGGER.info('Refreshing %s from %s...', hl(self), hl(source))
+
+            previous_archive_path = self.archive_path
+            cache_manifest = source.refresh(target_path=self.cache_path, cache_manifest=self.cache_manifest)
+
+            if cache_manifest is self.cache_manifest:
+                LOGGER.info("%s did not change.", hl(self))
+            else:
+                self.set_fetched_cache_manifest(cache_manifest)
+
+                if self.archive_path != previous_archive_path and os.path.isfile(previous_archive_path):
+                    os.remove(previous_archive_path)
+
+                LOGGER.info("%s refreshed successfully.", hl(self))
+
+        elif not self.cache_manifest:
             LOGGER.info('Fetching %s from %s...', hl(self), hl(source))
 
             mkdir(self.cache_path)
 
-            self.cache_manifest = source.fetch(target_path=self.cache_path)
+            if force:
+                cache_manifest = source.refresh(target_path=self.cache_path, cache_manifest={})
+            else:
+                cache_manifest = source.fetch(target_path=self.cache_path)
+
+            self.set_fetched_cache_manifest(cache_manifest)
 
-            LOGGER.debug("Wrote new cache manifest for %s at: %s", hl(self), hl(self.cache_manifest_path))
             LOGGER.info("%s fetched successfully.", hl(self))
 
         if not self.cache_manifest:
@@ -688,6 +909,20 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
             hl(self.archive_path),
         )
 
+    def set_fetched_cache_manifest(self, cache_manifest):
+        """
+        Save the download manifest returned by a fetch.
+        """
+
+        # Remember the state of the archive the digest was computed for, so
+        # that the digest can be trusted as long as the archive is unchanged.
+        if cache_manifest and cache_manifest.get('archive_digest') and os.path.isfile(cache_manifest['archive_path']):
+            cache_manifest['archive_stat'] = DigestCache.get_stat_key(os.stat(cache_manifest['archive_path']))
+
+        self.cache_manifest = cache_manifest
+
+        LOGGER.debug("Wrote new cache manifest for %s at: %s", hl(self), hl(self.cache_manifest_path))
+
     def unpack(self, force=False):
         """
         Unpack the archive.
@@ -720,19 +955,28 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
             )
 
             unpacker = Unpacker.get_instance_or_fail(self.archive_type)
-            self.sources_manifest = unpacker.unpack(archive_path=self.archive_path, target_path=self.sources_path)
 
-            try:
-                with chdir(self.extracted_sources_path):
-                    for command in self.post_unpack_commands:
-                        LOGGER.info("Executing post-unpack command: %s", hl(command))
-                        subprocess.check_call(command, shell=True)
-            except Exception as ex:
-                LOGGER.error('Error when running the post-unpack command: %s', hl(ex))
-                LOGGER.debug('Clearing the sources manifest for %s', hl(self))
-                self.sources_manifest = {}
-
-                raise
+            if get_option('extraction_cache') and self.archive_digest:
+                # Attendees that share the archive, the extraction patterns
+                # and the post-unpack commands share the extracted tree.
+                extraction_cache = get_extraction_cache()
+                archive_signature = self.archive_signature
+
+                with extraction_cache.signature_lock(archive_signature):
+                    # A forced unpack replaces the stored tree.
+                    if force:
+                        extraction_cache.remove(archive_signature)
+
+                    sources_manifest = extraction_cache.get(archive_signature, self.sources_path)
+
+                    if sources_manifest:
+                        LOGGER.info("%s was already unpacked with the same post-unpack commands. Copying it.", hl(self))
+                        self.sources_manifest = sources_manifest
+                    else:
+                        self.unpack_archive(unpacker)
+                        extraction_cache.add(archive_signature, self.sources_path, self.sources_manifest)
+            else:
+                self.unpack_archive(unpacker)
 
             LOGGER.debug('Clearing builds manifest as unpacking just took place.')
             self.builds_manifest = {}
@@ -744,6 +988,39 @@ class Attendee(MemoizedObject, FilteredObject, PrefixedObject):
             hl(self.extracted_sources_path),
         )
 
+    def unpack_archive(self, unpacker):
+        """
+        Unpack the archive with `unpacker` and run the post-unpack commands.
+        """
+
+        includes, excludes = self.extraction_patterns
+
+        if includes is not None or excludes:
+            LOGGER.debug(
+                "Only extracting %s (excluding %s) for %s.",
+                hl(', '.join(includes) if includes is not None else 'everything'),
+                hl(', '.join(excludes) or 'nothing'),
+                hl(self),
+            )
+
+        self.sources_manifest = unpacker.unpack(
+            archive_path=self.archive_path,
+            target_path=self.sources_path,
+            includes=includes,
+            excludes=excludes,
+        )
+
+        try:
+            for command in self.post_unpack_commands:
+                LOGGER.info("Executing post-unpack command: %s", hl(command))
+                subprocess.check_call(command, shell=True, cwd=self.extracted_sources_path)
+        except Exception as ex:
+            LOGGER.error('Error when running the post-unpack command: %s', hl(ex))
+            LOGGER.debug('Clearing the sources manifest for %s', hl(self))
+            self.sources_manifest = {}
+
+            raise
+
     def build(self, force=False, verbose=False, keep_builds=False):
         """
         Build the attendee.
@@ -10,6 +10,7 @@ import math
 from datetime import datetime
 from contextlib import contextmanager
 from threading import Thread
+from functools import partial
 
 from .memoized import MemoizedObject
 from .log import LOGGER, Highlight as hl
@@ -19,7 +20,37 @@ from .environment import Environment
 from .prefix import PrefixedObject
 from .signature import SignableObject
 from .command import Command
-from .path import chdir
+from .scheduler import on_cancel
+
+
+def start_process(args, **kwargs):
+    """
+    Start a subprocess that can later be stopped with `terminate_process`.
+
+    On POSIX systems, the subprocess gets its own process group so that the
+    whole process tree can be terminated at once.
+    """
+
+    if hasattr(os, 'setpgrp'):
+        kwargs['preexec_fn'] = os.setpgrp
+
+    return subprocess.Popen(args, **kwargs)
+
+
+def terminate_process(process):
+    """
+    Terminate a subprocess started with `start_process`, and its children.
+    """
+
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGTERM)
+        else:
+            process.terminate()
+
+    except OSError:
+        # The process is already gone.
+        pass
 
 
 class Build(MemoizedObject, FilteredObject, PrefixedObject, SignableObject):
@@ -119,6 +150,9 @@ class Build(MemoizedObject, FilteredObject, PrefixedObject, SignableObject):
     def handle_interruptions(self, callable=None):
         """
         Handle interruptions.
+
+        Signal handlers can only be installed from the main thread: from other
+        threads, `callable` is called when the scheduler cancels its tasks.
         """
 
         def handler(signum, frame):
@@ -127,7 +161,13 @@ class Build(MemoizedObject, FilteredObject, PrefixedObject, SignableObject):
             if callable:
                 callable()
 
-        previous_handler = signal.signal(signal.SIGINT, handler)
+        try:
+            previous_handler = signal.signal(signal.SIGINT, handler)
+        except ValueError:
+            with on_cancel(callable):
+                yield
+
+            return
 
         try:
             yield
@@ -139,79 +179,87 @@ class Build(MemoizedObject, FilteredObject, PrefixedObject, SignableObject):
         Launch the build in the specified `path`.
 
         `log_path` is the path to the log file to create.
+
+        The process environment and current directory are left untouched so
+        that several builds can run concurrently.
         """
 
         working_dir = os.path.join(path, self.subdir if self.subdir else '')
 
         with self.create_log_file(log_path) as log_file:
-            with chdir(working_dir):
-                with self.environment.enable() as env:
-                    LOGGER.info("Build started in %s at %s.", hl(working_dir), hl(datetime.now().strftime('%c')))
-                    log_file.write("Build started in %s at %s.\n" % (working_dir, datetime.now().strftime('%c')))
-
-                    if env.shell:
-                        LOGGER.info('Building within: %s', hl(' '.join(env.shell)))
-                        log_file.write('Using "%s" as a shell.\n' % ' '.join(env.shell))
-                    else:
-                        LOGGER.info('Building within %s.', hl('the default system shell'))
-                        log_file.write('Using system shell.\n')
+            # Extensions in commands may depend on the environment so they
+            # must be resolved while it is enabled.
+            with self.environment.enable() as env:
+                environ = os.environ.copy()
+                shell = env.shell
+                commands = self.commands
+
+            LOGGER.info("Build started in %s at %s.", hl(working_dir), hl(datetime.now().strftime('%c')))
+            log_file.write("Build started in %s at %s.\n" % (working_dir, datetime.now().strftime('%c')))
+
+            if shell:
+                LOGGER.info('Building within: %s', hl(' '.join(shell)))
+                log_file.write('Using "%s" as a shell.\n' % ' '.join(shell))
+            else:
+                LOGGER.info('Building within %s.', hl('the default system shell'))
+                log_file.write('Using system shell.\n')
 
-                    for key, value in os.environ.iteritems():
-                        LOGGER.debug('%s: %s', key, hl(value))
-                        log_file.write('%s: %s\n' % (key, value))
+            for key, value in environ.iteritems():
+                LOGGER.debug('%s: %s', key, hl(value))
+                log_file.write('%s: %s\n' % (key, value))
 
-                    for index, command in enumerate(self.commands):
-                        numbered_prefix = ('%%0%sd' % int(math.ceil(math.log10(len(self.commands))))) % index
+            for index, command in enumerate(commands):
+                numbered_prefix = ('%%0%sd' % int(math.ceil(math.log10(len(commands))))) % index
 
-                        LOGGER.important('%s: %s', numbered_prefix, hl(command))
-                        log_file.write('%s: %s\n' % (numbered_prefix, command))
+                LOGGER.important('%s: %s', numbered_prefix, hl(command))
+                log_file.write('%s: %s\n' % (numbered_prefix, command))
 
-                        if env.shell:
-                            process = subprocess.Popen(env.shell + [command], shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        else:
-                            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if shell:
+                    process = start_process(shell + [command], shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=working_dir, env=environ)
+                else:
+                    process = start_process(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=working_dir, env=environ)
 
-                        mixed_output = []
+                mixed_output = []
 
-                        with self.handle_interruptions(process.terminate):
-                            def read_stdout():
-                                for line in iter(process.stdout.readline, ''):
-                                    mixed_output.append((print_normal, line))
-                                    log_file.write(line)
+                with self.handle_interruptions(partial(terminate_process, process)):
+                    def read_stdout():
+                        for line in iter(process.stdout.readline, ''):
+                            mixed_output.append((print_normal, line))
+                            log_file.write(line)
 
-                                    if verbose:
-                                        print_normal(line)
+                            if verbose:
+                                print_normal(line)
 
-                            def read_stderr():
-                                for line in iter(process.stderr.readline, ''):
-                                    mixed_output.append((print_error, line))
-                                    log_file.write(line)
+                    def read_stderr():
+                        for line in iter(process.stderr.readline, ''):
+                            mixed_output.append((print_error, line))
+                            log_file.write(line)
 
-                                    if verbose:
-                                        print_error(line)
+                            if verbose:
+                                print_error(line)
 
-                            stdout_thread = Thread(target=read_stdout)
-                            stdout_thread.daemon = True
-                            stdout_thread.start()
+                    stdout_thread = Thread(target=read_stdout)
+                    stdout_thread.daemon = True
+                    stdout_thread.start()
 
-                            stderr_thread = Thread(target=read_stderr)
-                            stderr_thread.daemon = True
-                            stderr_thread.start()
+                    stderr_thread = Thread(target=read_stderr)
+                    stderr_thread.daemon = True
+                    stderr_thread.start()
 
-                            map(Thread.join, [stdout_thread, stderr_thread])
-                            process.wait()
+                    map(Thread.join, [stdout_thread, stderr_thread])
+                    process.wait()
 
-                        log_file.write('\n')
+                log_file.write('\n')
 
-                        if process.returncode != 0:
-                            if not verbose:
-                                for func, line in mixed_output:
-                                    func(line)
+                if process.returncode != 0:
+                    if not verbose:
+                        for func, line in mixed_output:
+                            func(line)
 
-                            log_file.write('Command failed with status: %s\n' % process.returncode)
-                            log_file.write('Build failed at %s.\n' % datetime.now().strftime('%c'))
+                    log_file.write('Command failed with status: %s\n' % process.returncode)
+                    log_file.write('Build failed at %s.\n' % datetime.now().strftime('%c'))
 
-                            raise subprocess.CalledProcessError(returncode=process.returncode, cmd=command)
+                    raise subprocess.CalledProcessError(returncode=process.returncode, cmd=command)
 
-                    LOGGER.info("Build succeeded at %s.", hl(datetime.now().strftime('%c')))
-                    log_file.write("Build succeeded at %s.\n" % datetime.now().strftime('%c'))
+            LOGGER.info("Build succeeded at %s.", hl(datetime.now().strftime('%c')))
+            log_file.write("Build succeeded at %s.\n" % datetime.now().strftime('%c'))
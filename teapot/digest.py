@@ -0,0 +1,267 @@
+"""
+File digests computation and caching.
+"""
+
+import os
+import time
+import hashlib
+import threading
+
+from .error import TeapotError
+from .log import LOGGER, Highlight as hl
+from .options import get_option
+from .path import mkdir, from_user_path, read_json, write_json
+
+
+class DigestCache(object):
+
+    """
+    Remembers the digest of files, so that they are only read and hashed
+    again when their size, modification time or inode change.
+    """
+
+    # Files modified less than this number of seconds ago could be modified
+    # again without their modification time changing: their digest is not
+    # persisted.
+    racy_delay = 2
+
+    # The size of the chunks read when hashing files.
+    chunk_size = 1024 ** 2
+
+    def __init__(self, path, hash=hashlib.sha1):
+        """
+        Create a digest cache, persisted at `path`.
+        """
+
+        self.path = path
+        self.hash = hash
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = read_json(self.path)
+
+        return self._entries
+
+    @staticmethod
+    def get_stat_key(stat):
+        """
+        Get the part of a file stat that identifies its content.
+        """
+
+        return [stat.st_size, stat.st_mtime, stat.st_ino]
+
+    def compute_digest(self, path):
+        """
+        Read and hash the file at `path`.
+        """
+
+        m = self.hash()
+
+        with open(path, 'rb') as f:
+            for s in iter(lambda: f.read(self.chunk_size), ''):
+                m.update(s)
+
+        return m.hexdigest()
+
+    def get_digest(self, path):
+        """
+        Get the digest of the file at `path`.
+
+        The file is only hashed if it changed since the last call.
+        """
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stat_key = self.get_stat_key(stat)
+
+        with self._lock:
+            entry = self.entries.get(path)
+
+        if entry and entry.get('stat') == stat_key and entry.get('digest'):
+            return entry['digest']
+
+        LOGGER.debug('Computing digest of %s...', hl(path))
+        digest = self.compute_digest(path)
+
+        self.set_digest(path, digest, stat=stat)
+
+        return digest
+
+    def set_digest(self, path, digest, stat=None):
+        """
+        Remember the `digest` of the file at `path`.
+
+        Use this when the digest was computed by other means, for instance
+        while the file was written. `stat` is the stat of the file at the
+        time the digest was computed.
+        """
+
+        path = os.path.abspath(path)
+
+        if stat is None:
+            stat = os.stat(path)
+
+        with self._lock:
+            if time.time() - stat.st_mtime < self.racy_delay:
+                self.entries.pop(path, None)
+            else:
+                self.entries[path] = {
+                    'stat': self.get_stat_key(stat),
+                    'digest': digest,
+                }
+
+            self._dirty = True
+
+    def get_checksums(self, path):
+        """
+        Get the known checksums of the file at `path`, by hashlib algorithm
+        name.
+
+        Only the checksums computed since the file last changed are returned.
+        """
+
+        path = os.path.abspath(path)
+        stat_key = self.get_stat_key(os.stat(path))
+
+        with self._lock:
+            entry = self.entries.get(path)
+
+            if entry and entry.get('stat') == stat_key:
+                return dict(entry.get('checksums', {}))
+
+        return {}
+
+    def set_checksums(self, path, checksums, stat=None):
+        """
+        Remember the `checksums` of the file at `path`, by hashlib algorithm
+        name.
+
+        `stat` is the stat of the file at the time the checksums were
+        computed.
+        """
+
+        path = os.path.abspath(path)
+
+        if stat is None:
+            stat = os.stat(path)
+
+        stat_key = self.get_stat_key(stat)
+
+        with self._lock:
+            if time.time() - stat.st_mtime < self.racy_delay:
+                return
+
+            entry = self.entries.get(path)
+
+            if not entry or entry.get('stat') != stat_key:
+                entry = self.entries[path] = {'stat': stat_key}
+
+            entry.setdefault('checksums', {}).update(checksums)
+            self._dirty = True
+
+    def save(self):
+        """
+        Persist the cache, if it changed.
+        """
+
+        with self._lock:
+            if not self._dirty:
+                return
+
+            mkdir(os.path.dirname(self.path))
+            write_json(self.path, self._entries)
+            self._dirty = False
+
+
+class StreamDigest(object):
+
+    """
+    Computes the digest of data as it is written, and checks it against
+    expected checksums.
+    """
+
+    def __init__(self, checksums=None, hash=hashlib.sha1):
+        """
+        Create a stream digest.
+
+        `checksums` is a dictionary of expected hexadecimal digests, indexed
+        by hashlib algorithm names.
+        """
+
+        self.checksums = checksums or {}
+        self._hash = hash()
+        self._checksum_hashes = {
+            name: hashlib.new(name) for name in self.checksums
+        }
+
+    def update(self, data):
+        """
+        Add some data to the digest.
+        """
+
+        self._hash.update(data)
+
+        for checksum_hash in self._checksum_hashes.itervalues():
+            checksum_hash.update(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def get_checksums(self):
+        """
+        Get the checksums of the data, by hashlib algorithm name.
+        """
+
+        return {
+            algorithm: checksum_hash.hexdigest()
+            for algorithm, checksum_hash in self._checksum_hashes.iteritems()
+        }
+
+    def verify(self, name):
+        """
+        Check the data against the expected checksums.
+
+        `name` is the user-friendly name of the data, used in the error
+        messages.
+        """
+
+        for algorithm, expected in sorted(self.checksums.iteritems()):
+            actual = self._checksum_hashes[algorithm].hexdigest()
+
+            if actual != expected.lower():
+                raise TeapotError(
+                    "The %s checksum of %s does not match: expected %s but got %s.",
+                    algorithm,
+                    hl(name),
+                    hl(expected),
+                    hl(actual),
+                )
+
+            LOGGER.debug(
+                "The %s checksum of %s matches (%s).",
+                algorithm,
+                hl(name),
+                hl(actual),
+            )
+
+
+_DIGEST_CACHES = {}
+_DIGEST_CACHES_LOCK = threading.Lock()
+
+
+def get_digest_cache():
+    """
+    Get the digest cache that lives in the cache root.
+    """
+
+    path = os.path.join(from_user_path(get_option('cache_root')), 'digests.json')
+
+    with _DIGEST_CACHES_LOCK:
+        if path not in _DIGEST_CACHES:
+            _DIGEST_CACHES[path] = DigestCache(path)
+
+        return _DIGEST_CACHES[path]
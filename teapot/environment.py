@@ -5,15 +5,22 @@ An environment class.
 import os
 import re
 import sys
+import threading
 
 from contextlib import contextmanager
 
-from .memoized import MemoizedObject
+from .memoized import Memoized, MemoizedObject
+from .graph import DependencyGraph
 from .error import TeapotError
 from .log import LOGGER, Highlight as hl
 from .signature import SignableObject
 
 
+# Enabling an environment modifies `os.environ` for the whole process so only
+# one thread at a time can do it.
+_ENABLE_LOCK = threading.RLock()
+
+
 class Environment(MemoizedObject, SignableObject):
 
     """
@@ -84,6 +91,8 @@ class Environment(MemoizedObject, SignableObject):
         """
 
         self._parent = environment
+        Memoized.invalidate()
+
         return self
 
     @property
@@ -105,16 +114,36 @@ class Environment(MemoizedObject, SignableObject):
 
         return self._parent
 
+    _dependency_graph = None
+
+    @classmethod
+    def get_dependency_graph(cls):
+        """
+        Get the dependency graph of the environments.
+
+        The graph is computed once and only computed again when the memoized
+        instances or their parents change.
+        """
+
+        graph = cls._dependency_graph
+
+        if graph is None or graph.generation != Memoized.generation:
+            graph = DependencyGraph(
+                cls.get_instances(),
+                get_parents=lambda environment: [environment.parent] if environment.parent else [],
+                generation=Memoized.generation,
+            )
+            cls._dependency_graph = graph
+
+        return graph
+
     @property
     def children(self):
         """
         Get environments that directly depend on this environment.
         """
 
-        return {
-            environment for environment in self.get_instances()
-            if self == environment.parent
-        }
+        return set(self.get_dependency_graph().children.get(self, set()))
 
     @property
     def shell(self):
@@ -147,8 +176,17 @@ class Environment(MemoizedObject, SignableObject):
         If `silent` is truthy, no log output will be done.
 
         enable() is supposed to be used with a `with` statement.
+
+        Other threads that try to enable an environment block until the call
+        returns.
         """
 
+        with _ENABLE_LOCK:
+            with self._enable(silent=silent):
+                yield self
+
+    @contextmanager
+    def _enable(self, silent=False):
         saved_environ = os.environ.copy()
 
         try:
@@ -0,0 +1,226 @@
+"""
+A content-addressed cache of extracted archives.
+"""
+
+import os
+import json
+import threading
+
+from .log import LOGGER, Highlight as hl
+from .options import get_option
+from .path import mkdir, rmdir, copytree, read_json, write_json, from_user_path
+from .lock import get_file_lock
+
+
+class ExtractionCache(object):
+
+    """
+    Stores pristine extracted trees by archive signature, so that an archive
+    unpacked with the same post-unpack commands by several attendees, parties
+    or checkouts is only extracted once.
+
+    The trees are stored once the post-unpack commands ran, and the sources
+    directories get copies of them. They are not hardlinked: builds and
+    post-unpack commands may write the sources in place, which must neither
+    change the stored tree nor the sources of the other attendees.
+
+    Every tree remembers the sources directories it was copied to, so that
+    it is only pruned once none of them is left.
+    """
+
+    def __init__(self, path):
+        """
+        Create an extraction cache at `path`.
+        """
+
+        self.path = path
+
+    def get_tree_path(self, signature):
+        """
+        Get the path of the tree with the specified archive `signature`.
+        """
+
+        return os.path.join(self.path, 'trees', signature[:2], signature)
+
+    def signature_lock(self, signature):
+        """
+        Get the lock of the specified archive `signature`, so that concurrent
+        unpacks of a same archive, from any thread or teapot process, happen
+        one after the other and only the first extracts it.
+        """
+
+        return get_file_lock(os.path.join(self.path, 'locks', '%s.lock' % signature))
+
+    def get_users_path(self, tree_path):
+        """
+        Get the path of the file that lists the copies of the tree at
+        `tree_path`.
+        """
+
+        return os.path.join(tree_path, 'users.json')
+
+    def copy_tree(self, source_path, target_path):
+        """
+        Copy the tree at `source_path` to `target_path`, replacing it.
+        """
+
+        if os.path.isdir(target_path):
+            rmdir(target_path)
+        elif os.path.lexists(target_path):
+            os.remove(target_path)
+
+        mkdir(os.path.dirname(target_path))
+        copytree(source_path, target_path, symlinks=True)
+
+    def add_user(self, tree_path, extracted_sources_path):
+        """
+        Remember that the tree at `tree_path` was copied to
+        `extracted_sources_path`.
+
+        The copy is identified by the inode of its directory, so that a tree
+        that was since replaced by another one doesn't count.
+        """
+
+        users_path = self.get_users_path(tree_path)
+        users = read_json(users_path)
+        users[os.path.abspath(extracted_sources_path)] = os.stat(extracted_sources_path).st_ino
+        write_json(users_path, users)
+
+    def get(self, signature, target_path):
+        """
+        Get the tree with the specified archive `signature` into
+        `target_path`.
+
+        Return the sources manifest, or None if no such tree was stored.
+        """
+
+        tree_path = self.get_tree_path(signature)
+
+        try:
+            with open(os.path.join(tree_path, 'manifest.json')) as f:
+                manifest = json.load(f)
+
+        except (IOError, ValueError):
+            return None
+
+        name = manifest['extracted_sources_name']
+        extracted_sources_path = os.path.join(target_path, name)
+
+        LOGGER.debug("Getting %s from the extraction cache...", hl(signature))
+        self.copy_tree(os.path.join(tree_path, 'tree', name), extracted_sources_path)
+        self.add_user(tree_path, extracted_sources_path)
+
+        return {
+            'extracted_sources_path': extracted_sources_path,
+        }
+
+    def add(self, signature, target_path, manifest):
+        """
+        Add the tree with the specified archive `signature`, extracted into
+        `target_path` as described by its sources `manifest`.
+        """
+
+        tree_path = self.get_tree_path(signature)
+
+        if os.path.isfile(os.path.join(tree_path, 'manifest.json')):
+            return
+
+        name = os.path.relpath(manifest['extracted_sources_path'], target_path)
+
+        if name == os.curdir or name.split(os.sep)[0] == os.pardir:
+            LOGGER.debug(
+                "Not storing %s in the extraction cache as it was not extracted in %s.",
+                hl(manifest['extracted_sources_path']),
+                hl(target_path),
+            )
+
+            return
+
+        tmp_path = '%s.%s.tmp' % (tree_path, os.getpid())
+
+        if os.path.isdir(tmp_path):
+            rmdir(tmp_path)
+
+        LOGGER.debug("Adding %s to the extraction cache...", hl(signature))
+        self.copy_tree(manifest['extracted_sources_path'], os.path.join(tmp_path, 'tree', name))
+        self.add_user(tmp_path, manifest['extracted_sources_path'])
+        write_json(os.path.join(tmp_path, 'manifest.json'), {'extracted_sources_name': name})
+
+        # A tree without a manifest was left by an interrupted process.
+        if os.path.isdir(tree_path):
+            rmdir(tree_path)
+
+        os.rename(tmp_path, tree_path)
+
+    def remove(self, signature):
+        """
+        Remove the tree with the specified archive `signature`, if it was
+        stored.
+
+        The sources directories it was copied to are left untouched.
+        """
+
+        tree_path = self.get_tree_path(signature)
+
+        if os.path.isdir(tree_path):
+            LOGGER.debug("Removing %s from the extraction cache.", hl(signature))
+            rmdir(tree_path)
+
+    def prune(self):
+        """
+        Remove the trees that no sources directory uses anymore.
+        """
+
+        count = 0
+
+        for root, dirs, files in os.walk(os.path.join(self.path, 'trees')):
+            if 'manifest.json' not in files:
+                continue
+
+            # Don't walk the trees themselves.
+            del dirs[:]
+
+            signature = os.path.basename(root)
+
+            with self.signature_lock(signature):
+                if not self.is_used(root):
+                    self.remove(signature)
+                    count += 1
+
+        return count
+
+    def is_used(self, tree_path):
+        """
+        Check whether any copy of the tree at `tree_path` is still there.
+        """
+
+        for path, inode in read_json(self.get_users_path(tree_path)).iteritems():
+            try:
+                if os.stat(path).st_ino == inode:
+                    return True
+
+            except OSError:
+                pass
+
+        return False
+
+
+_EXTRACTION_CACHES = {}
+_EXTRACTION_CACHES_LOCK = threading.Lock()
+
+
+def get_extraction_cache():
+    """
+    Get the extraction cache that lives in the sources root.
+
+    It lives next to the sources directories, so that it is removed along
+    with them.
+    """
+
+    path = os.path.join(from_user_path(get_option('sources_root')), '.extractions')
+
+    with _EXTRACTION_CACHES_LOCK:
+        if path not in _EXTRACTION_CACHES:
+            _EXTRACTION_CACHES[path] = ExtractionCache(path)
+
+        return _EXTRACTION_CACHES[path]
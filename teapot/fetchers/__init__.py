@@ -8,3 +8,4 @@ from teapot.fetchers.file_fetcher import FileFetcher  # NOQA
 from teapot.fetchers.folder_fetcher import FolderFetcher  # NOQA
 from teapot.fetchers.http_fetcher import HttpFetcher  # NOQA
 from teapot.fetchers.github_fetcher import GithubFetcher  # NOQA
+from teapot.fetchers.git_fetcher import GitFetcher  # NOQA
@@ -4,6 +4,8 @@ A set of fetcher callbacks class.
 
 from progressbar import *
 
+from ..log import PROGRESS_BAR_LOCK
+
 
 class BaseFetcherCallback(object):
 
@@ -70,8 +72,13 @@ class ProgressBarFetcherCallback(BaseFetcherCallback):
         The fetch just started.
 
         You use a None `size` to indicate that the overall size is unknown.
+
+        If another progress bar is already displayed, this one stays silent.
         """
 
+        if not PROGRESS_BAR_LOCK.acquire(False):
+            return
+
         widgets = [target, ': ', Bar(marker='#', left='[', right='] '), Percentage(), ' - ', FileTransferSpeed()]
         kwargs = {}
 
@@ -87,6 +94,9 @@ class ProgressBarFetcherCallback(BaseFetcherCallback):
         The fetch was updated.
         """
 
+        if not hasattr(self, 'progressbar'):
+            return
+
         try:
             if progress is not None:
                 self.progressbar.update(progress)
@@ -98,7 +108,14 @@ class ProgressBarFetcherCallback(BaseFetcherCallback):
         The fetch finished.
         """
 
-        self.progressbar.finish()
+        if not hasattr(self, 'progressbar'):
+            return
+
+        try:
+            self.progressbar.finish()
+        finally:
+            del self.progressbar
+            PROGRESS_BAR_LOCK.release()
 
     def on_exception(self, exception):
         """
@@ -49,6 +49,46 @@ class FetcherImplementation(object):
 
         raise NotImplementedError
 
+    def refresh(self, fetch_info, target_path, progress, cache_manifest):
+        """
+        Reimplement this method if your fetcher can tell cheaply whether a
+        source changed since it was last fetched.
+
+        `cache_manifest` is the download manifest returned by the last fetch,
+        or an empty dictionary if a new fetch is forced: no previously fetched
+        data must be reused then.
+
+        This method must return the new download manifest, or `cache_manifest`
+        itself if the fetched archive is still up-to-date.
+
+        The default implementation fetches the source again.
+        """
+
+        return self.fetch(
+            fetch_info=fetch_info,
+            target_path=target_path,
+            progress=progress,
+        )
+
+    def probe(self, fetch_info, cancelled=None):
+        """
+        Reimplement this method if your fetcher can measure how fast a source
+        responds, to choose between mirrors.
+
+        `cancelled` is an event that gets set once the result of the probe is
+        not needed anymore: the probe should then release its connections as
+        soon as possible.
+
+        This method must return the time, in seconds, the source took to
+        respond, or None if probing is not supported.
+
+        It must raise an exception if the source is unreachable.
+
+        The default implementation returns None.
+        """
+
+        return None
+
 
 class Fetcher(MemoizedObject):
 
@@ -71,7 +111,7 @@ class Fetcher(MemoizedObject):
         """
 
         self._fetcher_impl = fetcher_impl_class()
-        self.progress = progress_class()
+        self.progress_class = progress_class
 
     def parse_source(self, source):
         """
@@ -87,15 +127,55 @@ class Fetcher(MemoizedObject):
         If fetching is not supported, a falsy value is returned.
         """
 
+        # Several fetches may run concurrently: each gets its own callback.
+        progress = self.progress_class()
+
         try:
             return self._fetcher_impl.fetch(
                 fetch_info=parsed_source,
                 target_path=target_path,
-                progress=self.progress
+                progress=progress
+            )
+
+        except Exception as ex:
+            progress.on_exception(ex)
+
+            raise
+
+    def probe(self, parsed_source, cancelled=None):
+        """
+        Measure how fast the specified `parsed_source` responds.
+
+        `cancelled` is an event that gets set once the result of the probe is
+        not needed anymore.
+
+        Return the response time, in seconds, or None if probing is not
+        supported.
+        """
+
+        return self._fetcher_impl.probe(fetch_info=parsed_source, cancelled=cancelled)
+
+    def refresh(self, parsed_source, target_path, cache_manifest):
+        """
+        Fetch the specified `parsed_source` again, if it changed since it was
+        fetched with the specified `cache_manifest`.
+
+        Return the new download manifest, or `cache_manifest` if it is still
+        up-to-date.
+        """
+
+        progress = self.progress_class()
+
+        try:
+            return self._fetcher_impl.refresh(
+                fetch_info=parsed_source,
+                target_path=target_path,
+                progress=progress,
+                cache_manifest=cache_manifest,
             )
 
         except Exception as ex:
-            self.progress.on_exception(ex)
+            progress.on_exception(ex)
 
             raise
 
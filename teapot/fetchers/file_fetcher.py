@@ -3,13 +3,25 @@ A local-file fetcher class.
 """
 
 import os
-import shutil
 import urlparse
 import mimetypes
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from teapot.fetchers.fetcher import register_fetcher
 from teapot.fetchers.fetcher import FetcherImplementation
-from teapot.path import rmdir
+from teapot.log import LOGGER
+from teapot.log import Highlight as hl
+from teapot.digest import StreamDigest, get_digest_cache
+from teapot.path import copy_range
+
+
+# The Linux ioctl that makes a file share the data blocks of another one
+# (a "reflink"), on filesystems that support it (btrfs, xfs...).
+FICLONE = 0x40049409
 
 
 @register_fetcher('file')
@@ -19,6 +31,9 @@ class FileFetcher(FetcherImplementation):
     Fetchs a file on the local filesystem.
     """
 
+    # The size of the chunks copied at once.
+    chunk_size = 1024 ** 2
+
     def parse_source(self, source):
         """
         Checks that the `source` is a local filename.
@@ -31,34 +46,160 @@ class FileFetcher(FetcherImplementation):
                 'file_path': os.path.abspath(parse.netloc + parse.path),
             }
 
+    def link_file(self, source_path, target_path):
+        """
+        Hardlink a file.
+
+        Return whether the file could be hardlinked.
+        """
+
+        try:
+            os.link(source_path, target_path)
+
+        except (AttributeError, OSError) as ex:
+            LOGGER.debug("Unable to hardlink %s: %s", hl(source_path), ex)
+
+            return False
+
+        return True
+
+    def clone_file(self, source_path, target_path):
+        """
+        Clone a file, on filesystems that support copy-on-write.
+
+        Return whether the file could be cloned.
+        """
+
+        if not fcntl or not hasattr(fcntl, 'ioctl'):
+            return False
+
+        with open(source_path, 'rb') as source_file:
+            with open(target_path, 'wb') as target_file:
+                try:
+                    fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+
+                except (IOError, OSError) as ex:
+                    LOGGER.debug("Unable to clone %s: %s", hl(source_path), ex)
+
+                    cloned = False
+
+                else:
+                    cloned = True
+
+        if not cloned:
+            os.remove(target_path)
+
+        return cloned
+
+    def copy_file_range(self, source_path, target_path, progress):
+        """
+        Copy a file without reading it into Python, by chunks, reporting
+        progress as it goes.
+
+        Return whether the file could be copied.
+        """
+
+        size = os.path.getsize(source_path)
+
+        try:
+            with open(source_path, 'rb') as source_file:
+                # `copy_range()` writes at the position of the file
+                # descriptor: the writes must not be buffered.
+                with open(target_path, 'wb', 0) as target_file:
+                    for offset in xrange(0, size, self.chunk_size):
+                        copy_range(source_file, offset, min(self.chunk_size, size - offset), target_file)
+
+                        progress.on_update(progress=min(offset + self.chunk_size, size))
+
+        except (IOError, OSError) as ex:
+            LOGGER.debug("Unable to copy %s without reading it: %s", hl(source_path), ex)
+
+            if os.path.exists(target_path):
+                os.remove(target_path)
+
+            return False
+
+        return True
+
+    def copy_file(self, source_path, target_path, checksums, progress):
+        """
+        Copy a file by chunks, reporting progress as it goes.
+
+        Return the digest of the file.
+        """
+
+        digest = StreamDigest(checksums)
+        current_size = 0
+
+        with open(source_path, 'rb') as source_file:
+            with open(target_path, 'wb') as target_file:
+                for buf in iter(lambda: source_file.read(self.chunk_size), ''):
+                    target_file.write(buf)
+                    digest.update(buf)
+                    current_size += len(buf)
+
+                    progress.on_update(progress=current_size)
+
+        return digest
+
     def fetch(self, fetch_info, target_path, progress):
         """
         Fetch a file.
+
+        The file is hardlinked if possible, cloned if the filesystem supports
+        it, and copied otherwise: by the kernel if it can, and by chunks
+        through Python as a last resort.
         """
 
-        archive_path = os.path.join(target_path, os.path.basename(fetch_info['file_path']))
+        file_path = fetch_info['file_path']
+        archive_path = os.path.join(target_path, os.path.basename(file_path))
+        checksums = fetch_info.get('checksums')
 
-        size = os.path.getsize(fetch_info['file_path'])
+        size = os.path.getsize(file_path)
 
         if not size:
             size = None
 
-        rmdir(archive_path)
+        if os.path.lexists(archive_path):
+            os.remove(archive_path)
 
         progress.on_start(target=os.path.basename(archive_path), size=size)
 
-        if os.path.isfile(fetch_info['file_path']):
-            shutil.copyfile(fetch_info['file_path'], archive_path)
-            archive_type = mimetypes.guess_type(fetch_info['file_path'], strict=False)
+        if self.link_file(file_path, archive_path) or self.clone_file(file_path, archive_path) or self.copy_file_range(file_path, archive_path, progress):
+            progress.on_update(progress=size)
+
+            # The data was not read by Python: it still has to be checked, but
+            # its digest may already be known.
+            if checksums:
+                digest = StreamDigest(checksums)
+
+                with open(archive_path, 'rb') as archive_file:
+                    for buf in iter(lambda: archive_file.read(self.chunk_size), ''):
+                        digest.update(buf)
+
+                archive_digest = digest.hexdigest()
+            else:
+                digest = None
+                archive_digest = get_digest_cache().get_digest(file_path)
+
+        else:
+            digest = self.copy_file(file_path, archive_path, checksums, progress)
+            archive_digest = digest.hexdigest()
+
+        if digest:
+            try:
+                digest.verify(file_path)
+            except Exception:
+                os.remove(archive_path)
+
+                raise
 
-        # No real interactive progress to show here.
-        #
-        # This could be fixed though.
+        archive_type = mimetypes.guess_type(file_path, strict=False)
 
-        progress.on_update(progress=size)
         progress.on_finish()
 
         return {
             'archive_path': archive_path,
             'archive_type': archive_type,
+            'archive_digest': archive_digest,
         }
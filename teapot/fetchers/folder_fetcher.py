@@ -3,12 +3,25 @@ A local-folder fetcher class.
 """
 
 import os
+import sys
+import json
+import stat
+import time
 import shutil
+import hashlib
 import urlparse
 
+from itertools import imap
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
 from teapot.fetchers.fetcher import register_fetcher
 from teapot.fetchers.fetcher import FetcherImplementation
-from teapot.path import rmdir
+from teapot.error import TeapotError
+from teapot.log import LOGGER
+from teapot.log import Highlight as hl
+from teapot.path import mkdir, rmdir, write_json
+from teapot.digest import DigestCache
 
 
 @register_fetcher('folder')
@@ -16,8 +29,22 @@ class FolderFetcher(FetcherImplementation):
 
     """
     Fetchs a folder on the local filesystem.
+
+    The folder is synchronized incrementally: only the files whose size or
+    modification time changed since the last fetch are copied again, and the
+    files that were removed from the folder are removed from its copy.
+
+    A Merkle tree of the folder is kept next to the copy: it remembers the
+    stat and digest of every file, and the digest of every directory. The
+    digest of the folder is the digest of its root directory.
     """
 
+    # The size of the chunks copied at once.
+    chunk_size = 1024 ** 2
+
+    # The maximum number of files copied and hashed concurrently.
+    copy_threads = 8
+
     def parse_source(self, source):
         """
         Checks that the `source` is a local filename.
@@ -30,29 +57,308 @@ class FolderFetcher(FetcherImplementation):
                 'folder_path': os.path.abspath(parse.netloc + parse.path),
             }
 
+    def get_tree_path(self, archive_path):
+        """
+        Get the path of the tree of the folder copied at `archive_path`.
+        """
+
+        return '%s.files.json' % archive_path
+
+    def load_tree(self, path):
+        """
+        Load the tree at `path`.
+
+        Return None if it does not exist or is invalid.
+        """
+
+        try:
+            with open(path) as f:
+                tree = json.load(f)
+
+        except (IOError, ValueError):
+            return None
+
+        if not isinstance(tree, dict) or not isinstance(tree.get('dirs'), dict):
+            return None
+
+        return tree
+
+    def stat_entries(self, path, names):
+        """
+        Stat the entries with the specified `names` in the directory at
+        `path`.
+
+        Return the stats of the files and of the directories, by name.
+        """
+
+        files = {}
+        dirs = {}
+        prefix = os.path.join(path, u'')
+
+        for name in names:
+            entry_stat = os.stat(prefix + name)
+
+            if stat.S_ISDIR(entry_stat.st_mode):
+                dirs[name] = entry_stat
+            else:
+                files[name] = entry_stat
+
+        return files, dirs
+
+    def scan(self, folder_path, relpath, dir_stat, node, changes, removals, creations):
+        """
+        Scan the directory at `relpath` in the folder, whose stat is
+        `dir_stat` and whose node in the previous tree is `node`.
+
+        The directory listing is only read again if the modification time of
+        the directory changed. The files are always stat-ed, but they are
+        only hashed again if their size or modification time changed: they
+        are appended to `changes`. The entries that disappeared are appended
+        to `removals` and the new directories to `creations`.
+
+        Return the node of the directory in the new tree. Its digest is None
+        if it changed.
+        """
+
+        path = os.path.join(folder_path, relpath)
+        racy_time = time.time() - DigestCache.racy_delay
+        entries = None
+
+        if node is None:
+            node = {'mtime': None, 'digest': None, 'files': {}, 'dirs': {}}
+            creations.append(relpath)
+
+        elif node['mtime'] == dir_stat.st_mtime:
+            try:
+                entries = self.stat_entries(path, list(node['files']) + list(node['dirs']))
+            except OSError:
+                pass
+            else:
+                if set(entries[0]) != set(node['files']):
+                    entries = None
+
+        if entries is None:
+            entries = self.stat_entries(path, os.listdir(path))
+
+        files, dirs = entries
+        new_node = {
+            'mtime': dir_stat.st_mtime if dir_stat.st_mtime < racy_time else None,
+            'digest': None,
+            'files': {},
+            'dirs': {},
+        }
+        changed = set(files) != set(node['files']) or set(dirs) != set(node['dirs'])
+
+        for name in set(node['files']).difference(files):
+            removals.append(os.path.join(relpath, name))
+
+        for name in set(node['dirs']).difference(dirs):
+            removals.append(os.path.join(relpath, name))
+
+        for name, file_stat in files.iteritems():
+            entry = node['files'].get(name)
+
+            if not entry or entry[0] != file_stat.st_size or entry[1] != file_stat.st_mtime:
+                # Files modified too recently could change again without
+                # their modification time changing: they will be copied
+                # again.
+                entry = [
+                    file_stat.st_size,
+                    file_stat.st_mtime if file_stat.st_mtime < racy_time else None,
+                    None,
+                ]
+                changes.append((os.path.join(relpath, name), entry))
+                changed = True
+
+            new_node['files'][name] = entry
+
+        for name, subdir_stat in dirs.iteritems():
+            subnode = self.scan(
+                folder_path,
+                os.path.join(relpath, name),
+                subdir_stat,
+                node['dirs'].get(name),
+                changes,
+                removals,
+                creations,
+            )
+
+            if subnode['digest'] is None:
+                changed = True
+
+            new_node['dirs'][name] = subnode
+
+        if not changed:
+            new_node['digest'] = node['digest']
+
+        return new_node
+
+    def compute_digests(self, node):
+        """
+        Compute the digests of the directories that changed in the tree whose
+        root is `node`.
+
+        Return the digest of `node`.
+        """
+
+        if node['digest'] is None:
+            m = hashlib.sha1()
+
+            for name in sorted(node['files']):
+                m.update('f%s\0%s' % (name.encode('utf-8'), node['files'][name][2]))
+
+            for name in sorted(node['dirs']):
+                m.update('d%s\0%s' % (name.encode('utf-8'), self.compute_digests(node['dirs'][name])))
+
+            node['digest'] = m.hexdigest()
+
+        return node['digest']
+
+    def copy_file(self, source_path, target_path):
+        """
+        Copy a file by chunks.
+
+        Return the digest of the file and its size.
+        """
+
+        m = hashlib.sha1()
+        size = 0
+
+        with open(source_path, 'rb') as source_file:
+            with open(target_path, 'wb') as target_file:
+                for buf in iter(lambda: source_file.read(self.chunk_size), ''):
+                    target_file.write(buf)
+                    m.update(buf)
+                    size += len(buf)
+
+        shutil.copystat(source_path, target_path)
+
+        return m.hexdigest(), size
+
+    def sync(self, folder_path, archive_path, progress, tree):
+        """
+        Synchronize the copy at `archive_path` of a folder with the folder
+        itself.
+
+        `tree` is the tree of the current copy of the folder, or None if
+        there is none.
+
+        Return the new tree.
+        """
+
+        changes = []
+        removals = []
+        creations = []
+
+        tree = self.scan(folder_path, u'', os.stat(folder_path), tree, changes, removals, creations)
+
+        for relpath in removals:
+            path = os.path.join(archive_path, relpath)
+
+            if os.path.isdir(path):
+                rmdir(path)
+            elif os.path.lexists(path):
+                LOGGER.debug("Removing %s.", hl(path))
+                os.remove(path)
+
+        for relpath in creations:
+            mkdir(os.path.join(archive_path, relpath))
+
+        progress.on_start(
+            target=os.path.basename(archive_path),
+            size=sum(entry[0] for _, entry in changes) or None,
+        )
+
+        def copy(change):
+            relpath, entry = change
+
+            LOGGER.debug("Copying %s.", hl(relpath))
+            entry[2], size = self.copy_file(
+                os.path.join(folder_path, relpath),
+                os.path.join(archive_path, relpath),
+            )
+
+            return size
+
+        threads = min(self.copy_threads, cpu_count(), len(changes))
+        current_size = 0
+
+        if threads > 1:
+            pool = ThreadPool(threads)
+            sizes = pool.imap_unordered(copy, changes, chunksize=16)
+        else:
+            pool = None
+            sizes = imap(copy, changes)
+
+        try:
+            for size in sizes:
+                current_size += size
+                progress.on_update(progress=current_size)
+
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        progress.on_finish()
+
+        self.compute_digests(tree)
+
+        return tree
+
     def fetch(self, fetch_info, target_path, progress):
         """
         Fetch a folder.
+
+        Any previous copy of the folder is discarded.
         """
 
-        archive_path = os.path.join(target_path, os.path.basename(fetch_info['folder_path']))
+        return self.refresh(
+            fetch_info=fetch_info,
+            target_path=target_path,
+            progress=progress,
+            cache_manifest={},
+        )
+
+    def refresh(self, fetch_info, target_path, progress, cache_manifest):
+        """
+        Synchronize a previously fetched folder.
+        """
 
-        rmdir(archive_path)
+        folder_path = fetch_info['folder_path']
 
-        progress.on_start(target=os.path.basename(archive_path), size=None)
+        if not os.path.isdir(folder_path):
+            raise TeapotError("%s is not a folder.", hl(folder_path))
 
-        if os.path.isdir(fetch_info['folder_path']):
-            shutil.copytree(fetch_info['folder_path'], archive_path)
-            archive_type = (None, None)
+        # Work with unicode paths, so that the file names match the ones in
+        # the tree.
+        if isinstance(folder_path, str):
+            folder_path = folder_path.decode(sys.getfilesystemencoding())
 
-        # No real interactive progress to show here.
-        #
-        # This could be fixed though.
+        if isinstance(target_path, str):
+            target_path = target_path.decode(sys.getfilesystemencoding())
 
-        progress.on_update(progress=None)
-        progress.on_finish()
+        archive_path = os.path.join(target_path, os.path.basename(folder_path))
+        tree_path = self.get_tree_path(archive_path)
+        tree = None
+
+        if cache_manifest and cache_manifest.get('archive_digest'):
+            tree = self.load_tree(tree_path)
+
+        # Without a tree, the content of the copy is unknown.
+        if tree is None:
+            rmdir(archive_path)
+
+        new_tree = self.sync(folder_path, archive_path, progress, tree)
+
+        if new_tree != tree:
+            write_json(tree_path, new_tree)
+
+        if cache_manifest.get('archive_digest') == new_tree['digest']:
+            return cache_manifest
 
         return {
             'archive_path': archive_path,
-            'archive_type': archive_type,
+            'archive_type': (None, None),
+            'archive_digest': new_tree['digest'],
         }
@@ -0,0 +1,261 @@
+"""
+A git fetcher class.
+"""
+
+import os
+import re
+import hashlib
+import subprocess
+
+from teapot.fetchers.fetcher import register_fetcher
+from teapot.fetchers.fetcher import FetcherImplementation
+from teapot.error import TeapotError
+from teapot.log import LOGGER
+from teapot.log import Highlight as hl
+from teapot.options import get_option
+from teapot.path import mkdir, rmdir, from_user_path
+from teapot.lock import get_file_lock
+
+
+@register_fetcher('git')
+class GitFetcher(FetcherImplementation):
+
+    """
+    Fetchs a commit from a git repository.
+
+    A bare mirror of every repository is kept under the cache root and
+    updated incrementally, so that moving a ref forward only fetches the new
+    objects, and a commit that is already in the mirror is never fetched
+    again. The commit is then archived from the mirror.
+    """
+
+    # The size of the chunks read from `git archive` at once.
+    chunk_size = 1024 ** 2
+
+    def parse_source(self, source):
+        """
+        Checks that the `source` is a git repository URL, optionally followed
+        by a ref.
+        """
+
+        match = re.match(r'git:(?P<url>[^#]+)(#(?P<ref>.+))?$', source.resource)
+
+        if match:
+            return {
+                'url': match.group('url'),
+                'ref': match.group('ref') or 'HEAD',
+            }
+
+    def git(self, *args, **kwargs):
+        """
+        Run a git command and return its output.
+
+        Raise a `TeapotError` if it fails, unless `check` is falsy: None is
+        returned then.
+        """
+
+        check = kwargs.pop('check', True)
+        command = ['git'] + list(args)
+
+        LOGGER.debug("Running: %s", hl(' '.join(command)))
+
+        try:
+            process = subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                **kwargs
+            )
+
+        except OSError as ex:
+            raise TeapotError("Unable to run git: %s. Is it installed?", hl(str(ex)))
+
+        stdout, stderr = process.communicate()
+
+        if process.returncode != 0:
+            if not check:
+                return None
+
+            raise TeapotError(
+                "%s failed: %s",
+                hl(' '.join(command)),
+                hl(stderr.strip()),
+            )
+
+        return stdout
+
+    def get_mirror_path(self, url):
+        """
+        Get the path of the mirror of the repository at `url`.
+        """
+
+        return os.path.join(
+            from_user_path(get_option('cache_root')),
+            '.mirrors',
+            '%s.git' % hashlib.sha1(url).hexdigest(),
+        )
+
+    def get_remote_ref(self, url, ref):
+        """
+        Get the object the `ref` of the repository at `url` points to, without
+        fetching anything.
+
+        Return None if `ref` is not the name of a ref, for instance if it is
+        a commit SHA.
+        """
+
+        refs = {}
+
+        for line in self.git('ls-remote', url, ref).splitlines():
+            sha, name = line.split('\t', 1)
+            refs[name] = sha
+
+        for name in (ref, 'refs/heads/%s' % ref, 'refs/tags/%s' % ref):
+            if name in refs:
+                return refs[name]
+
+    def get_commit(self, mirror_path, rev):
+        """
+        Get the SHA of the commit `rev` designates in the mirror at
+        `mirror_path`.
+
+        Return None if the mirror does not contain it.
+        """
+
+        if not os.path.isdir(mirror_path):
+            return None
+
+        output = self.git(
+            'rev-parse', '--verify', '--quiet', '%s^{commit}' % rev,
+            cwd=mirror_path,
+            check=False,
+        )
+
+        if output:
+            return output.strip()
+
+    def update_mirror(self, url, mirror_path):
+        """
+        Create or update the mirror of the repository at `url`.
+        """
+
+        if os.path.isdir(mirror_path):
+            LOGGER.info("Updating the mirror of %s...", hl(url))
+            self.git('fetch', '--prune', '--quiet', 'origin', cwd=mirror_path)
+        else:
+            LOGGER.info("Cloning %s...", hl(url))
+            tmp_path = '%s.%s.tmp' % (mirror_path, os.getpid())
+
+            if os.path.isdir(tmp_path):
+                rmdir(tmp_path)
+
+            mkdir(os.path.dirname(mirror_path))
+            self.git('clone', '--mirror', '--quiet', url, tmp_path)
+            os.rename(tmp_path, mirror_path)
+
+    def resolve(self, fetch_info):
+        """
+        Get the SHA of the commit to fetch, updating the mirror only if it
+        does not contain it yet.
+
+        The mirror lock must be held.
+        """
+
+        url = fetch_info['url']
+        ref = fetch_info['ref']
+        mirror_path = self.get_mirror_path(url)
+        rev = ref
+
+        if not re.match(r'^[0-9a-f]{40}$', ref):
+            rev = self.get_remote_ref(url, ref) or ref
+
+        commit = self.get_commit(mirror_path, rev)
+
+        if not commit:
+            self.update_mirror(url, mirror_path)
+            commit = self.get_commit(mirror_path, rev)
+
+        if not commit:
+            raise TeapotError("Unable to find %s in %s.", hl(ref), hl(url))
+
+        LOGGER.debug("%s is at %s in %s.", hl(ref), hl(commit), hl(url))
+
+        return commit
+
+    def fetch(self, fetch_info, target_path, progress):
+        """
+        Fetch a commit.
+        """
+
+        return self.refresh(
+            fetch_info=fetch_info,
+            target_path=target_path,
+            progress=progress,
+            cache_manifest={},
+        )
+
+    def refresh(self, fetch_info, target_path, progress, cache_manifest):
+        """
+        Fetch a commit, if the ref now points to another one.
+        """
+
+        url = fetch_info['url']
+        mirror_path = self.get_mirror_path(url)
+
+        # The mirror is shared by all the attendees that use the repository.
+        with get_file_lock('%s.lock' % mirror_path):
+            commit = self.resolve(fetch_info)
+
+            if cache_manifest.get('commit') == commit and os.path.isfile(cache_manifest.get('archive_path', '')):
+                return cache_manifest
+
+            return self.archive(url, mirror_path, commit, target_path, progress)
+
+    def archive(self, url, mirror_path, commit, target_path, progress):
+        """
+        Archive `commit` from the mirror at `mirror_path`.
+        """
+
+        name = os.path.basename(url.rstrip('/'))
+
+        if name.endswith('.git'):
+            name = name[:-len('.git')]
+
+        prefix = '%s-%s' % (name, commit[:7])
+        archive_path = os.path.join(target_path, '%s.tar' % prefix)
+
+        progress.on_start(target=os.path.basename(archive_path), size=None)
+
+        command = ['git', 'archive', '--format=tar', '--prefix=%s/' % prefix, commit]
+        LOGGER.debug("Running: %s", hl(' '.join(command)))
+
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=mirror_path)
+        m = hashlib.sha1()
+        current_size = 0
+
+        try:
+            with open(archive_path, 'wb') as archive_file:
+                for buf in iter(lambda: process.stdout.read(self.chunk_size), ''):
+                    archive_file.write(buf)
+                    m.update(buf)
+                    current_size += len(buf)
+
+                    progress.on_update(progress=current_size)
+
+        finally:
+            process.stdout.close()
+            process.wait()
+
+        if process.returncode != 0:
+            os.remove(archive_path)
+
+            raise TeapotError("Unable to archive %s from %s.", hl(commit), hl(url))
+
+        progress.on_finish()
+
+        return {
+            'archive_path': archive_path,
+            'archive_type': ('application/x-tar', None),
+            'archive_digest': m.hexdigest(),
+            'commit': commit,
+        }
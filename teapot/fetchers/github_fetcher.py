@@ -2,10 +2,15 @@
 A Github fetcher class.
 """
 
+import os
 import re
 
 from teapot.fetchers.fetcher import register_fetcher
-from teapot.fetchers.http_fetcher import HttpFetcher
+from teapot.fetchers.http_fetcher import HttpFetcher, get_session
+from teapot.error import TeapotError
+from teapot.log import LOGGER
+from teapot.log import Highlight as hl
+from teapot.options import get_option
 
 
 @register_fetcher('github')
@@ -13,6 +18,10 @@ class GithubFetcher(HttpFetcher):
 
     """
     Fetchs an archive from Github.
+
+    The ref is resolved to a commit SHA first, and the archive of that commit
+    is fetched: it is only downloaded again when the ref moves to another
+    commit.
     """
 
     def parse_source(self, source):
@@ -25,8 +34,94 @@ class GithubFetcher(HttpFetcher):
         if match:
             values = match.groupdict()
             values['archive_format'] = 'tarball'
+            values['api_url'] = get_option('github_api_url').rstrip('/')
 
             return {
-                'url': 'https://api.github.com/repos/%(owner)s/%(repo)s/%(archive_format)s/%(ref)s' % values,
+                'url': '%(api_url)s/repos/%(owner)s/%(repo)s/%(archive_format)s/%(ref)s' % values,
+                'repository_url': '%(api_url)s/repos/%(owner)s/%(repo)s' % values,
+                'archive_format': values['archive_format'],
+                'ref': values['ref'],
                 'mimetype': source.mimetype,
             }
+
+    def resolve(self, fetch_info):
+        """
+        Get the SHA of the commit the ref points to.
+
+        Only the SHA is requested, which is much cheaper than the archive.
+        """
+
+        ref = fetch_info['ref']
+
+        if re.match(r'^[0-9a-f]{40}$', ref):
+            return ref
+
+        commit_url = '%s/commits/%s' % (fetch_info['repository_url'], ref)
+        response = get_session().get(
+            commit_url,
+            headers={'Accept': 'application/vnd.github.sha'},
+        )
+
+        try:
+            response.raise_for_status()
+            commit = response.text.strip()
+
+        finally:
+            response.close()
+
+        if not re.match(r'^[0-9a-f]{40}$', commit):
+            raise TeapotError(
+                "Unexpected response when resolving %s: %s",
+                hl(commit_url),
+                hl(commit[:80]),
+            )
+
+        LOGGER.debug("%s is at %s.", hl(ref), hl(commit))
+
+        return commit
+
+    def get_commit_fetch_info(self, fetch_info, commit):
+        """
+        Get the fetch information of the archive of the specified `commit`.
+        """
+
+        return dict(
+            fetch_info,
+            url='%s/%s/%s' % (fetch_info['repository_url'], fetch_info['archive_format'], commit),
+        )
+
+    def fetch(self, fetch_info, target_path, progress):
+        """
+        Fetch the archive of the commit the ref points to.
+        """
+
+        return self.refresh(
+            fetch_info=fetch_info,
+            target_path=target_path,
+            progress=progress,
+            cache_manifest={},
+        )
+
+    def refresh(self, fetch_info, target_path, progress, cache_manifest):
+        """
+        Fetch the archive again, only if the ref now points to another
+        commit.
+
+        As the archive of a given commit never changes, it is taken from the
+        download store if it was downloaded already, even if the fetch is
+        forced.
+        """
+
+        commit = self.resolve(fetch_info)
+
+        if cache_manifest.get('commit') == commit and os.path.isfile(cache_manifest.get('archive_path', '')):
+            return cache_manifest
+
+        manifest = super(GithubFetcher, self).fetch(
+            fetch_info=self.get_commit_fetch_info(fetch_info, commit),
+            target_path=target_path,
+            progress=progress,
+        )
+        manifest['commit'] = commit
+
+        return manifest
@@ -3,17 +3,119 @@ A HTTP fetcher class.
 """
 
 import os
+import re
+import sys
+import time
+import json
 import urlparse
 import requests
 import shutil
 import mimetypes
+import threading
+
+from contextlib import contextmanager
 
 from teapot.extra.rfc6266 import parse_requests_response
 
 from teapot.fetchers.fetcher import register_fetcher
 from teapot.fetchers.fetcher import FetcherImplementation
 from teapot.path import rmdir
+from teapot.error import TeapotError
 from teapot.log import LOGGER
+from teapot.log import Highlight as hl
+from teapot.options import get_option
+from teapot.digest import StreamDigest, get_digest_cache
+from teapot.scheduler import on_cancel
+from teapot.store import get_download_store
+
+
+_SESSION = None
+_HOST_SEMAPHORES = {}
+_LOCK = threading.Lock()
+
+
+def get_session():
+    """
+    Get the HTTP session shared by all the fetches.
+
+    Sharing a session allows connections to be kept alive and reused across
+    downloads from the same host.
+    """
+
+    global _SESSION
+
+    with _LOCK:
+        if _SESSION is None:
+            # The connections per host are limited by `host_slot()`: the pool
+            # only has to keep them all alive.
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=get_option('max_connections_per_host'),
+            )
+
+            _SESSION = requests.Session()
+            _SESSION.mount('http://', adapter)
+            _SESSION.mount('https://', adapter)
+
+        return _SESSION
+
+
+def get_host_semaphore(url):
+    """
+    Get the semaphore that counts the connection slots to the host of the
+    specified `url`.
+
+    The number of slots per host is set by the `max_connections_per_host`
+    option.
+    """
+
+    host = urlparse.urlparse(url).netloc
+
+    with _LOCK:
+        if host not in _HOST_SEMAPHORES:
+            _HOST_SEMAPHORES[host] = threading.Semaphore(get_option('max_connections_per_host'))
+
+        return _HOST_SEMAPHORES[host]
+
+
+@contextmanager
+def host_slot(url):
+    """
+    Wait for a connection slot to the host of the specified `url`.
+    """
+
+    semaphore = get_host_semaphore(url)
+
+    if not semaphore.acquire(False):
+        LOGGER.debug('Waiting for a free connection to %s...', hl(urlparse.urlparse(url).netloc))
+        semaphore.acquire()
+
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+@contextmanager
+def extra_host_slots(url, count):
+    """
+    Take up to `count` more connection slots to the host of the specified
+    `url`, without waiting for them.
+
+    Yield the number of slots that were taken. As the caller already holds a
+    slot, waiting for more could deadlock with other fetches doing the same.
+    """
+
+    semaphore = get_host_semaphore(url)
+    acquired = 0
+
+    while acquired < count and semaphore.acquire(False):
+        acquired += 1
+
+    try:
+        yield acquired
+    finally:
+        for _ in xrange(acquired):
+            semaphore.release()
 
 
 @register_fetcher('http')
@@ -23,6 +125,9 @@ class HttpFetcher(FetcherImplementation):
     Fetchs a file on the local filesystem.
     """
 
+    # The size of the chunks read from the network.
+    chunk_size = 64 * 1024
+
     def parse_source(self, source):
         """
         Checks that the `source` is a local filename.
@@ -39,11 +144,234 @@ class HttpFetcher(FetcherImplementation):
     def fetch(self, fetch_info, target_path, progress):
         """
         Fetch a file.
+
+        Files that were already downloaded, for any attendee, are taken from
+        the download store instead, unless they don't match the checksums of
+        the source: they are downloaded again then.
+        """
+
+        store = get_download_store()
+        url = fetch_info['url']
+
+        with store.url_lock(url):
+            manifest = store.get(url, fetch_info['mimetype'], target_path)
+
+            if manifest:
+                if self.check_stored_archive(manifest, fetch_info.get('checksums')):
+                    return manifest
+
+                LOGGER.warning("The stored archive of %s does not match its checksums. Will download it again.", hl(url))
+                os.remove(manifest['archive_path'])
+
+            with host_slot(url):
+                manifest = self.download(fetch_info, target_path, progress)
+
+            store.add(url, fetch_info['mimetype'], manifest)
+
+        return manifest
+
+    def check_stored_archive(self, manifest, checksums):
+        """
+        Check that an archive taken from the download store matches the
+        specified `checksums`.
+
+        The checksums of the stored archives are kept in the digest cache, so
+        that an archive is only read again if it changed or if its checksums
+        changed.
+        """
+
+        if not checksums:
+            return True
+
+        digest_cache = get_digest_cache()
+        object_path = get_download_store().get_object_path(manifest['archive_digest'])
+        stat = os.stat(object_path)
+        known_checksums = digest_cache.get_checksums(object_path)
+
+        if any(algorithm not in known_checksums for algorithm in checksums):
+            digest = StreamDigest(checksums)
+
+            with open(object_path, 'rb') as archive_file:
+                for buf in iter(lambda: archive_file.read(self.chunk_size), ''):
+                    digest.update(buf)
+
+            known_checksums.update(digest.get_checksums())
+            digest_cache.set_checksums(object_path, known_checksums, stat=stat)
+
+        return all(known_checksums[algorithm] == expected.lower() for algorithm, expected in checksums.iteritems())
+
+    def refresh(self, fetch_info, target_path, progress, cache_manifest):
+        """
+        Fetch a file again, only if it changed since it was last fetched.
+        """
+
+        store = get_download_store()
+        url = fetch_info['url']
+
+        with store.url_lock(url):
+            with host_slot(url):
+                manifest = self.download(fetch_info, target_path, progress, cache_manifest=cache_manifest)
+
+            if manifest is not cache_manifest:
+                store.add(url, fetch_info['mimetype'], manifest)
+
+        return manifest
+
+    def probe(self, fetch_info, cancelled=None):
+        """
+        Measure the time to the first byte of a file.
+
+        If the probe is `cancelled` by the time the server responds, the
+        response is closed without being read.
+        """
+
+        start = time.time()
+        response = get_session().get(
+            fetch_info['url'],
+            stream=True,
+            headers={'Range': 'bytes=0-1023'},
+            timeout=get_option('mirror_probe_timeout'),
+        )
+
+        try:
+            if cancelled is not None and cancelled.is_set():
+                return None
+
+            response.raise_for_status()
+            next(response.iter_content(1024), None)
+
+            return time.time() - start
+
+        finally:
+            response.close()
+
+    def get_partial_download(self, url, target_path):
+        """
+        Get the partial download of `url` that was left in `target_path` by an
+        interrupted fetch, if any.
+
+        Return a tuple (part_path, part_info). `part_info` is a dictionary of
+        the validators of the partial download, or None if no download can be
+        resumed.
+        """
+
+        part_path = os.path.join(target_path, 'download.part')
+
+        try:
+            with open(part_path + '.json') as f:
+                part_info = json.load(f)
+
+        except (IOError, ValueError):
+            return part_path, None
+
+        if not isinstance(part_info, dict) or part_info.get('url') != url:
+            return part_path, None
+
+        if not os.path.isfile(part_path) or not os.path.getsize(part_path):
+            return part_path, None
+
+        return part_path, part_info
+
+    def get_conditional_headers(self, cache_manifest):
+        """
+        Get the headers of a request that only downloads the file if it
+        changed since it was fetched with `cache_manifest`.
+        """
+
+        headers = {}
+
+        if cache_manifest.get('etag'):
+            headers['If-None-Match'] = cache_manifest['etag']
+
+        if cache_manifest.get('last_modified'):
+            headers['If-Modified-Since'] = cache_manifest['last_modified']
+
+        return headers
+
+    def get_range_headers(self, part_path, part_info):
+        """
+        Get the headers of a request that resumes a partial download.
+        """
+
+        etag = part_info.get('etag')
+
+        # Weak entity tags can't be used to resume a download.
+        if etag and etag.startswith('W/'):
+            etag = None
+
+        validator = etag or part_info.get('last_modified')
+
+        if not validator:
+            return {}
+
+        # The `.part` file holds decoded data: the remaining bytes must not be
+        # encoded either.
+        return {
+            'Range': 'bytes=%s-' % os.path.getsize(part_path),
+            'If-Range': validator,
+            'Accept-Encoding': 'identity',
+        }
+
+    def download(self, fetch_info, target_path, progress, cache_manifest=None):
+        """
+        Download a file, using the shared session.
+
+        The file is first downloaded to a `.part` file that is kept if the
+        download gets interrupted. The next fetch then resumes it with a
+        `Range` request, if the server supports it and the file did not change
+        in the meantime.
+
+        If `cache_manifest` is specified, the file is only downloaded if it
+        changed since it was fetched with that manifest, which is returned
+        otherwise.
         """
 
-        response = requests.get(fetch_info['url'], stream=True)
+        url = fetch_info['url']
+        part_path, part_info = self.get_partial_download(url, target_path)
+        headers = self.get_range_headers(part_path, part_info) if part_info else {}
+        resuming = bool(headers)
+
+        if not resuming and cache_manifest:
+            headers = self.get_conditional_headers(cache_manifest)
+
+        response = get_session().get(url, stream=True, headers=headers)
+
+        if response.status_code == 304 and not resuming and cache_manifest:
+            LOGGER.debug('%s was not modified.', hl(url))
+            response.close()
+
+            return cache_manifest
+
+        if response.status_code == 416 and resuming:
+            LOGGER.debug('Unable to resume the download of %s. Restarting it.', hl(url))
+            resuming = False
+            response.close()
+            response = get_session().get(url, stream=True)
+
         response.raise_for_status()
 
+        offset = 0
+
+        if resuming and response.status_code == 206:
+            content_range = response.headers.get('content-range', '')
+            match = re.match(r'bytes\s+(\d+)-', content_range)
+
+            if response.headers.get('content-encoding'):
+                LOGGER.debug('The server encoded the rest of %s. Restarting the download.', hl(url))
+                response.close()
+                response = get_session().get(url, stream=True)
+                response.raise_for_status()
+            elif match and int(match.group(1)) == os.path.getsize(part_path):
+                offset = int(match.group(1))
+                LOGGER.info('Resuming the download of %s at byte %s.', hl(url), hl(offset))
+            else:
+                LOGGER.debug('Unexpected content range %r. Restarting the download.', content_range)
+                response.close()
+                response = get_session().get(url, stream=True)
+                response.raise_for_status()
+        elif resuming:
+            LOGGER.debug('The server did not resume the download of %s. Restarting it.', hl(url))
+
         mimetype = fetch_info['mimetype'] or response.headers.get('content-type')
         encoding = response.headers.get('content-encoding')
         archive_type = (mimetype, encoding)
@@ -60,7 +388,7 @@ class HttpFetcher(FetcherImplementation):
         if not extension:
             LOGGER.debug('No extension registered for this mimetype (%s). Guessing one from the URL...', mimetype)
 
-            extension = os.path.splitext(urlparse.urlparse(fetch_info['url']).path)[1]
+            extension = os.path.splitext(urlparse.urlparse(url).path)[1]
 
         if extension and extension.startswith('.'):
             extension = extension[1:]
@@ -72,26 +400,307 @@ class HttpFetcher(FetcherImplementation):
         content_length = response.headers.get('content-length')
 
         if content_length is not None:
-            content_length = int(content_length)
+            content_length = offset + int(content_length)
 
         archive_path = os.path.join(target_path, filename)
+        segments = 1
+
+        if not offset and response.status_code == 200:
+            segments = self.get_segments_count(response, content_length)
 
         progress.on_start(target=os.path.basename(archive_path), size=content_length)
 
-        with open(archive_path, 'wb') as target_file:
-            current_size = 0
+        # The segments count against the connections to the host: only the
+        # free slots are used.
+        with extra_host_slots(url, segments - 1) as extra_slots:
+            if extra_slots:
+                LOGGER.debug('Downloading %s in %s segments...', hl(url), hl(extra_slots + 1))
 
-            for buf in response.iter_content(1024):
+                if os.path.exists(part_path + '.json'):
+                    os.remove(part_path + '.json')
 
-                if buf:
-                    target_file.write(buf)
-                    current_size += len(buf)
+                digest = self.download_segments(
+                    url=url,
+                    response=response,
+                    part_path=part_path,
+                    size=content_length,
+                    segments=extra_slots + 1,
+                    checksums=fetch_info.get('checksums'),
+                    progress=progress,
+                )
+            else:
+                digest = self.download_stream(
+                    url=url,
+                    response=response,
+                    part_path=part_path,
+                    offset=offset,
+                    size=content_length,
+                    checksums=fetch_info.get('checksums'),
+                    progress=progress,
+                )
+
+        try:
+            digest.verify(url)
+        except Exception:
+            os.remove(part_path)
+
+            raise
+
+        finally:
+            if os.path.exists(part_path + '.json'):
+                os.remove(part_path + '.json')
 
-                    progress.on_update(progress=current_size)
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+
+        os.rename(part_path, archive_path)
 
         progress.on_finish()
 
         return {
             'archive_path': archive_path,
             'archive_type': archive_type,
+            'archive_digest': digest.hexdigest(),
+            'etag': response.headers.get('etag'),
+            'last_modified': response.headers.get('last-modified'),
         }
+
+    def download_stream(self, url, response, part_path, offset, size, checksums, progress):
+        """
+        Download a file in a single stream, appending to the `.part` file from
+        `offset`.
+
+        The `size` of an encoded response is the one of its encoded content,
+        while the `.part` file holds the decoded content.
+
+        Return the digest of the `.part` file.
+        """
+
+        encoding = response.headers.get('content-encoding')
+
+        # Transparently decoded responses can't be resumed as the ranges apply
+        # to the encoded content.
+        if not offset:
+            with open(part_path + '.json', 'w') as f:
+                json.dump({
+                    'url': url,
+                    'etag': None if encoding else response.headers.get('etag'),
+                    'last_modified': None if encoding else response.headers.get('last-modified'),
+                }, f)
+
+        digest = StreamDigest(checksums)
+
+        if offset:
+            with open(part_path, 'rb') as part_file:
+                for buf in iter(lambda: part_file.read(self.chunk_size), ''):
+                    digest.update(buf)
+
+        with open(part_path, 'ab' if offset else 'wb') as target_file:
+            current_size = offset
+
+            for buf in response.iter_content(self.chunk_size):
+                if buf:
+                    target_file.write(buf)
+                    digest.update(buf)
+                    current_size += len(buf)
+
+                    progress.on_update(progress=response.raw.tell() if encoding else current_size)
+
+        if encoding:
+            current_size = response.raw.tell()
+
+        # The partial download is kept so that the next fetch can resume it.
+        if size is not None and current_size != size:
+            raise TeapotError(
+                "The download of %s was interrupted after %s byte(s) out of %s.",
+                hl(url),
+                hl(current_size),
+                hl(size),
+            )
+
+        return digest
+
+    def get_segments_count(self, response, size):
+        """
+        Get the number of segments to download a file in, given the `response`
+        to the initial request.
+
+        Files are downloaded in a single stream unless they are larger than
+        the `segmented_download_threshold` option and the server supports
+        range requests.
+        """
+
+        threshold = get_option('segmented_download_threshold')
+
+        if not threshold or size is None or size < threshold:
+            return 1
+
+        if response.headers.get('accept-ranges', '').lower() != 'bytes':
+            LOGGER.debug('The server does not support range requests. Downloading in a single stream.')
+
+            return 1
+
+        if response.headers.get('content-encoding'):
+            return 1
+
+        if not response.headers.get('etag') and not response.headers.get('last-modified'):
+            LOGGER.debug('The server sent no validator for the file. Downloading in a single stream.')
+
+            return 1
+
+        # The segments all use connections to the same host.
+        return max(1, min(
+            get_option('segmented_download_segments'),
+            get_option('max_connections_per_host'),
+            size // self.chunk_size,
+        ))
+
+    def download_segments(self, url, response, part_path, size, segments, checksums, progress):
+        """
+        Download a file of `size` bytes in several segments fetched on parallel
+        connections, into a preallocated `.part` file.
+
+        The initial `response` is used for the first segment.
+
+        The file is hashed in order as its segments arrive: the part of the
+        file that was received from its start is read back while the other
+        segments are still being downloaded, from the page cache.
+
+        Return the digest of the `.part` file.
+        """
+
+        etag = response.headers.get('etag')
+
+        if etag and etag.startswith('W/'):
+            etag = None
+
+        validator = etag or response.headers.get('last-modified')
+        segment_size = -(-size // segments)
+        ranges = [
+            (start, min(start + segment_size, size) - 1)
+            for start in xrange(0, size, segment_size)
+        ]
+        received = [0] * len(ranges)
+        errors = []
+        stop = threading.Event()
+
+        with open(part_path, 'wb') as part_file:
+            part_file.truncate(size)
+
+        def download_segment(index, start, end, segment_response):
+            try:
+                if segment_response is None:
+                    segment_response = get_session().get(
+                        url,
+                        stream=True,
+                        headers={
+                            'Range': 'bytes=%s-%s' % (start, end),
+                            'If-Range': validator,
+                            'Accept-Encoding': 'identity',
+                        },
+                    )
+                    segment_response.raise_for_status()
+
+                    content_range = segment_response.headers.get('content-range', '')
+                    match = re.match(r'bytes\s+(\d+)-', content_range)
+
+                    if segment_response.status_code != 206 or not match or int(match.group(1)) != start:
+                        raise TeapotError(
+                            "The server did not honor the range request for the segment %s of %s. The file may have changed during the download.",
+                            hl(index),
+                            hl(url),
+                        )
+
+                remaining = end - start + 1
+
+                try:
+                    # The received data must be visible to the hashing thread.
+                    with open(part_path, 'r+b', 0) as part_file:
+                        part_file.seek(start)
+
+                        for buf in segment_response.iter_content(self.chunk_size):
+                            if stop.is_set():
+                                return
+
+                            buf = buf[:remaining]
+                            part_file.write(buf)
+                            remaining -= len(buf)
+                            received[index] += len(buf)
+
+                            if not remaining:
+                                break
+
+                finally:
+                    segment_response.close()
+
+                if remaining:
+                    raise TeapotError(
+                        "The segment %s of %s was interrupted after %s byte(s) out of %s.",
+                        hl(index),
+                        hl(url),
+                        hl(end - start + 1 - remaining),
+                        hl(end - start + 1),
+                    )
+
+            except Exception:
+                errors.append(sys.exc_info())
+                stop.set()
+
+        digest = StreamDigest(checksums)
+        hashed = [0]
+
+        def hash_received(part_file):
+            received_size = 0
+
+            for (start, end), size_received in zip(ranges, received):
+                received_size = start + size_received
+
+                if received_size <= end:
+                    break
+
+            part_file.seek(hashed[0])
+
+            while hashed[0] < received_size:
+                buf = part_file.read(min(self.chunk_size, received_size - hashed[0]))
+
+                if not buf:
+                    break
+
+                digest.update(buf)
+                hashed[0] += len(buf)
+
+        threads = [
+            threading.Thread(
+                target=download_segment,
+                args=(index, start, end, response if index == 0 else None),
+            )
+            for index, (start, end) in enumerate(ranges)
+        ]
+
+        with open(part_path, 'rb') as part_file:
+            with on_cancel(stop.set):
+                for thread in threads:
+                    thread.daemon = True
+                    thread.start()
+
+                for thread in threads:
+                    while thread.is_alive():
+                        thread.join(0.1)
+                        progress.on_update(progress=sum(received))
+
+                        if not stop.is_set():
+                            hash_received(part_file)
+
+            if not errors and not stop.is_set():
+                hash_received(part_file)
+
+        # Segmented downloads can't be resumed: the `.part` file has holes.
+        if errors or stop.is_set():
+            os.remove(part_path)
+
+            if errors:
+                raise errors[0][0], errors[0][1], errors[0][2]
+
+            raise TeapotError("The download of %s was cancelled.", hl(url))
+
+        return digest
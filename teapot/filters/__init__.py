@@ -3,6 +3,7 @@ The filters.
 """
 
 from ..error import TeapotError
+from ..memoized import Memoized
 from ..log import Highlight as hl
 from .filter import Filter, f, uf
 
@@ -39,6 +40,7 @@ class FilteredObject(object):
         """
 
         self._filter = filter
+        Memoized.invalidate()
 
         return self
 
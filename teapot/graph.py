@@ -0,0 +1,177 @@
+"""
+A dependency graph class.
+"""
+
+from collections import deque
+
+
+class DependencyGraph(object):
+
+    """
+    An index of the dependencies between a set of nodes.
+
+    The graph is computed once, in O(V+E), and holds both the parents and the
+    children of every node.
+    """
+
+    def __init__(self, nodes, get_parents, generation=None):
+        """
+        Create a dependency graph.
+
+        `nodes` is the list of nodes, in declaration order.
+        `get_parents` is a callable that returns the parents of a node. Parents
+        that are not in `nodes` are ignored.
+        `generation` is an opaque value that identifies the state the graph
+        was computed from.
+        """
+
+        self.nodes = list(nodes)
+        self.generation = generation
+        self.parents = {node: set() for node in self.nodes}
+        self.children = {node: set() for node in self.nodes}
+
+        for node in self.nodes:
+            for parent in get_parents(node):
+                if parent in self.parents:
+                    self.parents[node].add(parent)
+                    self.children[parent].add(node)
+
+        self._topological_order = None
+        self._cycles = None
+
+    @property
+    def topological_order(self):
+        """
+        Get the nodes, parents first, using Kahn's algorithm.
+
+        Nodes that are ready at the same time keep their declaration order.
+
+        Nodes that are part of (or depend on) a cycle are left out: compare
+        the result length to the number of nodes or call `get_cycles()` to
+        detect them.
+        """
+
+        if self._topological_order is None:
+            position = {node: index for index, node in enumerate(self.nodes)}
+            in_degrees = {node: len(parents) for node, parents in self.parents.iteritems()}
+            queue = deque(node for node in self.nodes if not in_degrees[node])
+            result = []
+
+            while queue:
+                node = queue.popleft()
+                result.append(node)
+
+                for child in sorted(self.children[node], key=position.get):
+                    in_degrees[child] -= 1
+
+                    if not in_degrees[child]:
+                        queue.append(child)
+
+            self._topological_order = result
+
+        return self._topological_order
+
+    def get_strongly_connected_components(self):
+        """
+        Get the strongly connected components of the graph, using an
+        iterative version of Tarjan's algorithm.
+        """
+
+        index_of = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+
+        for root in self.nodes:
+            if root in index_of:
+                continue
+
+            index_of[root] = lowlink[root] = len(index_of)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.parents[root]))]
+
+            while work:
+                node, parents = work[-1]
+
+                for parent in parents:
+                    if parent not in index_of:
+                        index_of[parent] = lowlink[parent] = len(index_of)
+                        stack.append(parent)
+                        on_stack.add(parent)
+                        work.append((parent, iter(self.parents[parent])))
+                        break
+                    elif parent in on_stack:
+                        lowlink[node] = min(lowlink[node], index_of[parent])
+                else:
+                    work.pop()
+
+                    if work:
+                        caller = work[-1][0]
+                        lowlink[caller] = min(lowlink[caller], lowlink[node])
+
+                    if lowlink[node] == index_of[node]:
+                        component = []
+
+                        while True:
+                            member = stack.pop()
+                            on_stack.remove(member)
+                            component.append(member)
+
+                            if member == node:
+                                break
+
+                        components.append(component)
+
+        return components
+
+    def get_cycles(self):
+        """
+        Get one dependency cycle for every strongly connected component that
+        has one.
+
+        Each cycle is a list of nodes that starts and ends with the same node,
+        where each node depends on the next one.
+        """
+
+        if self._cycles is None:
+            position = {node: index for index, node in enumerate(self.nodes)}
+            cycles = []
+
+            for component in self.get_strongly_connected_components():
+                members = set(component)
+                start = min(component, key=position.get)
+
+                if len(component) == 1 and start not in self.parents[start]:
+                    continue
+
+                cycle = []
+                node = start
+
+                while node not in cycle:
+                    cycle.append(node)
+                    node = min(self.parents[node] & members, key=position.get)
+
+                cycles.append(cycle[cycle.index(node):] + [node])
+
+            self._cycles = sorted(cycles, key=lambda cycle: position[cycle[0]])
+
+        return self._cycles
+
+    def get_ancestors(self, nodes):
+        """
+        Get the specified `nodes` and all the nodes they depend on, directly
+        or not.
+        """
+
+        result = set(nodes)
+        queue = deque(result)
+
+        while queue:
+            for parent in self.parents[queue.popleft()]:
+                if parent not in result:
+                    result.add(parent)
+                    queue.append(parent)
+
+        return result
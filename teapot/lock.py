@@ -0,0 +1,145 @@
+"""
+File locks, to coordinate teapot processes that share the same directories.
+"""
+
+import os
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from .error import TeapotError
+from .log import LOGGER, Highlight as hl
+from .path import mkdir
+from .scheduler import on_cancel
+
+
+class FileLock(object):
+
+    """
+    A lock backed by a file, that excludes both the other threads and the
+    other processes that use the same path.
+
+    The lock is reentrant: a thread that holds it can acquire it again.
+
+    Use `get_file_lock()` to get instances, so that all the threads of a
+    process share the same one.
+    """
+
+    # The interval, in seconds, at which a busy lock is polled.
+    poll_interval = 0.1
+
+    def __init__(self, path):
+        """
+        Create a lock backed by the file at `path`.
+        """
+
+        self.path = path
+        self._lock = threading.RLock()
+        self._count = 0
+        self._file = None
+
+    def _lock_file(self):
+        try:
+            if fcntl:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+
+        except (IOError, OSError):
+            return False
+
+        return True
+
+    def _unlock_file(self):
+        if fcntl:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _try_acquire(self):
+        if not self._lock.acquire(False):
+            return False
+
+        if not self._count:
+            mkdir(os.path.dirname(self.path))
+            self._file = open(self.path, 'a')
+
+            if not self._lock_file():
+                self._file.close()
+                self._file = None
+                self._lock.release()
+
+                return False
+
+        self._count += 1
+
+        return True
+
+    def acquire(self):
+        """
+        Acquire the lock, waiting as long as necessary.
+
+        Raise a `TeapotError` if the running tasks get cancelled meanwhile.
+        """
+
+        if self._try_acquire():
+            return
+
+        LOGGER.info("Waiting for %s to be released...", hl(self.path))
+
+        cancelled = threading.Event()
+
+        with on_cancel(cancelled.set):
+            while not self._try_acquire():
+                if cancelled.is_set():
+                    raise TeapotError("Cancelled while waiting for %s.", hl(self.path))
+
+                time.sleep(self.poll_interval)
+
+        LOGGER.debug("Acquired %s.", hl(self.path))
+
+    def release(self):
+        """
+        Release the lock.
+        """
+
+        self._count -= 1
+
+        if not self._count:
+            self._unlock_file()
+            self._file.close()
+            self._file = None
+
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+_FILE_LOCKS = {}
+_FILE_LOCKS_LOCK = threading.Lock()
+
+
+def get_file_lock(path):
+    """
+    Get the lock backed by the file at `path`.
+    """
+
+    path = os.path.abspath(path)
+
+    with _FILE_LOCKS_LOCK:
+        if path not in _FILE_LOCKS:
+            _FILE_LOCKS[path] = FileLock(path)
+
+        return _FILE_LOCKS[path]
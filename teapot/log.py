@@ -3,6 +3,7 @@ The teapot logging facilities.
 """
 
 import logging
+import threading
 import colorama
 
 try:
@@ -21,6 +22,10 @@ except ImportError:
 LOGGER = logging.getLogger('teapot')
 LOGGER.addHandler(NullHandler())
 
+# Progress bars redraw the current terminal line: when several operations run
+# concurrently, only one of them may display its progress at any given time.
+PROGRESS_BAR_LOCK = threading.Lock()
+
 # Add new log levels
 
 
@@ -75,8 +75,12 @@ def main():
     fetch_command_parser.set_defaults(func=fetch)
     fetch_command_parser.add_argument(
         'attendees', metavar='attendee', nargs='*', default=[], help='The attendees to fetch.')
+    fetch_command_parser.add_argument(
+        '-j', '--jobs', type=int, default=1, help='The number of attendees that can be fetched concurrently.')
     fetch_command_parser.add_argument(
         '-f', '--force', action='store_true', help='Fetch archives even if they already exist in the cache.')
+    fetch_command_parser.add_argument(
+        '-r', '--refresh', action='store_true', help='Fetch archives that already exist in the cache again, only if they changed.')
 
     # The unpack command
     unpack_command_parser = command_parser.add_parser(
@@ -84,6 +88,10 @@ def main():
     unpack_command_parser.set_defaults(func=unpack)
     unpack_command_parser.add_argument(
         'attendees', metavar='attendee', nargs='*', default=[], help='The attendees to unpack.')
+    unpack_command_parser.add_argument(
+        '-j', '--jobs', type=int, default=1, help='The number of attendees that can be unpacked concurrently.')
+    unpack_command_parser.add_argument(
+        '--fetch-jobs', type=int, default=None, help='The number of attendees that can be fetched concurrently. Defaults to the number of jobs.')
     unpack_command_parser.add_argument(
         '-f', '--force', action='store_true', help='Unpack archives even if they already exist in the build.')
 
@@ -93,6 +101,12 @@ def main():
     build_command_parser.set_defaults(func=build)
     build_command_parser.add_argument(
         'attendees', metavar='attendee', nargs='*', default=[], help='The attendees to build.')
+    build_command_parser.add_argument(
+        '-j', '--jobs', type=int, default=1, help='The number of attendees that can be built concurrently.')
+    build_command_parser.add_argument(
+        '--fetch-jobs', type=int, default=None, help='The number of attendees that can be fetched concurrently. Defaults to the number of jobs.')
+    build_command_parser.add_argument(
+        '--unpack-jobs', type=int, default=None, help='The number of attendees that can be unpacked concurrently. Defaults to the number of jobs.')
     build_command_parser.add_argument(
         '-f', '--force', action='store_true', help='Build archives even if they were already built.')
     build_command_parser.add_argument(
@@ -231,6 +245,8 @@ def fetch(args):
     teapot.party.fetch(
         attendees=args.attendees,
         force=args.force,
+        jobs=args.jobs,
+        refresh=args.refresh,
     )
 
 
@@ -243,6 +259,8 @@ def unpack(args):
     teapot.party.unpack(
         attendees=args.attendees,
         force=args.force,
+        jobs=args.jobs,
+        fetch_jobs=args.fetch_jobs,
     )
 
 
@@ -257,4 +275,7 @@ def build(args):
         force=args.force,
         verbose=args.verbose,
         keep_builds=args.keep_builds,
+        jobs=args.jobs,
+        fetch_jobs=args.fetch_jobs,
+        unpack_jobs=args.unpack_jobs,
     )
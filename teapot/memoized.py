@@ -3,6 +3,7 @@ A Memoized metaclass.
 """
 
 import functools
+from collections import OrderedDict
 from contextlib import contextmanager
 
 from .error import TeapotError
@@ -17,6 +18,19 @@ class Memoized(type):
 
     _ALL_INSTANCES = {}
 
+    # Incremented whenever the registries change, so that values computed
+    # from them can be cached.
+    generation = 0
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Signal that the registries, or the relations between their
+        instances, changed.
+        """
+
+        Memoized.generation += 1
+
     @classmethod
     def clear_all_instances(cls):
         for mcls in cls._ALL_INSTANCES.values():
@@ -24,11 +38,12 @@ class Memoized(type):
             del mcls
 
         cls._ALL_INSTANCES = {}
+        cls.invalidate()
 
     def __new__(cls, name, bases, attrs):
 
         attrs.setdefault('public_name', name)
-        attrs['_INSTANCES'] = {}
+        attrs['_INSTANCES'] = OrderedDict()
         attrs['_INSTANCES_PARAMS'] = {}
 
         cls._ALL_INSTANCES[name] = super(Memoized, cls).__new__(cls, name, bases, attrs)
@@ -48,6 +63,7 @@ class Memoized(type):
 
             cls._INSTANCES[keys] = instance
             cls._INSTANCES_PARAMS[keys] = (args, kwargs)
+            Memoized.invalidate()
 
         elif cls.raise_on_duplicate_enabled:
             raise cls.DuplicateInstance(cls, keys)
@@ -80,8 +96,9 @@ class MemoizedObject(object):
 
     @classmethod
     def clear_instances(cls):
-        cls._INSTANCES = {}
+        cls._INSTANCES = OrderedDict()
         cls._INSTANCES_PARAMS = {}
+        Memoized.invalidate()
 
     @classmethod
     def transform_memoization_keys(cls, *args):
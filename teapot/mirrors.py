@@ -0,0 +1,197 @@
+"""
+Mirrors selection.
+"""
+
+import os
+import time
+import Queue
+import urlparse
+import threading
+
+from .log import LOGGER, Highlight as hl
+from .options import get_option
+from .path import mkdir, from_user_path, read_json, write_json
+
+
+class LatencyCache(object):
+
+    """
+    Remembers how fast hosts responded, across runs.
+    """
+
+    # The weight of a new measure in the remembered latency of a host.
+    smoothing = 0.5
+
+    def __init__(self, path):
+        """
+        Create a latency cache, persisted at `path`.
+        """
+
+        self.path = path
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = read_json(self.path)
+
+        return self._entries
+
+    def get_latency(self, host):
+        """
+        Get the remembered latency of `host`, in seconds, or None if it is
+        unknown.
+        """
+
+        with self._lock:
+            return self.entries.get(host)
+
+    def add_latency(self, host, latency):
+        """
+        Remember that `host` responded in `latency` seconds.
+        """
+
+        with self._lock:
+            previous = self.entries.get(host)
+
+            if previous is None:
+                self.entries[host] = latency
+            else:
+                self.entries[host] = previous + (latency - previous) * self.smoothing
+
+            self._dirty = True
+
+    def save(self):
+        """
+        Persist the cache, if it changed.
+        """
+
+        with self._lock:
+            if not self._dirty:
+                return
+
+            mkdir(os.path.dirname(self.path))
+            write_json(self.path, self._entries)
+            self._dirty = False
+
+
+_LATENCY_CACHES = {}
+_LATENCY_CACHES_LOCK = threading.Lock()
+
+
+def get_latency_cache():
+    """
+    Get the latency cache that lives in the cache root.
+    """
+
+    path = os.path.join(from_user_path(get_option('cache_root')), 'latencies.json')
+
+    with _LATENCY_CACHES_LOCK:
+        if path not in _LATENCY_CACHES:
+            _LATENCY_CACHES[path] = LatencyCache(path)
+
+        return _LATENCY_CACHES[path]
+
+
+def get_host(source):
+    """
+    Get the host a source is fetched from.
+    """
+
+    return urlparse.urlparse(source.resource).netloc or source.resource
+
+
+def race_sources(sources):
+    """
+    Probe all the `sources` concurrently and get the one that responded
+    first.
+
+    The probes that are still running when the first one succeeds are
+    cancelled: they close their connection as soon as they get a response,
+    and their results are ignored.
+
+    If no probe succeeds, the source whose host has the lowest remembered
+    latency is returned. If none is known, None is returned.
+    """
+
+    latency_cache = get_latency_cache()
+    timeout = get_option('mirror_probe_timeout')
+    results = Queue.Queue()
+    cancelled = threading.Event()
+    winner = None
+
+    def probe(source):
+        host = get_host(source)
+
+        try:
+            latency = source.probe(cancelled=cancelled)
+
+        except Exception as ex:
+            LOGGER.debug("Unable to probe %s: %s", hl(source), hl(str(ex)))
+
+            if cancelled.is_set():
+                return
+
+            # Unreachable hosts are remembered as slow.
+            latency_cache.add_latency(host, timeout)
+            latency = None
+
+        else:
+            if latency is not None:
+                latency_cache.add_latency(host, latency)
+
+        results.put((source, latency))
+
+    # Probe the hosts known to be the fastest first.
+    sources = sorted(
+        sources,
+        key=lambda source: latency_cache.get_latency(get_host(source)),
+    )
+
+    for source in sources:
+        thread = threading.Thread(target=probe, args=(source,))
+        thread.daemon = True
+        thread.start()
+
+    deadline = time.time() + timeout
+
+    for _ in sources:
+        try:
+            source, latency = results.get(timeout=max(0, deadline - time.time()))
+        except Queue.Empty:
+            break
+
+        if latency is not None:
+            LOGGER.debug(
+                "%s responded first, in %s ms.",
+                hl(source),
+                hl(int(latency * 1000)),
+            )
+
+            winner = source
+            break
+
+    cancelled.set()
+
+    if winner is None:
+        known_sources = [
+            x for x in sources
+            if latency_cache.get_latency(get_host(x)) is not None
+        ]
+
+        if known_sources:
+            winner = min(
+                known_sources,
+                key=lambda source: latency_cache.get_latency(get_host(source)),
+            )
+
+            LOGGER.debug(
+                "No source could be probed. Using %s, which was the fastest so far.",
+                hl(winner),
+            )
+
+    latency_cache.save()
+
+    return winner
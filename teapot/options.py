@@ -177,3 +177,33 @@ register_option('prefix', default_values=[
     Option.Value('~/.teapot/install', filter=~f('windows')),
     Option.Value('%APPDATA%\\teapot\\install', filter=f('windows')),
 ])
+register_option('max_connections_per_host', value_type=int, default_values=[
+    Option.Value(4),
+])
+register_option('segmented_download_threshold', value_type=int, default_values=[
+    Option.Value(32 * 1024 ** 2),
+])
+register_option('segmented_download_segments', value_type=int, default_values=[
+    Option.Value(4),
+])
+register_option('mirror_racing', value_type=bool, default_values=[
+    Option.Value(False),
+])
+register_option('mirror_probe_timeout', value_type=float, default_values=[
+    Option.Value(5.0),
+])
+register_option('github_api_url', default_values=[
+    Option.Value('https://api.github.com'),
+])
+register_option('external_decompressors', value_type=bool, default_values=[
+    Option.Value(True),
+])
+register_option('extraction_cache', value_type=bool, default_values=[
+    Option.Value(True),
+])
+register_option('transcode_archives', value_type=bool, default_values=[
+    Option.Value(False),
+])
+register_option('selective_extraction', value_type=bool, default_values=[
+    Option.Value(True),
+])
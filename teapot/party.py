@@ -7,11 +7,16 @@ import sys
 import imp
 
 from contextlib import contextmanager
+from functools import partial
 
 from .log import LOGGER
 from .log import Highlight as hl
 from .attendee import Attendee
 from .globals import set_party_path
+from .scheduler import Scheduler
+from .store import get_download_store
+from .digest import get_digest_cache
+from .extractions import get_extraction_cache
 
 
 @contextmanager
@@ -73,6 +78,11 @@ def clean_cache(attendees=None):
     for attendee in attendees:
         attendee.clean_cache()
 
+    pruned = get_download_store().prune()
+
+    if pruned:
+        LOGGER.info("Removed %s unused archive(s) from the download store.", hl(pruned))
+
     LOGGER.info("Done cleaning cache for %s attendee(s)...", hl(len(attendees)))
 
 
@@ -88,6 +98,11 @@ def clean_sources(attendees=None):
     for attendee in attendees:
         attendee.clean_sources()
 
+    pruned = get_extraction_cache().prune()
+
+    if pruned:
+        LOGGER.info("Removed %s unused tree(s) from the extraction cache.", hl(pruned))
+
     LOGGER.info("Done cleaning sources for %s attendee(s)...", hl(len(attendees)))
 
 
@@ -106,15 +121,21 @@ def clean_builds(attendees=None):
     LOGGER.info("Done cleaning builds for %s attendee(s)...", hl(len(attendees)))
 
 
-def fetch(attendees=None, force=False):
+def fetch(attendees=None, force=False, jobs=1, refresh=False):
     """
     Fetch the specified attendees.
+
+    `jobs` is the number of attendees that can be fetched concurrently.
+    `refresh` tells whether the already fetched attendees must be fetched
+    again if their source changed.
     """
 
     attendees = Attendee.get_dependent_instances(attendees or None)
 
     if force:
         LOGGER.info("Force fetch requested...")
+    elif refresh:
+        LOGGER.info("Refresh requested...")
     else:
         attendees = [x for x in attendees if x.must_fetch]
 
@@ -124,59 +145,160 @@ def fetch(attendees=None, force=False):
 
     LOGGER.info("Will now fetch %s." % ", ".join(["%s"] * len(attendees)), *map(hl, attendees))
 
+    scheduler = Scheduler(jobs=jobs)
+
     for attendee in attendees:
-        attendee.fetch(force=force)
+        scheduler.add_task(attendee, partial(fetch_stage, attendee, force=force, refresh=refresh))
+
+    scheduler.run()
 
     LOGGER.info("Done fetching %s attendee(s)...", hl(len(attendees)))
 
 
-def unpack(attendees=None, force=False):
+def fetch_stage(attendee, force=False, refresh=False):
     """
-    Unpack the specified attendees.
+    The fetch stage of the pipeline.
+
+    Each stage locks the attendee, so that a concurrent teapot process that
+    shares the same directories waits for it and then reuses its results.
+    """
+
+    with attendee.locked('fetch'):
+        if force or refresh or attendee.must_fetch:
+            attendee.fetch(force=force, refresh=refresh)
+
+        # Local archives may have been hashed while they were fetched.
+        get_digest_cache().save()
+
+
+def unpack_stage(attendee, force=False):
+    """
+    The unpack stage of the pipeline.
+    """
+
+    with attendee.locked('unpack'):
+        if force or attendee.must_unpack:
+            attendee.unpack(force=force)
+
+        # The archive may have been hashed to check its signature.
+        get_digest_cache().save()
+
+
+def build_stage(attendee, force=False, verbose=False, keep_builds=False):
+    """
+    The build stage of the pipeline.
+    """
+
+    with attendee.locked('build'):
+        if force or attendee.must_build:
+            attendee.build(force=force, verbose=verbose, keep_builds=keep_builds)
+        else:
+            LOGGER.info("%s was built already. Nothing to do.", hl(attendee))
+
+
+def make_pipeline(fetch_jobs=1, unpack_jobs=1, build_jobs=1):
+    """
+    Create a scheduler with one pool per stage.
+
+    `fetch_jobs`, `unpack_jobs` and `build_jobs` are the number of
+    attendees that can respectively be fetched, unpacked and built
+    concurrently.
+    """
+
+    scheduler = Scheduler()
+    scheduler.add_pool('fetch', fetch_jobs)
+    scheduler.add_pool('unpack', unpack_jobs)
+    scheduler.add_pool('build', build_jobs)
+
+    return scheduler
+
+
+def unpack(attendees=None, force=False, jobs=1, fetch_jobs=None):
     """
+    Unpack the specified attendees.
 
-    fetch(attendees, force=False)
+    Each attendee gets unpacked as soon as its own archive is fetched.
+
+    `jobs` is the number of attendees that can be unpacked concurrently.
+    `fetch_jobs` is the number of attendees that can be fetched
+    concurrently. It defaults to `jobs`.
+    """
 
     attendees = Attendee.get_dependent_instances(attendees or None)
 
     if force:
         LOGGER.info("Force unpack requested...")
-    else:
-        attendees = [x for x in attendees if x.must_unpack]
-
-        if not attendees:
-            LOGGER.info("All attendees were unpacked already. Nothing to do.")
-            return
 
     LOGGER.info("Will now unpack %s." % ", ".join(["%s"] * len(attendees)), *map(hl, attendees))
 
+    scheduler = make_pipeline(
+        fetch_jobs=fetch_jobs or jobs,
+        unpack_jobs=jobs,
+    )
+
     for attendee in attendees:
-        attendee.unpack(force=force)
+        scheduler.add_task(
+            ('fetch', attendee),
+            partial(fetch_stage, attendee),
+            pool='fetch',
+        )
+        scheduler.add_task(
+            ('unpack', attendee),
+            partial(unpack_stage, attendee, force=force),
+            depends_on=[('fetch', attendee)],
+            pool='unpack',
+        )
+
+    scheduler.run()
 
     LOGGER.info("Done unpacking %s attendee(s)...", hl(len(attendees)))
 
 
-def build(attendees=None, force=False, verbose=False, keep_builds=False):
+def build(attendees=None, force=False, verbose=False, keep_builds=False, jobs=1, fetch_jobs=None, unpack_jobs=None):
     """
     Build the specified attendees.
-    """
 
-    unpack(attendees, force=False)
+    Each attendee goes through the fetch, unpack and build stages on its own:
+    it gets unpacked as soon as its archive is fetched, and built as soon as
+    it is unpacked and all its parents are built.
+
+    `jobs` is the number of attendees that can be built concurrently.
+    `fetch_jobs` and `unpack_jobs` are the number of attendees that can be
+    respectively fetched and unpacked concurrently. They default to `jobs`.
+    """
 
     attendees = Attendee.get_dependent_instances(attendees or None)
 
     if force:
         LOGGER.info("Force build requested...")
-    else:
-        attendees = [x for x in attendees if x.must_build]
-
-        if not attendees:
-            LOGGER.info("All attendees were built already. Nothing to do.")
-            return
 
     LOGGER.info("Will now build %s." % ", ".join(["%s"] * len(attendees)), *map(hl, attendees))
 
+    scheduler = make_pipeline(
+        fetch_jobs=fetch_jobs or jobs,
+        unpack_jobs=unpack_jobs or jobs,
+        build_jobs=jobs,
+    )
+
     for attendee in attendees:
-        attendee.build(force=force, verbose=verbose, keep_builds=keep_builds)
+        scheduler.add_task(
+            ('fetch', attendee),
+            partial(fetch_stage, attendee),
+            pool='fetch',
+        )
+        scheduler.add_task(
+            ('unpack', attendee),
+            partial(unpack_stage, attendee),
+            depends_on=[('fetch', attendee)],
+            pool='unpack',
+        )
+        scheduler.add_task(
+            ('build', attendee),
+            partial(build_stage, attendee, force=force, verbose=verbose, keep_builds=keep_builds),
+            depends_on=[('unpack', attendee)] + [('build', parent) for parent in attendee.parents],
+            pool='build',
+        )
+
+    scheduler.run()
 
     LOGGER.info("Done building %s attendee(s)...", hl(len(attendees)))
@@ -4,8 +4,12 @@ A teapot path-handling class.
 
 import os
 import stat
+import json
 import shutil
+import mmap
 import errno
+import ctypes
+import threading
 
 from contextlib import contextmanager
 from functools import wraps
@@ -104,6 +108,141 @@ def mkdir(path):
             raise
 
 
+def read_json(path):
+    """
+    Read a JSON object from the specified path.
+
+    Return an empty dictionary if the file does not exist or does not hold a
+    JSON object.
+    """
+
+    try:
+        with open(path) as f:
+            value = json.load(f)
+
+    except (IOError, ValueError):
+        return {}
+
+    if not isinstance(value, dict):
+        return {}
+
+    return value
+
+
+def write_json(path, value):
+    """
+    Write `value` as JSON to the specified path.
+
+    The file is replaced atomically, so that concurrent readers never see a
+    partially written file.
+    """
+
+    tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+
+    # `json.dumps()` is much faster than `json.dump()` on large values.
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(value))
+
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+
+    os.rename(tmp_path, path)
+
+
+def _get_copy_file_range():
+    """
+    Get the `copy_file_range()` function of the C library, or None if it is
+    not available.
+    """
+
+    try:
+        func = ctypes.CDLL(None, use_errno=True).copy_file_range
+
+    except (AttributeError, OSError, TypeError):
+        return None
+
+    func.argtypes = [
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_longlong),
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_longlong),
+        ctypes.c_size_t,
+        ctypes.c_uint,
+    ]
+    func.restype = ctypes.c_ssize_t
+
+    return func
+
+
+_COPY_FILE_RANGE = _get_copy_file_range()
+
+# The errors `copy_file_range()` fails with when it can't copy between two
+# files at all.
+_COPY_FILE_RANGE_UNSUPPORTED = frozenset(
+    getattr(errno, name) for name in ('ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'EBADF')
+    if hasattr(errno, name)
+)
+
+
+def copy_range(source_file, offset, size, target_file, chunk_size=1024 ** 2 * 16):
+    """
+    Copy `size` bytes at `offset` in `source_file` to the current position
+    of `target_file`.
+
+    The data is never read into Python: it is copied by the kernel with
+    `copy_file_range()` when it is available, and written from a memory
+    mapping of `source_file` otherwise.
+
+    `target_file` must not have pending buffered writes.
+    """
+
+    if not size:
+        return
+
+    if _COPY_FILE_RANGE:
+        source_offset = ctypes.c_longlong(offset)
+        remaining = size
+
+        while remaining:
+            result = _COPY_FILE_RANGE(
+                source_file.fileno(),
+                ctypes.byref(source_offset),
+                target_file.fileno(),
+                None,
+                min(remaining, chunk_size),
+                0,
+            )
+
+            if result < 0:
+                error = ctypes.get_errno()
+
+                # Nothing was copied yet: fall back to the memory mapping.
+                if remaining == size and error in _COPY_FILE_RANGE_UNSUPPORTED:
+                    break
+
+                raise OSError(error, os.strerror(error))
+
+            if result == 0:
+                raise IOError(errno.EIO, 'Unexpected end of file')
+
+            remaining -= result
+
+        else:
+            return
+
+    view = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        if offset + size > len(view):
+            raise IOError(errno.EIO, 'Unexpected end of file')
+
+        for start in xrange(offset, offset + size, chunk_size):
+            target_file.write(buffer(view, start, min(chunk_size, offset + size - start)))
+
+    finally:
+        view.close()
+
+
 def rmdir(path):
     """
     Delete the specified path if it exists.
@@ -156,7 +295,7 @@ def copytree(src, dst, symlinks=False, ignore=None, copy_function=shutil.copy2):
             else:
                 try:
                     copy_function(srcname, dstname)
-                except (IOError, WindowsError):
+                except (IOError, OSError):
                     shutil.copy2(srcname, dstname)
 
             # XXX What about devices, sockets etc.?
@@ -164,17 +303,16 @@ def copytree(src, dst, symlinks=False, ignore=None, copy_function=shutil.copy2):
             errors.append((srcname, dstname, str(why)))
         # catch the Error from the recursive copytree so that we can
         # continue with other files
-        except Error as err:
+        except shutil.Error as err:
             errors.extend(err.args[0])
     try:
         shutil.copystat(src, dst)
-    except WindowsError:
-        # can't copy file access times on Windows
-        pass
     except OSError as why:
-        errors.extend((src, dst, str(why)))
+        # can't copy file access times on Windows
+        if os.name != 'nt':
+            errors.append((src, dst, str(why)))
     if errors:
-        raise Error(errors)
+        raise shutil.Error(errors)
 
 
 @contextmanager
@@ -0,0 +1,274 @@
+"""
+A task scheduler that runs tasks concurrently while honoring their
+dependencies.
+"""
+
+import sys
+import threading
+
+from contextlib import contextmanager
+
+from .error import TeapotError
+from .log import LOGGER, Highlight as hl
+
+
+_CANCEL_CALLBACKS = []
+_CANCEL_LOCK = threading.Lock()
+
+
+@contextmanager
+def on_cancel(callback):
+    """
+    Register a `callback` to call if the running tasks get cancelled.
+
+    The callback is unregistered when the context exits. This is mainly used
+    to terminate subprocesses that run in worker threads, where signal
+    handlers cannot be installed.
+    """
+
+    if callback is None:
+        yield
+        return
+
+    with _CANCEL_LOCK:
+        _CANCEL_CALLBACKS.append(callback)
+
+    try:
+        yield
+    finally:
+        with _CANCEL_LOCK:
+            _CANCEL_CALLBACKS.remove(callback)
+
+
+def cancel_all():
+    """
+    Call all the registered cancellation callbacks.
+    """
+
+    with _CANCEL_LOCK:
+        callbacks = list(_CANCEL_CALLBACKS)
+
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as ex:
+            LOGGER.debug('Cancellation callback failed: %s', hl(ex))
+
+
+class Scheduler(object):
+
+    """
+    Runs tasks as soon as all the tasks they depend on are done.
+
+    Each task belongs to a pool that bounds how many of its tasks can run at
+    the same time. Tasks that don't specify a pool go to the default pool,
+    which has `jobs` slots.
+    """
+
+    # The maximum time, in seconds, the scheduler blocks at once while
+    # waiting for tasks: Python 2 can't interrupt an untimed wait on SIGINT.
+    poll_interval = 0.1
+
+    class Task(object):
+
+        """
+        A scheduled task.
+        """
+
+        def __init__(self, key, func, depends_on, pool):
+            self.key = key
+            self.func = func
+            self.depends_on = set(depends_on)
+            self.pool = pool
+            self.thread = None
+            self.exc_info = None
+
+        def __repr__(self):
+            return 'Task(%r)' % (self.key,)
+
+    def __init__(self, jobs=1):
+        """
+        Create a scheduler.
+
+        `jobs` is the maximum number of tasks that can run at the same time.
+        """
+
+        self._pools = {}
+        self.add_pool(None, jobs)
+        self._tasks = {}
+        self._order = []
+        self._condition = threading.Condition()
+        self._finished = []
+
+    @property
+    def jobs(self):
+        return self._pools[None]
+
+    def add_pool(self, name, jobs):
+        """
+        Add a pool.
+
+        `name` is the name of the pool.
+        `jobs` is the maximum number of tasks of the pool that can run at the
+        same time.
+        """
+
+        if jobs < 1:
+            raise TeapotError(
+                "The number of jobs must be at least 1 (got %s).",
+                hl(jobs),
+            )
+
+        self._pools[name] = jobs
+
+        return self
+
+    def add_task(self, key, func, depends_on=None, pool=None):
+        """
+        Add a task.
+
+        `key` identifies the task and must be unique within the scheduler.
+        `func` is a callable that takes no arguments.
+        `depends_on` is a list of keys of tasks that must complete before this
+        one starts. Keys that don't match any task are ignored, which allows
+        depending on things that need no work.
+        `pool` is the name of the pool to run the task in.
+        """
+
+        if key in self._tasks:
+            raise TeapotError("A task %s was already scheduled.", hl(key))
+
+        if pool not in self._pools:
+            raise TeapotError("No pool named %s was added.", hl(pool))
+
+        self._tasks[key] = Scheduler.Task(key, func, depends_on or [], pool)
+        self._order.append(key)
+
+        return self
+
+    def _execute(self, task):
+        try:
+            task.func()
+        except BaseException:
+            task.exc_info = sys.exc_info()
+
+        with self._condition:
+            self._finished.append(task)
+            self._condition.notify()
+
+    def _start(self, task):
+        LOGGER.debug('Starting task %s.', hl(task.key))
+
+        task.thread = threading.Thread(target=self._execute, args=(task,))
+        task.thread.daemon = True
+        task.thread.start()
+
+    def _wait(self, running):
+        """
+        Wait for at least one running task to finish and return the finished
+        tasks.
+        """
+
+        with self._condition:
+            while not self._finished:
+                self._condition.wait(self.poll_interval)
+
+            finished, self._finished = self._finished, []
+
+        for task in finished:
+            task.thread.join()
+            running.remove(task)
+
+        return finished
+
+    def _abort(self, running):
+        """
+        Cancel and wait for all the running tasks.
+        """
+
+        if running:
+            LOGGER.warning(
+                "Cancelling %s running task(s)...",
+                hl(len(running)),
+            )
+
+        while running:
+            cancel_all()
+
+            try:
+                self._wait(running)
+            except KeyboardInterrupt:
+                pass
+
+    def run(self):
+        """
+        Run all the tasks.
+
+        If a task fails, no new task is started, the running ones are
+        cancelled and the first error is raised once they all stopped.
+        """
+
+        remaining = {
+            key: {dep for dep in task.depends_on if dep in self._tasks}
+            for key, task in self._tasks.iteritems()
+        }
+        dependents = {key: [] for key in self._tasks}
+
+        for key, deps in remaining.iteritems():
+            for dep in deps:
+                dependents[dep].append(key)
+
+        position = {key: index for index, key in enumerate(self._order)}
+        ready = [key for key in self._order if not remaining[key]]
+        running = set()
+        usage = dict.fromkeys(self._pools, 0)
+        done = 0
+        exc_info = None
+
+        try:
+            while done < len(self._tasks):
+                for key in list(ready):
+                    task = self._tasks[key]
+
+                    if usage[task.pool] < self._pools[task.pool]:
+                        ready.remove(key)
+                        usage[task.pool] += 1
+                        running.add(task)
+                        self._start(task)
+
+                if not running:
+                    raise TeapotError(
+                        "Unable to schedule %s: dependency cycle detected.",
+                        hl(', '.join(str(key) for key in self._order if remaining[key])),
+                    )
+
+                for task in self._wait(running):
+                    done += 1
+                    usage[task.pool] -= 1
+
+                    if task.exc_info:
+                        exc_info = task.exc_info
+                        break
+
+                    for key in dependents[task.key]:
+                        remaining[key].discard(task.key)
+
+                        if not remaining[key]:
+                            ready.append(key)
+
+                    # Keep the declaration order among ready tasks.
+                    ready.sort(key=position.get)
+
+                if exc_info:
+                    break
+
+        except KeyboardInterrupt:
+            LOGGER.warning('Interrupted by the user.')
+            self._abort(running)
+
+            raise
+
+        if exc_info:
+            self._abort(running)
+
+            raise exc_info[0], exc_info[1], exc_info[2]
@@ -31,10 +31,27 @@ class Source(MemoizedObject, FilteredObject):
 
         return attendee, resource
 
+    checksum_algorithms = ('md5', 'sha1', 'sha256', 'sha512')
+
     def __init__(self, attendee, resource, mimetype=None, fetcher=None, *args, **kwargs):
         """
         Create a source that maps on the specified resource.
+
+        An expected checksum of the fetched archive can be specified for each
+        of the `checksum_algorithms`, as a named argument (for instance
+        `sha256='...'`). The fetch fails if the archive doesn't match.
         """
+
+        checksums = {
+            algorithm: kwargs.pop(algorithm, None)
+            for algorithm in self.checksum_algorithms
+        }
+        self.checksums = {
+            algorithm: checksum
+            for algorithm, checksum in checksums.iteritems()
+            if checksum
+        }
+
         super(Source, self).__init__(*args, **kwargs)
 
         self.mimetype = mimetype
@@ -74,6 +91,11 @@ class Source(MemoizedObject, FilteredObject):
         if self._parsed_source is None:
             self._parsed_source = self.fetcher.parse_source(source=self)
 
+            # The checksums are part of the parsed source so that changing them
+            # triggers a new fetch.
+            if self._parsed_source and self.checksums:
+                self._parsed_source = dict(self._parsed_source, checksums=self.checksums)
+
         return self._parsed_source
 
     def fetch(self, target_path):
@@ -85,3 +107,22 @@ class Source(MemoizedObject, FilteredObject):
             parsed_source=self.parsed_source,
             target_path=target_path,
         )
+
+    def probe(self, cancelled=None):
+        """
+        Measures how fast the source responds.
+        """
+
+        return self.fetcher.probe(parsed_source=self.parsed_source, cancelled=cancelled)
+
+    def refresh(self, target_path, cache_manifest):
+        """
+        Fetches the source again, if it changed since it was fetched with the
+        specified `cache_manifest`.
+        """
+
+        return self.fetcher.refresh(
+            parsed_source=self.parsed_source,
+            target_path=target_path,
+            cache_manifest=cache_manifest,
+        )
@@ -0,0 +1,221 @@
+"""
+A content-addressed store for downloaded archives.
+"""
+
+import os
+import shutil
+import hashlib
+import threading
+
+from contextlib import contextmanager
+
+from .log import LOGGER, Highlight as hl
+from .options import get_option
+from .path import mkdir, from_user_path, read_json, write_json
+from .lock import get_file_lock
+
+
+def link_or_copy(source_path, target_path):
+    """
+    Hardlink `source_path` to `target_path`, or copy it if hardlinks are not
+    supported.
+
+    `target_path` must not exist.
+    """
+
+    try:
+        os.link(source_path, target_path)
+
+    except (AttributeError, OSError) as ex:
+        LOGGER.debug(
+            "Unable to hardlink %s to %s (%s). Copying it instead.",
+            hl(source_path),
+            hl(target_path),
+            ex,
+        )
+
+        shutil.copyfile(source_path, target_path)
+
+
+class DownloadStore(object):
+
+    """
+    Stores downloaded archives by digest, so that an archive used by several
+    attendees is only downloaded and stored once.
+
+    The attendees caches get hardlinks to the stored archives. An index
+    remembers the digest of the archive behind every downloaded URL.
+    """
+
+    def __init__(self, path):
+        """
+        Create a download store at `path`.
+        """
+
+        self.path = path
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, 'index.json')
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = read_json(self.index_path)
+
+        return self._index
+
+    def save(self):
+        """
+        Persist the index.
+        """
+
+        mkdir(self.path)
+        write_json(self.index_path, self._index)
+
+    def get_object_path(self, digest):
+        """
+        Get the path of the archive with the specified `digest`.
+        """
+
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def url_lock(self, url):
+        """
+        Get the lock of the specified `url`, so that concurrent fetches of a
+        same URL, from any thread or teapot process, happen one after the
+        other and only the first downloads it.
+        """
+
+        return get_file_lock(os.path.join(self.path, 'locks', '%s.lock' % hashlib.sha1(url).hexdigest()))
+
+    @contextmanager
+    def index_lock(self):
+        """
+        Lock the index and read it again, as another process may have changed
+        it.
+        """
+
+        with get_file_lock(os.path.join(self.path, 'locks', 'index.lock')):
+            with self._lock:
+                self._index = None
+
+                yield
+
+    def get(self, url, mimetype, target_path):
+        """
+        Get the archive downloaded from `url` into `target_path`.
+
+        `mimetype` is the mimetype the archive was forced to, if any.
+
+        Return the download manifest, or None if the URL was never downloaded.
+        """
+
+        with self.index_lock():
+            entry = self.index.get(url)
+
+        if not entry or entry.get('mimetype') != mimetype:
+            return None
+
+        object_path = self.get_object_path(entry['archive_digest'])
+
+        if not os.path.isfile(object_path):
+            return None
+
+        archive_path = os.path.join(target_path, entry['filename'])
+
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+
+        LOGGER.debug("Getting %s from the download store...", hl(url))
+        link_or_copy(object_path, archive_path)
+
+        return {
+            'archive_path': archive_path,
+            'archive_type': tuple(entry['archive_type']),
+            'archive_digest': entry['archive_digest'],
+            'etag': entry.get('etag'),
+            'last_modified': entry.get('last_modified'),
+        }
+
+    def add(self, url, mimetype, manifest):
+        """
+        Add the archive downloaded from `url`, as described by its download
+        `manifest`.
+
+        `mimetype` is the mimetype the archive was forced to, if any.
+        """
+
+        archive_path = manifest['archive_path']
+        object_path = self.get_object_path(manifest['archive_digest'])
+
+        if not os.path.isfile(object_path):
+            mkdir(os.path.dirname(object_path))
+            tmp_path = '%s.%s.tmp' % (object_path, os.getpid())
+            link_or_copy(archive_path, tmp_path)
+            os.rename(tmp_path, object_path)
+
+        elif os.stat(object_path).st_ino != os.stat(archive_path).st_ino:
+            # The archive was already stored: share it.
+            os.remove(archive_path)
+            link_or_copy(object_path, archive_path)
+
+        with self.index_lock():
+            self.index[url] = {
+                'mimetype': mimetype,
+                'filename': os.path.basename(archive_path),
+                'archive_type': manifest['archive_type'],
+                'archive_digest': manifest['archive_digest'],
+                'etag': manifest.get('etag'),
+                'last_modified': manifest.get('last_modified'),
+            }
+
+            self.save()
+
+    def prune(self):
+        """
+        Remove the archives that no attendee cache links to anymore.
+
+        Archives that were copied instead of hardlinked are removed as well.
+        """
+
+        with self.index_lock():
+            digests = set()
+
+            for root, dirs, files in os.walk(os.path.join(self.path, 'objects')):
+                for filename in files:
+                    path = os.path.join(root, filename)
+
+                    if os.stat(path).st_nlink == 1:
+                        LOGGER.debug("Removing %s from the download store.", hl(filename))
+                        os.remove(path)
+                        digests.add(filename)
+
+            if digests:
+                for url, entry in self.index.items():
+                    if entry.get('archive_digest') in digests:
+                        del self.index[url]
+
+                self.save()
+
+            return len(digests)
+
+
+_DOWNLOAD_STORES = {}
+_DOWNLOAD_STORES_LOCK = threading.Lock()
+
+
+def get_download_store():
+    """
+    Get the download store that lives in the cache root.
+    """
+
+    path = os.path.join(from_user_path(get_option('cache_root')), '.store')
+
+    with _DOWNLOAD_STORES_LOCK:
+        if path not in _DOWNLOAD_STORES:
+            _DOWNLOAD_STORES[path] = DownloadStore(path)
+
+        return _DOWNLOAD_STORES[path]
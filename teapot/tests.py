@@ -3,7 +3,24 @@ teapot unit tests.
 """
 
 import os
+import re
 import sys
+import json
+import time
+import errno
+import zlib
+import struct
+import hashlib
+import shutil
+import tempfile
+import threading
+import tarfile
+import zipfile
+import subprocess
+import SocketServer
+import BaseHTTPServer
+
+from contextlib import contextmanager
 
 try:
     import unittest2 as unittest
@@ -14,6 +31,46 @@ from teapot import *
 from teapot.memoized import Memoized
 from teapot.extensions import parse_extension
 from teapot.error import TeapotError
+from teapot.scheduler import Scheduler
+from teapot.digest import DigestCache
+from teapot import mirrors
+from teapot import path as teapot_path
+from teapot.store import DownloadStore
+from teapot.extractions import ExtractionCache
+from teapot.fetchers.folder_fetcher import FolderFetcher
+from teapot.fetchers.git_fetcher import GitFetcher
+from teapot.fetchers.callbacks import NullFetcherCallback
+from teapot.fetchers import http_fetcher
+from teapot.fetchers import file_fetcher
+from teapot.unpackers.tarball_unpacker import TarballUnpacker
+from teapot.unpackers import tarball_unpacker
+from teapot.unpackers import zipfile_unpacker
+from teapot.unpackers.callbacks import NullUnpackerCallback
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@contextmanager
+def http_server(handler_class):
+    """
+    Serve requests with `handler_class` on a local port, from another thread.
+
+    Yield the URL of the server.
+    """
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        yield 'http://127.0.0.1:%s' % server.server_address[1]
+
+    finally:
+        server.shutdown()
+        server.server_close()
 
 
 class TestTeapot(unittest.TestCase):
@@ -138,6 +195,8 @@ class TestTeapot(unittest.TestCase):
             self.assertTrue('NON_EXISTING' not in os.environ)
 
         self.assertEqual(orphan_environment.shell, None)
+        self.assertEqual(system_environment.children, {environment})
+        self.assertEqual(environment.children, {sub_environment})
 
         shell_environment = Environment(
             name='shell_environment',
@@ -263,6 +322,17 @@ class TestTeapot(unittest.TestCase):
 
         self.assertRaises(Attendee.DependencyCycleError, Attendee.get_dependent_instances)
 
+        # All the cycles get reported.
+        e = Attendee('e')
+        e.depends_on(e)
+
+        try:
+            Attendee.get_dependent_instances()
+        except Attendee.DependencyCycleError as ex:
+            self.assertEqual(ex.cycles, [[a, c, d, a], [e, e]])
+        else:
+            self.fail('No dependency cycle was detected.')
+
         # Add a source.
         a.add_source('http://some.fake.address')
         self.assertIsNotNone(a.get_source('http://some.fake.address'))
@@ -274,6 +344,24 @@ class TestTeapot(unittest.TestCase):
         self.assertIsNotNone(a.get_build('foo'))
         self.assertEqual(a.get_build('foo').environment, attendee_test_environment)
 
+        # Only the subdirectories of the builds are extracted, if they all
+        # have one.
+        self.assertEqual(a.extraction_patterns, (None, []))
+
+        a.get_build('foo').subdir = 'lib/foo/'
+        a.add_extracted_path('./include')
+        a.add_excluded_path('lib/foo/tests')
+
+        self.assertEqual(a.extraction_patterns, (['include', 'lib/foo'], ['lib/foo/tests']))
+
+        # Post-unpack commands may need any file.
+        a.add_post_unpack_command('./bootstrap.sh')
+        self.assertEqual(a.extraction_patterns, (None, ['lib/foo/tests']))
+
+        a.post_unpack_commands = []
+        a.add_build('bar', environment='attendee_test_environment')
+        self.assertEqual(a.extraction_patterns, (None, ['lib/foo/tests']))
+
     def test_extensions(self):
         """
         Test the extensions.
@@ -318,6 +406,1485 @@ class TestTeapot(unittest.TestCase):
         # Make sure unregistered extensions don't parse successfully.
         self.assertRaises(TeapotError, parse_extension, missing_call)
 
+    def test_scheduler(self):
+        """
+        Test the scheduler.
+        """
+
+        lock = threading.Lock()
+        events = []
+        state = {'running': 0, 'max_running': 0}
+
+        def task(name):
+            def func():
+                with lock:
+                    events.append(('start', name))
+                    state['running'] += 1
+                    state['max_running'] = max(state['max_running'], state['running'])
+
+                time.sleep(0.05)
+
+                with lock:
+                    state['running'] -= 1
+                    events.append(('end', name))
+
+            return func
+
+        scheduler = Scheduler(jobs=2)
+        scheduler.add_task('a', task('a'), depends_on=['b', 'c'])
+        scheduler.add_task('b', task('b'))
+        scheduler.add_task('c', task('c'), depends_on=['d', 'missing'])
+        scheduler.add_task('d', task('d'))
+        scheduler.run()
+
+        # A task only starts when all its dependencies ended.
+        for name, deps in [('a', ['b', 'c']), ('c', ['d'])]:
+            for dep in deps:
+                self.assertLess(events.index(('end', dep)), events.index(('start', name)))
+
+        self.assertEqual(state['max_running'], 2)
+
+        # The first failure is raised and prevents other tasks from starting.
+        def fail():
+            raise TeapotError('failure')
+
+        del events[:]
+        scheduler = Scheduler(jobs=1)
+        scheduler.add_task('a', task('a'), depends_on=['b'])
+        scheduler.add_task('b', fail)
+        self.assertRaises(TeapotError, scheduler.run)
+        self.assertEqual(events, [])
+
+        # Dependency cycles are detected.
+        scheduler = Scheduler(jobs=1)
+        scheduler.add_task('a', task('a'), depends_on=['b'])
+        scheduler.add_task('b', task('b'), depends_on=['a'])
+        self.assertRaises(TeapotError, scheduler.run)
+
+        self.assertRaises(TeapotError, Scheduler, jobs=0)
+
+        # Each pool has its own limit.
+        del events[:]
+        state['max_running'] = 0
+        scheduler = Scheduler(jobs=1)
+        scheduler.add_pool('other', 3)
+        scheduler.add_task('a', task('a'))
+        scheduler.add_task('b', task('b'), pool='other')
+        scheduler.add_task('c', task('c'), pool='other')
+        scheduler.add_task('d', task('d'), pool='other', depends_on=['a'])
+        scheduler.run()
+
+        self.assertEqual(state['max_running'], 3)
+        self.assertRaises(TeapotError, scheduler.add_task, 'e', task('e'), pool='missing')
+
+    def test_host_slots(self):
+        """
+        Test that the connections to a same host are limited.
+        """
+
+        lock = threading.Lock()
+        connections = [0, 0]
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    connections[0] += 1
+                    connections[1] = max(connections)
+
+                time.sleep(0.05)
+
+                with lock:
+                    connections[0] -= 1
+
+                self.send_response(200)
+                self.send_header('Content-Length', 3)
+                self.end_headers()
+                self.wfile.write('foo')
+
+            def log_message(self, *args):
+                pass
+
+        with http_server(Handler) as url:
+            def get():
+                with http_fetcher.host_slot(url):
+                    self.assertEqual(http_fetcher.get_session().get(url).content, 'foo')
+
+            threads = [threading.Thread(target=get) for _ in range(12)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(connections[1], get_option('max_connections_per_host'))
+
+    def test_digest_cache(self):
+        """
+        Test the digest cache.
+        """
+
+        root = tempfile.mkdtemp()
+
+        try:
+            path = os.path.join(root, 'archive')
+            cache_path = os.path.join(root, 'digests.json')
+
+            with open(path, 'wb') as f:
+                f.write('foo')
+
+            os.utime(path, (1000000000, 1000000000))
+
+            cache = DigestCache(cache_path)
+            digest = cache.get_digest(path)
+            cache.save()
+
+            # A new cache must read the persisted digest and never hash the
+            # file again while it is unchanged.
+            cache = DigestCache(cache_path)
+            cache.compute_digest = lambda path: self.fail('The file was hashed again.')
+            self.assertEqual(cache.get_digest(path), digest)
+
+            with open(path, 'wb') as f:
+                f.write('bar')
+
+            os.utime(path, (1000000001, 1000000001))
+
+            cache = DigestCache(cache_path)
+            self.assertNotEqual(cache.get_digest(path), digest)
+
+        finally:
+            shutil.rmtree(root)
+
+    def test_checksums(self):
+        """
+        Test that archives that don't match their checksums are discarded.
+        """
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-gzip')
+                self.send_header('Content-Length', 3)
+                self.end_headers()
+                self.wfile.write('foo')
+
+            def log_message(self, *args):
+                pass
+
+        # Empty checksums are ignored.
+        source = Attendee('foo').add_source('http://host/foo.tar.gz', sha256=None, md5='').get_source('http://host/foo.tar.gz')
+        self.assertEqual(source.checksums, {})
+
+        root = tempfile.mkdtemp()
+
+        try:
+            with http_server(Handler) as url:
+                fetch_info = {'url': url + '/foo.tar.gz', 'mimetype': None}
+
+                with self.assertRaises(TeapotError):
+                    http_fetcher.HttpFetcher().download(
+                        dict(fetch_info, checksums={'sha256': '0' * 64}),
+                        root,
+                        NullFetcherCallback(),
+                    )
+
+                self.assertEqual(os.listdir(root), [])
+
+                manifest = http_fetcher.HttpFetcher().download(
+                    dict(fetch_info, checksums={'sha1': '0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33'}),
+                    root,
+                    NullFetcherCallback(),
+                )
+
+                self.assertEqual(open(manifest['archive_path'], 'rb').read(), 'foo')
+
+        finally:
+            shutil.rmtree(root)
+
+    def test_stored_checksums(self):
+        """
+        Test that stored archives that don't match their checksums are
+        downloaded again.
+        """
+
+        server = {'data': 'foo', 'requests': 0}
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server['requests'] += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-gzip')
+                self.send_header('Content-Length', len(server['data']))
+                self.end_headers()
+                self.wfile.write(server['data'])
+
+            def log_message(self, *args):
+                pass
+
+        root = tempfile.mkdtemp()
+        store = DownloadStore(os.path.join(root, 'store'))
+        digest_cache = DigestCache(os.path.join(root, 'digests.json'))
+        get_download_store = http_fetcher.get_download_store
+        get_digest_cache = http_fetcher.get_digest_cache
+        http_fetcher.get_download_store = lambda: store
+        http_fetcher.get_digest_cache = lambda: digest_cache
+
+        try:
+            with http_server(Handler) as url:
+                fetch_info = {'url': url + '/foo.tar.gz', 'mimetype': None}
+
+                def fetch(data, target):
+                    target_path = os.path.join(root, target)
+                    teapot_path.mkdir(target_path)
+
+                    return http_fetcher.HttpFetcher().fetch(
+                        dict(fetch_info, checksums={'sha256': hashlib.sha256(data).hexdigest()}),
+                        target_path,
+                        NullFetcherCallback(),
+                    )
+
+                manifest = fetch('foo', 'a')
+                object_path = store.get_object_path(manifest['archive_digest'])
+
+                # Only the checksums of archives that were not modified
+                # recently are remembered.
+                os.utime(object_path, (time.time() - 3600, time.time() - 3600))
+
+                self.assertEqual(open(fetch('foo', 'b')['archive_path']).read(), 'foo')
+                self.assertEqual(server['requests'], 1)
+                self.assertEqual(digest_cache.get_checksums(object_path), {'sha256': hashlib.sha256('foo').hexdigest()})
+
+                # The archive changed upstream, and so did its checksums.
+                server['data'] = 'bar'
+                manifest = fetch('bar', 'b')
+
+                self.assertEqual(open(manifest['archive_path']).read(), 'bar')
+                self.assertEqual(server['requests'], 2)
+                self.assertEqual(open(fetch('bar', 'c')['archive_path']).read(), 'bar')
+                self.assertEqual(server['requests'], 2)
+
+                # Nothing is left behind when the new archive doesn't match
+                # either.
+                with self.assertRaises(TeapotError):
+                    fetch('baz', 'd')
+
+                self.assertEqual(os.listdir(os.path.join(root, 'd')), [])
+
+        finally:
+            http_fetcher.get_download_store = get_download_store
+            http_fetcher.get_digest_cache = get_digest_cache
+            shutil.rmtree(root)
+
+    def test_resumed_downloads(self):
+        """
+        Test that interrupted downloads are resumed.
+        """
+
+        data = ''.join(chr(index % 251) for index in range(200000))
+        server = {'mode': 'interrupt', 'ranges': []}
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                mode = server['mode']
+                match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+
+                if match and mode in ('ranges', '416', 'bad range'):
+                    server['ranges'].append(int(match.group(1)))
+
+                    if mode == '416':
+                        self.send_response(416)
+                        self.send_header('Content-Length', 0)
+                        self.end_headers()
+
+                        return
+
+                    start = 0 if mode == 'bad range' else int(match.group(1))
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, len(data) - 1, len(data)))
+                    body = data[start:]
+                else:
+                    self.send_response(200)
+                    body = data
+
+                if mode == 'gzip':
+                    body = zlib.compress(body)[2:-4]
+                    body = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03' + body + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+                    self.send_header('Content-Encoding', 'gzip')
+
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', len(body))
+                self.send_header('ETag', '"1"')
+                self.end_headers()
+
+                if mode == 'interrupt':
+                    body = body[:len(body) // 2]
+
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        # The responses that are replaced by another one must be closed, so
+        # that their connection goes back to the pool.
+        responses = []
+        get_session = http_fetcher.get_session
+
+        class Session(object):
+            def get(self, *args, **kwargs):
+                response = get_session().get(*args, **kwargs)
+                close = response.close
+
+                def close_response():
+                    response.was_closed = True
+                    close()
+
+                response.was_closed = False
+                response.close = close_response
+                responses.append(response)
+
+                return response
+
+        root = tempfile.mkdtemp()
+        http_fetcher.get_session = Session
+
+        try:
+            with http_server(Handler) as url:
+                fetch_info = {'url': url + '/archive.bin', 'mimetype': None}
+                part_path = os.path.join(root, 'download.part')
+
+                def download():
+                    return http_fetcher.HttpFetcher().download(fetch_info, root, NullFetcherCallback())
+
+                def interrupt():
+                    server['mode'] = 'interrupt'
+
+                    with self.assertRaises(Exception):
+                        download()
+
+                    # The partial download and its validators are kept.
+                    self.assertEqual(open(part_path, 'rb').read(), data[:len(data) // 2])
+                    self.assertEqual(json.load(open(part_path + '.json')), {
+                        'url': fetch_info['url'],
+                        'etag': '"1"',
+                        'last_modified': None,
+                    })
+
+                    del responses[:]
+
+                def check(manifest):
+                    self.assertEqual(open(manifest['archive_path'], 'rb').read(), data)
+                    self.assertEqual(manifest['archive_digest'], hashlib.sha1(data).hexdigest())
+                    self.assertFalse(os.path.exists(part_path))
+                    self.assertFalse(os.path.exists(part_path + '.json'))
+                    self.assertTrue(all(response.was_closed for response in responses[:-1]))
+                    del responses[:]
+
+                # The server resumes the download.
+                interrupt()
+                server['mode'] = 'ranges'
+                check(download())
+                self.assertEqual(server['ranges'], [len(data) // 2])
+
+                # The server sends the whole file again.
+                interrupt()
+                server['mode'] = '200'
+                check(download())
+
+                # The server can't satisfy the range.
+                interrupt()
+                server['mode'] = '416'
+                check(download())
+                self.assertEqual(server['ranges'], [len(data) // 2] * 2)
+
+                # The server sends another range.
+                interrupt()
+                server['mode'] = 'bad range'
+                check(download())
+                self.assertEqual(server['ranges'], [len(data) // 2] * 3)
+
+                # The length of encoded responses is the encoded one.
+                server['mode'] = 'gzip'
+                check(download())
+
+        finally:
+            http_fetcher.get_session = get_session
+            shutil.rmtree(root)
+
+    def test_conditional_refresh(self):
+        """
+        Test that archives are only downloaded again when they changed.
+        """
+
+        server = {'data': 'foo', 'etag': '"1"', 'requests': []}
+        last_modified = 'Sat, 17 Oct 2026 00:00:00 GMT'
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server['requests'].append(dict(self.headers))
+
+                if self.headers.get('If-None-Match', server['etag']) == server['etag'] and self.headers.get('If-Modified-Since') == last_modified:
+                    self.send_response(304)
+                    self.end_headers()
+
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-gzip')
+                self.send_header('Content-Length', len(server['data']))
+                self.send_header('Last-Modified', last_modified)
+
+                if server['etag']:
+                    self.send_header('ETag', server['etag'])
+
+                self.end_headers()
+                self.wfile.write(server['data'])
+
+            def log_message(self, *args):
+                pass
+
+        root = tempfile.mkdtemp()
+
+        try:
+            with http_server(Handler) as url:
+                fetch_info = {'url': url + '/foo.tar.gz', 'mimetype': None}
+
+                def download(cache_manifest=None):
+                    return http_fetcher.HttpFetcher().download(fetch_info, root, NullFetcherCallback(), cache_manifest=cache_manifest)
+
+                manifest = download()
+
+                self.assertEqual(manifest['etag'], '"1"')
+                self.assertEqual(manifest['last_modified'], last_modified)
+
+                # A 304 reply keeps the archive and its manifest.
+                os.utime(manifest['archive_path'], (1000000000, 1000000000))
+
+                self.assertIs(download(manifest), manifest)
+                self.assertEqual(server['requests'][-1]['if-none-match'], '"1"')
+                self.assertEqual(os.path.getmtime(manifest['archive_path']), 1000000000)
+
+                # Without an entity tag, the modification date is used.
+                server['etag'] = None
+                manifest = download()
+
+                self.assertIsNone(manifest['etag'])
+                self.assertIs(download(manifest), manifest)
+                self.assertNotIn('if-none-match', server['requests'][-1])
+
+                # A changed archive is downloaded again.
+                server['data'] = 'bar'
+                server['etag'] = '"2"'
+                new_manifest = download(dict(manifest, etag='"1"'))
+
+                self.assertEqual(new_manifest['etag'], '"2"')
+                self.assertEqual(open(new_manifest['archive_path'], 'rb').read(), 'bar')
+
+        finally:
+            shutil.rmtree(root)
+
+    def test_segmented_downloads(self):
+        """
+        Test the download of large archives in several segments.
+        """
+
+        data = ''.join(chr(index % 251) for index in range(1024 ** 2))
+        server = {'accept_ranges': True, 'ranges': []}
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+
+                if match and server['accept_ranges']:
+                    start, end = int(match.group(1)), int(match.group(2))
+                    server['ranges'].append((start, end))
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(data)))
+                    body = data[start:end + 1]
+                else:
+                    self.send_response(200)
+                    body = data
+
+                if server['accept_ranges']:
+                    self.send_header('Accept-Ranges', 'bytes')
+
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', len(body))
+                self.send_header('ETag', '"1"')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        root = tempfile.mkdtemp()
+        original_get_option = http_fetcher.get_option
+        http_fetcher.get_option = lambda name: 1024 if name == 'segmented_download_threshold' else original_get_option(name)
+
+        try:
+            with http_server(Handler) as url:
+                fetch_info = {
+                    'url': url + '/archive.bin',
+                    'mimetype': None,
+                    'checksums': {'sha256': hashlib.sha256(data).hexdigest()},
+                }
+
+                def download():
+                    manifest = http_fetcher.HttpFetcher().download(fetch_info, root, NullFetcherCallback())
+
+                    self.assertEqual(open(manifest['archive_path'], 'rb').read(), data)
+                    self.assertEqual(manifest['archive_digest'], hashlib.sha1(data).hexdigest())
+
+                # The first segment comes from the initial response.
+                download()
+                self.assertEqual(sorted(server['ranges']), [(262144, 524287), (524288, 786431), (786432, 1048575)])
+
+                # The segments only use the free connections to the host: the
+                # fetch holds one and other fetches hold two.
+                del server['ranges'][:]
+
+                with http_fetcher.host_slot(url):
+                    with http_fetcher.host_slot(url):
+                        with http_fetcher.host_slot(url):
+                            download()
+
+                self.assertEqual(server['ranges'], [(524288, 1048575)])
+
+                # Servers that don't support ranges send the file in a single
+                # stream.
+                del server['ranges'][:]
+                server['accept_ranges'] = False
+                download()
+                self.assertEqual(server['ranges'], [])
+
+        finally:
+            http_fetcher.get_option = original_get_option
+            shutil.rmtree(root)
+
+    def test_race_sources(self):
+        """
+        Test the selection of the fastest source.
+        """
+
+        class FakeSource(object):
+            def __init__(self, resource, latency):
+                self.resource = resource
+                self.latency = latency
+                self.cancelled = False
+
+            def probe(self, cancelled=None):
+                if self.latency is None:
+                    raise IOError('Unreachable.')
+
+                time.sleep(self.latency)
+                self.cancelled = cancelled.is_set()
+
+                return self.latency
+
+        root = tempfile.mkdtemp()
+        path = os.path.join(root, 'latencies.json')
+        latency_cache = mirrors.LatencyCache(path)
+        get_latency_cache = mirrors.get_latency_cache
+        mirrors.get_latency_cache = lambda: latency_cache
+
+        try:
+            slow = FakeSource('http://slow/archive.tar.gz', 0.5)
+            fast = FakeSource('http://fast/archive.tar.gz', 0.05)
+            down = FakeSource('http://down/archive.tar.gz', None)
+
+            self.assertIs(mirrors.race_sources([slow, down, fast]), fast)
+            self.assertFalse(fast.cancelled)
+
+            # The losing probes are cancelled.
+            time.sleep(0.6)
+            self.assertTrue(slow.cancelled)
+            self.assertEqual(mirrors.LatencyCache(path).get_latency('fast'), 0.05)
+            self.assertEqual(mirrors.LatencyCache(path).get_latency('down'), get_option('mirror_probe_timeout'))
+
+            # When no source can be probed, the fastest known host wins.
+            fast.latency = None
+            self.assertIs(mirrors.race_sources([down, fast]), fast)
+
+            # Cancelled HTTP probes don't read the response.
+            class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    self.send_response(200)
+                    self.send_header('Content-Length', 3)
+                    self.end_headers()
+                    self.wfile.write('foo')
+
+                def log_message(self, *args):
+                    pass
+
+            with http_server(Handler) as url:
+                cancelled = threading.Event()
+
+                self.assertIsNotNone(http_fetcher.HttpFetcher().probe({'url': url}, cancelled))
+
+                cancelled.set()
+                self.assertIsNone(http_fetcher.HttpFetcher().probe({'url': url}, cancelled))
+
+        finally:
+            mirrors.get_latency_cache = get_latency_cache
+            shutil.rmtree(root)
+
+    def test_download_store(self):
+        """
+        Test the download store.
+        """
+
+        root = tempfile.mkdtemp()
+
+        try:
+            url = 'http://host/archive.tar.gz'
+            store = DownloadStore(os.path.join(root, 'store'))
+            os.mkdir(os.path.join(root, 'a'))
+            os.mkdir(os.path.join(root, 'b'))
+            archive_path = os.path.join(root, 'a', 'archive.tar.gz')
+
+            with open(archive_path, 'wb') as f:
+                f.write('foo')
+
+            self.assertIsNone(store.get(url, None, os.path.join(root, 'b')))
+
+            store.add(url, None, {
+                'archive_path': archive_path,
+                'archive_type': ('application/x-tar', 'gzip'),
+                'archive_digest': 'abcdef',
+            })
+
+            # A new store must find the archive from its index.
+            store = DownloadStore(os.path.join(root, 'store'))
+            manifest = store.get(url, None, os.path.join(root, 'b'))
+
+            self.assertEqual(manifest['archive_path'], os.path.join(root, 'b', 'archive.tar.gz'))
+            self.assertEqual(manifest['archive_type'], ('application/x-tar', 'gzip'))
+            self.assertEqual(open(manifest['archive_path'], 'rb').read(), 'foo')
+            self.assertIsNone(store.get(url, 'application/zip', os.path.join(root, 'b')))
+
+            # Stored archives are only removed once no cache uses them.
+            os.remove(archive_path)
+            self.assertEqual(store.prune(), 0)
+
+            if hasattr(os, 'link'):
+                os.remove(manifest['archive_path'])
+                self.assertEqual(store.prune(), 1)
+                self.assertIsNone(store.get(url, None, os.path.join(root, 'b')))
+
+        finally:
+            shutil.rmtree(root)
+
+    @unittest.skipIf(os.name == 'nt', 'The commands use a POSIX shell.')
+    def test_extraction_cache(self):
+        """
+        Test the sharing of extracted trees.
+        """
+
+        root = tempfile.mkdtemp()
+
+        try:
+            extraction_cache = ExtractionCache(os.path.join(root, 'extractions'))
+            signature = 'a' * 40
+
+            self.assertIsNone(extraction_cache.get(signature, os.path.join(root, 'a')))
+
+            os.makedirs(os.path.join(root, 'a', 'foo-1.0', 'src'))
+
+            with open(os.path.join(root, 'a', 'foo-1.0', 'src', 'a.c'), 'w') as f:
+                f.write('int a;')
+
+            os.symlink('a.c', os.path.join(root, 'a', 'foo-1.0', 'src', 'b.c'))
+
+            extraction_cache.add(signature, os.path.join(root, 'a'), {
+                'extracted_sources_path': os.path.join(root, 'a', 'foo-1.0'),
+            })
+            manifest = extraction_cache.get(signature, os.path.join(root, 'b'))
+
+            self.assertEqual(manifest, {'extracted_sources_path': os.path.join(root, 'b', 'foo-1.0')})
+            self.assertEqual(os.readlink(os.path.join(root, 'b', 'foo-1.0', 'src', 'b.c')), 'a.c')
+
+            # The sources are copies: writing them in place doesn't change
+            # the stored tree.
+            with open(os.path.join(root, 'a', 'foo-1.0', 'src', 'a.c'), 'r+') as f:
+                f.write('int b;')
+
+            with open(os.path.join(root, 'b', 'foo-1.0', 'src', 'a.c'), 'a') as f:
+                f.write('int c;')
+
+            manifest = extraction_cache.get(signature, os.path.join(root, 'c'))
+
+            self.assertEqual(open(os.path.join(root, 'c', 'foo-1.0', 'src', 'a.c')).read(), 'int a;')
+
+            # Trees are kept as long as a sources directory uses them.
+            shutil.rmtree(os.path.join(root, 'c'))
+            shutil.rmtree(os.path.join(root, 'a'))
+            self.assertEqual(extraction_cache.prune(), 0)
+
+            shutil.rmtree(os.path.join(root, 'b'))
+            self.assertEqual(extraction_cache.prune(), 1)
+            self.assertIsNone(extraction_cache.get(signature, os.path.join(root, 'd')))
+
+        finally:
+            shutil.rmtree(root)
+
+    @unittest.skipIf(os.name == 'nt', 'The commands use a POSIX shell.')
+    def test_extraction_cache_builds(self):
+        """
+        Test that builds that write their sources in place don't change the
+        sources of the other attendees.
+        """
+
+        root = tempfile.mkdtemp()
+
+        try:
+            os.makedirs(os.path.join(root, 'src', 'foo'))
+
+            with open(os.path.join(root, 'src', 'foo', 'a.txt'), 'w') as f:
+                f.write('foo')
+
+            party_path = os.path.join(root, 'party.py')
+
+            with open(party_path, 'w') as f:
+                f.write('''
+import os
+
+from teapot import *
+
+root = %r
+
+set_option('cache_root', os.path.join(root, 'cache'))
+set_option('sources_root', os.path.join(root, 'sources'))
+set_option('builds_root', os.path.join(root, 'builds'))
+
+for name in ['a', 'b']:
+    Attendee(name).add_source('folder://' + os.path.join(root, 'src', 'foo'))
+    Attendee(name).add_build('default', environment='system')
+
+Attendee('a').get_build('default').add_command('echo bar >> a.txt')
+Attendee('b').get_build('default').add_command('cat a.txt > %%s' %% os.path.join(root, 'b.txt'))
+Attendee('b').depends_on('a')
+'''.lstrip() % root)
+
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            process = subprocess.Popen(
+                [sys.executable, '-c', 'import sys; from teapot.main import main; sys.exit(main())', '-p', party_path, 'build'],
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            output = process.communicate()[0]
+
+            self.assertEqual(process.returncode, 0, output)
+            self.assertIn('Copying it.', output)
+            self.assertEqual(open(os.path.join(root, 'b.txt')).read(), 'foo')
+
+        finally:
+            shutil.rmtree(root)
+
+    def test_file_fetcher(self):
+        """
+        Test the ways local archives are fetched.
+        """
+
+        class Progress(NullFetcherCallback):
+            def __init__(self):
+                self.updates = []
+
+            def on_update(self, progress):
+                self.updates.append(progress)
+
+        class FakeFcntl(object):
+            @staticmethod
+            def ioctl(target_fd, request, source_fd):
+                self.assertEqual(request, file_fetcher.FICLONE)
+                os.write(target_fd, os.read(source_fd, 1024))
+
+        root = tempfile.mkdtemp()
+        fcntl = file_fetcher.fcntl
+        copy_range = file_fetcher.copy_range
+        link_file = file_fetcher.FileFetcher.__dict__['link_file']
+
+        try:
+            file_path = os.path.join(root, 'foo.tar.gz')
+            target_path = os.path.join(root, 'cache')
+            os.mkdir(target_path)
+
+            with open(file_path, 'wb') as f:
+                f.write('0123456789')
+
+            fetch_info = {
+                'file_path': file_path,
+                'checksums': {'sha1': hashlib.sha1('0123456789').hexdigest()},
+            }
+
+            def fetch():
+                fetcher = file_fetcher.FileFetcher()
+                fetcher.chunk_size = 4
+                progress = Progress()
+                manifest = fetcher.fetch(fetch_info, target_path, progress)
+
+                self.assertEqual(open(manifest['archive_path'], 'rb').read(), '0123456789')
+                self.assertEqual(manifest['archive_digest'], hashlib.sha1('0123456789').hexdigest())
+
+                return manifest, progress.updates
+
+            # Archives on the same filesystem are hardlinked.
+            manifest, updates = fetch()
+
+            self.assertEqual(os.stat(manifest['archive_path']).st_ino, os.stat(file_path).st_ino)
+            self.assertEqual(updates, [10])
+
+            # Otherwise, they are cloned if the filesystem supports it.
+            file_fetcher.FileFetcher.link_file = lambda *args: False
+            file_fetcher.fcntl = FakeFcntl
+            manifest, updates = fetch()
+
+            self.assertNotEqual(os.stat(manifest['archive_path']).st_ino, os.stat(file_path).st_ino)
+            self.assertEqual(updates, [10])
+
+            # Or copied by the kernel.
+            file_fetcher.fcntl = None
+            self.assertEqual(fetch()[1], [4, 8, 10, 10])
+
+            # Or copied by chunks.
+            def fail(*args):
+                raise OSError(errno.ENOSYS, 'Not supported')
+
+            file_fetcher.copy_range = fail
+            self.assertEqual(fetch()[1], [4, 8, 10])
+
+        finally:
+            file_fetcher.FileFetcher.link_file = link_file
+            file_fetcher.fcntl = fcntl
+            file_fetcher.copy_range = copy_range
+            shutil.rmtree(root)
+
+    def test_folder_fetcher(self):
+        """
+        Test the incremental synchronization of folders.
+        """
+
+        root = tempfile.mkdtemp()
+
+        try:
+            folder_path = os.path.join(root, 'foo')
+            cache_path = os.path.join(root, 'cache')
+            os.makedirs(os.path.join(folder_path, 'sub'))
+            os.mkdir(cache_path)
+
+            def write(relpath, content):
+                path = os.path.join(folder_path, relpath)
+
+                with open(path, 'w') as f:
+                    f.write(content)
+
+                # Recently modified files are always copied again.
+                os.utime(path, (time.time() - 3600, time.time() - 3600))
+
+            write('a.txt', 'a')
+            write(os.path.join('sub', 'b.txt'), 'b')
+
+            fetcher = FolderFetcher()
+            fetch_info = {'folder_path': folder_path}
+            progress = NullFetcherCallback()
+            archive_path = os.path.join(cache_path, 'foo')
+
+            manifest = fetcher.fetch(fetch_info, cache_path, progress)
+
+            self.assertEqual(manifest['archive_path'], archive_path)
+            self.assertEqual(open(os.path.join(archive_path, 'sub', 'b.txt')).read(), 'b')
+            self.assertIs(fetcher.refresh(fetch_info, cache_path, progress, manifest), manifest)
+
+            write('a.txt', 'aa')
+            shutil.rmtree(os.path.join(folder_path, 'sub'))
+            new_manifest = fetcher.refresh(fetch_info, cache_path, progress, manifest)
+
+            self.assertNotEqual(new_manifest['archive_digest'], manifest['archive_digest'])
+            self.assertEqual(open(os.path.join(archive_path, 'a.txt')).read(), 'aa')
+            self.assertFalse(os.path.exists(os.path.join(archive_path, 'sub')))
+
+        finally:
+            shutil.rmtree(root)
+
+    def test_folder_fetcher_tree(self):
+        """
+        Test that the unchanged subtrees of folders are skipped.
+        """
+
+        root = tempfile.mkdtemp()
+        listdir = os.listdir
+
+        try:
+            folder_path = os.path.join(root, 'foo')
+            cache_path = os.path.join(root, 'cache')
+            os.mkdir(cache_path)
+
+            for relpath, content in [('a.txt', 'a'), ('sub1/b.txt', 'b'), ('sub2/c.txt', 'c')]:
+                path = os.path.join(folder_path, relpath)
+                teapot_path.mkdir(os.path.dirname(path))
+
+                with open(path, 'w') as f:
+                    f.write(content)
+
+            # Recently modified files and directories are always scanned
+            # again.
+            for path in ['a.txt', 'sub1/b.txt', 'sub2/c.txt', 'sub1', 'sub2', '']:
+                os.utime(os.path.join(folder_path, path), (time.time() - 3600, time.time() - 3600))
+
+            fetcher = FolderFetcher()
+            fetch_info = {'folder_path': folder_path}
+            progress = NullFetcherCallback()
+            tree_path = fetcher.get_tree_path(os.path.join(cache_path, 'foo'))
+            listed = []
+            copied = []
+            copy_file = fetcher.copy_file
+
+            def record_listdir(path):
+                if path.startswith(folder_path):
+                    listed.append(os.path.relpath(path, folder_path))
+
+                return listdir(path)
+
+            def record_copy_file(source_path, target_path):
+                copied.append(os.path.relpath(source_path, folder_path))
+                return copy_file(source_path, target_path)
+
+            os.listdir = record_listdir
+            fetcher.copy_file = record_copy_file
+
+            manifest = fetcher.fetch(fetch_info, cache_path, progress)
+            tree = json.load(open(tree_path))
+
+            self.assertEqual(sorted(listed), ['.', 'sub1', 'sub2'])
+            self.assertEqual(sorted(copied), ['a.txt', 'sub1/b.txt', 'sub2/c.txt'])
+
+            # Nothing changed: no directory is listed and no file copied.
+            del listed[:], copied[:]
+
+            self.assertIs(fetcher.refresh(fetch_info, cache_path, progress, manifest), manifest)
+            self.assertEqual(listed, [])
+            self.assertEqual(copied, [])
+
+            # A changed file is copied again, and only the digests of its
+            # directories change.
+            del listed[:], copied[:]
+
+            with open(os.path.join(folder_path, 'sub1', 'b.txt'), 'w') as f:
+                f.write('d')
+
+            os.utime(os.path.join(folder_path, 'sub1', 'b.txt'), (time.time() - 1800, time.time() - 1800))
+            new_manifest = fetcher.refresh(fetch_info, cache_path, progress, manifest)
+            new_tree = json.load(open(tree_path))
+
+            self.assertEqual(listed, [])
+            self.assertEqual(copied, ['sub1/b.txt'])
+            self.assertEqual(open(os.path.join(cache_path, 'foo', 'sub1', 'b.txt')).read(), 'd')
+            self.assertNotEqual(new_manifest['archive_digest'], manifest['archive_digest'])
+            self.assertNotEqual(new_tree['dirs']['sub1']['digest'], tree['dirs']['sub1']['digest'])
+            self.assertEqual(new_tree['dirs']['sub2'], tree['dirs']['sub2'])
+
+        finally:
+            os.listdir = listdir
+            shutil.rmtree(root)
+
+    def test_git_fetcher(self):
+        """
+        Test the git fetcher against a local repository.
+        """
+
+        root = tempfile.mkdtemp()
+
+        try:
+            repository_path = os.path.join(root, 'repository')
+            cache_path = os.path.join(root, 'cache')
+            os.mkdir(cache_path)
+
+            fetcher = GitFetcher()
+            fetcher.get_mirror_path = lambda url: os.path.join(root, 'mirror.git')
+            progress = NullFetcherCallback()
+
+            def git(*args):
+                return fetcher.git(
+                    '-c', 'user.name=teapot',
+                    '-c', 'user.email=teapot@localhost',
+                    *args,
+                    cwd=repository_path
+                ).strip()
+
+            try:
+                fetcher.git('init', '--quiet', repository_path)
+            except TeapotError:
+                self.skipTest("git is not available.")
+
+            with open(os.path.join(repository_path, 'a.txt'), 'w') as f:
+                f.write('a')
+
+            git('add', 'a.txt')
+            git('commit', '--quiet', '-m', 'first')
+            first_commit = git('rev-parse', 'HEAD')
+
+            fetch_info = {'url': 'file://%s' % repository_path, 'ref': 'HEAD'}
+            manifest = fetcher.fetch(fetch_info, cache_path, progress)
+
+            self.assertEqual(manifest['commit'], first_commit)
+            self.assertEqual(manifest['archive_type'], ('application/x-tar', None))
+            self.assertIs(fetcher.refresh(fetch_info, cache_path, progress, manifest), manifest)
+
+            git('commit', '--quiet', '--allow-empty', '-m', 'second')
+            new_manifest = fetcher.refresh(fetch_info, cache_path, progress, manifest)
+
+            self.assertEqual(new_manifest['commit'], git('rev-parse', 'HEAD'))
+
+            # Commits that are already mirrored are not fetched again.
+            fetcher.update_mirror = None
+            fetch_info = {'url': 'file://%s' % repository_path, 'ref': first_commit}
+
+            self.assertEqual(fetcher.fetch(fetch_info, cache_path, progress)['commit'], first_commit)
+
+        finally:
+            shutil.rmtree(root)
+
+    def test_github_fetcher(self):
+        """
+        Test that Github archives are fetched by commit.
+        """
+
+        root = tempfile.mkdtemp()
+        requests = []
+        commits = {'master': '1' * 40}
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                kind, ref = self.path.split('/')[-2:]
+
+                if kind == 'commits' and ref in commits:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/vnd.github.sha')
+                    self.end_headers()
+                    self.wfile.write(commits[ref])
+                elif kind == 'tarball':
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/gzip')
+                    self.send_header('Content-Length', len(ref))
+                    self.end_headers()
+                    self.wfile.write(ref)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            party_path = os.path.join(root, 'party.py')
+
+            with open(party_path, 'w') as f:
+                f.write('''
+import os
+
+from teapot import *
+
+root = %r
+
+set_option('cache_root', os.path.join(root, 'cache'))
+set_option('github_api_url', 'http://127.0.0.1:%s')
+
+Attendee('foo').add_source('github:owner/repository/master')
+'''.lstrip() % (root, server.server_address[1]))
+
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+            def fetch(*args):
+                process = subprocess.Popen(
+                    [sys.executable, '-c', 'import sys; from teapot.main import main; sys.exit(main())', '-d', '-p', party_path, 'fetch'] + list(args),
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                )
+                output = process.communicate()[0]
+                self.assertEqual(process.returncode, 0, output)
+
+            def tarball_requests():
+                return [path.split('/')[-1] for path in requests if '/tarball/' in path]
+
+            fetch()
+            self.assertEqual(tarball_requests(), ['1' * 40])
+
+            # The archive of a same commit is never downloaded twice.
+            fetch('--force')
+            fetch('--refresh')
+            self.assertEqual(tarball_requests(), ['1' * 40])
+
+            commits['master'] = '2' * 40
+            fetch('--refresh')
+            self.assertEqual(tarball_requests(), ['1' * 40, '2' * 40])
+
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(root)
+
+    def test_tarball_unpacker(self):
+        """
+        Test the extraction of tarballs.
+        """
+
+        root = tempfile.mkdtemp()
+
+        try:
+            os.makedirs(os.path.join(root, 'foo-1.0', 'src'))
+
+            with open(os.path.join(root, 'foo-1.0', 'src', 'a.c'), 'w') as f:
+                f.write('int a;')
+
+            archive_path = os.path.join(root, 'foo.tar.gz')
+
+            with tarfile.open(archive_path, 'w:gz') as tar:
+                tar.add(os.path.join(root, 'foo-1.0'), arcname='foo-1.0')
+
+            target_path = os.path.join(root, 'sources')
+            os.mkdir(target_path)
+
+            manifest = TarballUnpacker().unpack(archive_path, target_path, NullUnpackerCallback())
+
+            self.assertEqual(manifest['extracted_sources_path'], os.path.join(target_path, 'foo-1.0'))
+            self.assertEqual(os.listdir(target_path), ['foo-1.0'])
+            self.assertEqual(open(os.path.join(target_path, 'foo-1.0', 'src', 'a.c')).read(), 'int a;')
+
+            # The members are indexed while the archive is extracted.
+            self.assertEqual(
+                [member[:3] for member in TarballUnpacker().load_index(archive_path)],
+                [['foo-1.0', 0, 'directory'], ['foo-1.0/src', 0, 'directory'], ['foo-1.0/src/a.c', 6, 'file']],
+            )
+
+            # Every available backend extracts the same members.
+            compressions = [('w', None), ('w:gz', 'gzip'), ('w:bz2', 'bzip2')]
+
+            if tarball_unpacker.find_program('xz'):
+                compressions.append(('w', 'xz'))
+
+            for mode, compression in compressions:
+                archive_path = os.path.join(root, 'foo.%s.tar' % compression)
+
+                with tarfile.open(archive_path, mode) as tar:
+                    tar.add(os.path.join(root, 'foo-1.0'), arcname='foo-1.0')
+
+                # Python's `tarfile` can't write xz archives.
+                if compression == 'xz':
+                    subprocess.check_call(['xz', archive_path])
+                    archive_path += '.xz'
+
+                backends = TarballUnpacker().get_backends(compression)
+
+                self.assertTrue(backends)
+
+                for backend in backends:
+                    shutil.rmtree(target_path)
+                    os.mkdir(target_path)
+
+                    extracted_sources_path, index = TarballUnpacker().extract(
+                        archive_path,
+                        target_path,
+                        NullUnpackerCallback(),
+                        backend,
+                    )
+
+                    self.assertEqual(extracted_sources_path, os.path.join(target_path, 'foo-1.0'), backend)
+                    self.assertEqual(open(os.path.join(extracted_sources_path, 'src', 'a.c')).read(), 'int a;')
+                    self.assertEqual(
+                        sorted(member[0] for member in index),
+                        ['foo-1.0', 'foo-1.0/src', 'foo-1.0/src/a.c'],
+                    )
+
+            # Parallel decompressors are preferred to `bsdtar` on several
+            # processors.
+            find_program = tarball_unpacker.find_program
+            cpu_count = tarball_unpacker.cpu_count
+            tarball_unpacker.find_program = lambda name: name
+
+            try:
+                for tarball_unpacker.cpu_count, names in [
+                    (lambda: 1, ['bsdtar', 'lbzip2', 'pbzip2', 'tarfile']),
+                    (lambda: 4, ['lbzip2', 'pbzip2', 'bsdtar', 'tarfile']),
+                ]:
+                    self.assertEqual([backend[0] for backend in TarballUnpacker().get_backends('bzip2')], names)
+
+            finally:
+                tarball_unpacker.find_program = find_program
+                tarball_unpacker.cpu_count = cpu_count
+
+            shutil.rmtree(target_path)
+            os.mkdir(target_path)
+
+            # The members of uncompressed archives are copied as they are,
+            # by the kernel or through a memory mapping.
+            archive_path = os.path.join(root, 'foo.tar')
+
+            with tarfile.open(archive_path, 'w') as tar:
+                tar.add(os.path.join(root, 'foo-1.0'), arcname='foo-1.0')
+
+            copy_file_range = teapot_path._COPY_FILE_RANGE
+
+            try:
+                for teapot_path._COPY_FILE_RANGE in (copy_file_range, None):
+                    shutil.rmtree(target_path)
+                    os.mkdir(target_path)
+
+                    TarballUnpacker().extract(archive_path, target_path, NullUnpackerCallback(), ('zero-copy', None))
+
+                    self.assertEqual(open(os.path.join(target_path, 'foo-1.0', 'src', 'a.c')).read(), 'int a;')
+
+                # The headers of uncompressed archives are read without their
+                # data, and the members are then read from their offsets.
+                members = TarballUnpacker().get_members(archive_path)
+
+                self.assertEqual([member[3] for member in members], [0, 512, 1024])
+
+                shutil.rmtree(target_path)
+                os.mkdir(target_path)
+
+                extracted_sources_path, _ = TarballUnpacker().extract(
+                    archive_path,
+                    target_path,
+                    NullUnpackerCallback(),
+                    ('zero-copy', None),
+                    members[1:],
+                )
+
+                self.assertEqual(extracted_sources_path, os.path.join(target_path, 'foo-1.0/src'))
+                self.assertEqual(os.listdir(extracted_sources_path), ['a.c'])
+
+            finally:
+                teapot_path._COPY_FILE_RANGE = copy_file_range
+
+            # Only the selected members are extracted, at their offsets.
+            shutil.rmtree(target_path)
+            os.mkdir(target_path)
+
+            with open(os.path.join(root, 'foo-1.0', 'README'), 'w') as f:
+                f.write('foo')
+
+            os.makedirs(os.path.join(root, 'foo-1.0', 'src', 'tests'))
+
+            with tarfile.open(archive_path, 'w') as tar:
+                tar.add(os.path.join(root, 'foo-1.0'), arcname='foo-1.0')
+
+            manifest = TarballUnpacker().unpack(
+                archive_path,
+                target_path,
+                NullUnpackerCallback(),
+                includes=['src'],
+                excludes=['src/tests'],
+            )
+
+            # The files at the root of the sources are always extracted.
+            self.assertEqual(sorted(os.listdir(manifest['extracted_sources_path'])), ['README', 'src'])
+            self.assertEqual(os.listdir(os.path.join(manifest['extracted_sources_path'], 'src')), ['a.c'])
+
+            # Archives that only `bsdtar` can extract are extracted
+            # entirely.
+            if tarball_unpacker.find_program('bsdtar'):
+                class Progress(NullUnpackerCallback):
+                    def on_start(self, archive_path, count):
+                        self.count = count
+
+                shutil.rmtree(target_path)
+                os.mkdir(target_path)
+
+                unpacker = TarballUnpacker()
+                unpacker.get_backends = lambda compression: [('bsdtar', None)]
+                progress = Progress()
+                manifest = unpacker.unpack(archive_path, target_path, progress, includes=['src'], excludes=['src/tests'])
+
+                self.assertEqual(progress.count, 5)
+                self.assertEqual(sorted(os.listdir(os.path.join(manifest['extracted_sources_path'], 'src'))), ['a.c', 'tests'])
+
+            os.remove(os.path.join(root, 'foo-1.0', 'README'))
+            os.rmdir(os.path.join(root, 'foo-1.0', 'src', 'tests'))
+
+            # Archives are transcoded once, until they change.
+            if tarball_unpacker.find_program('bzip2'):
+                archive_path = os.path.join(root, 'foo.tar.bz2')
+
+                with tarfile.open(archive_path, 'w:bz2') as tar:
+                    tar.add(os.path.join(root, 'foo-1.0'), arcname='foo-1.0')
+
+                unpacker = TarballUnpacker()
+                transcoded_path = unpacker.transcode(archive_path, 'bzip2')
+
+                self.assertEqual(transcoded_path, archive_path + '.transcoded.tar')
+                self.assertIsNone(tarball_unpacker.get_compression(transcoded_path))
+                self.assertEqual(tarfile.open(transcoded_path).getnames(), ['foo-1.0', 'foo-1.0/src', 'foo-1.0/src/a.c'])
+
+                os.remove(transcoded_path)
+                open(transcoded_path, 'w').close()
+                self.assertEqual(os.path.getsize(unpacker.transcode(archive_path, 'bzip2')), 0)
+
+                os.remove(archive_path)
+
+                with tarfile.open(archive_path, 'w:bz2') as tar:
+                    tar.add(os.path.join(root, 'foo-1.0'), arcname='foo-1.0')
+
+                self.assertNotEqual(os.path.getsize(unpacker.transcode(archive_path, 'bzip2')), 0)
+
+            # The names that are not valid UTF-8 survive the index.
+            archive_path = os.path.join(root, 'foo.tar')
+
+            with tarfile.open(archive_path, 'w') as tar:
+                tar.add(os.path.join(root, 'foo-1.0'), arcname='foo-1.0')
+                tar.add(os.path.join(root, 'foo-1.0', 'src', 'a.c'), arcname='foo-1.0/caf\xe9/a.c')
+
+            unpacker = TarballUnpacker()
+            unpacker.save_index(archive_path, unpacker.build_index(archive_path))
+
+            self.assertEqual(unpacker.load_index(archive_path), unpacker.build_index(archive_path))
+
+            shutil.rmtree(target_path)
+            os.mkdir(target_path)
+
+            manifest = unpacker.unpack(archive_path, target_path, NullUnpackerCallback(), includes=['caf\xe9'])
+
+            self.assertEqual(os.listdir(manifest['extracted_sources_path']), ['caf\xe9'])
+
+            # Archives without a common directory can't be unpacked.
+            archive_path = os.path.join(root, 'foo.tar.gz')
+
+            with tarfile.open(archive_path, 'w:gz') as tar:
+                tar.add(os.path.join(root, 'foo-1.0', 'src', 'a.c'), arcname='a.c')
+
+            shutil.rmtree(target_path)
+            os.mkdir(target_path)
+
+            with self.assertRaises(TeapotError):
+                TarballUnpacker().unpack(archive_path, target_path, NullUnpackerCallback())
+
+            self.assertEqual(os.listdir(target_path), [])
+
+        finally:
+            shutil.rmtree(root)
+
+    def test_zipfile_unpacker(self):
+        """
+        Test the concurrent extraction of zip archives.
+        """
+
+        root = tempfile.mkdtemp()
+        cpu_count = zipfile_unpacker.cpu_count
+
+        try:
+            archive_path = os.path.join(root, 'foo.zip')
+
+            # Half the members are stored without compression.
+            with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                for index in range(100):
+                    zipf.writestr(
+                        'foo-1.0/dir%d/file%d.c' % (index % 10, index),
+                        'int a%d;' % index,
+                        zipfile.ZIP_STORED if index % 2 else zipfile.ZIP_DEFLATED,
+                    )
+
+                zipf.writestr('foo-1.0/empty/', '')
+
+            target_path = os.path.join(root, 'sources')
+            os.mkdir(target_path)
+
+            zipfile_unpacker.cpu_count = lambda: 4
+            manifest = zipfile_unpacker.ZipFileUnpacker().unpack(archive_path, target_path, NullUnpackerCallback())
+
+            self.assertEqual(manifest['extracted_sources_path'], os.path.join(target_path, 'foo-1.0'))
+            self.assertTrue(os.path.isdir(os.path.join(target_path, 'foo-1.0', 'empty')))
+            self.assertEqual(
+                zipfile_unpacker.ZipFileUnpacker().load_index(archive_path)[-1],
+                ['foo-1.0/empty', 0, 'directory', zipfile.ZipFile(archive_path).getinfo('foo-1.0/empty/').header_offset],
+            )
+
+            for index in range(100):
+                path = os.path.join(target_path, 'foo-1.0', 'dir%d' % (index % 10), 'file%d.c' % index)
+                self.assertEqual(open(path).read(), 'int a%d;' % index)
+
+            # Only the selected members are extracted.
+            shutil.rmtree(target_path)
+            os.mkdir(target_path)
+
+            zipfile_unpacker.ZipFileUnpacker().unpack(
+                archive_path,
+                target_path,
+                NullUnpackerCallback(),
+                includes=['dir1', 'dir2/*.c'],
+                excludes=['dir1/file11.c'],
+            )
+
+            self.assertEqual(sorted(os.listdir(os.path.join(target_path, 'foo-1.0'))), ['dir1', 'dir2'])
+            self.assertEqual(len(os.listdir(os.path.join(target_path, 'foo-1.0', 'dir1'))), 9)
+            self.assertEqual(len(os.listdir(os.path.join(target_path, 'foo-1.0', 'dir2'))), 10)
+
+        finally:
+            zipfile_unpacker.cpu_count = cpu_count
+            shutil.rmtree(root)
+
+    def test_concurrent_processes(self):
+        """
+        Test several teapot processes sharing the same directories.
+        """
+
+        root = tempfile.mkdtemp()
+
+        try:
+            os.makedirs(os.path.join(root, 'src', 'foo'))
+
+            with open(os.path.join(root, 'src', 'foo', 'a.txt'), 'w') as f:
+                f.write('foo')
+
+            party_path = os.path.join(root, 'party.py')
+
+            with open(party_path, 'w') as f:
+                f.write('''
+import os
+
+from teapot import *
+
+root = %r
+
+set_option('cache_root', os.path.join(root, 'cache'))
+set_option('sources_root', os.path.join(root, 'sources'))
+set_option('builds_root', os.path.join(root, 'builds'))
+
+for name in ['a', 'b', 'c']:
+    Attendee(name).add_source('folder://' + os.path.join(root, 'src', 'foo'))
+    Attendee(name).add_post_unpack_command('echo %%s >> %%s' %% (name, os.path.join(root, 'unpacks')))
+    Attendee(name).add_build('default', environment='system')
+    Attendee(name).get_build('default').add_command('sleep 0.2 && cat a.txt && echo %%s >> %%s' %% (name, os.path.join(root, 'builds.log')))
+
+Attendee('c').depends_on('a', 'b')
+'''.lstrip() % root)
+
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            processes = [
+                subprocess.Popen(
+                    [sys.executable, '-c', 'import sys; from teapot.main import main; sys.exit(main())', '-p', party_path, 'build', '-j', '2'],
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                )
+                for _ in range(4)
+            ]
+
+            for process in processes:
+                output = process.communicate()[0]
+                self.assertEqual(process.returncode, 0, output)
+
+            # Every attendee must have been unpacked and built only once.
+            self.assertEqual(sorted(open(os.path.join(root, 'unpacks')).read().split()), ['a', 'b', 'c'])
+            self.assertEqual(sorted(open(os.path.join(root, 'builds.log')).read().split()), ['a', 'b', 'c'])
+
+        finally:
+            shutil.rmtree(root)
+
 
 if __name__ == '__main__':
     unittest.main()
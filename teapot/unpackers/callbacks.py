@@ -3,6 +3,9 @@ A set of unpacker callbacks class.
 """
 
 import os
+import sys
+
+from ..log import PROGRESS_BAR_LOCK
 
 try:
     from progressbar import WidgetHFill
@@ -119,6 +122,17 @@ class CurrentFile(WidgetHFill):
         return result
 
 
+class FileCount(object):
+    """Displays the count of files, when their total count is unknown."""
+
+    def update(self, pbar):
+        """
+        Update the progress bar.
+        """
+
+        return '%d files' % pbar.currval
+
+
 class ProgressBarUnpackerCallback(BaseUnpackerCallback):
     """
     Provides a progress bar callback to unpackers.
@@ -127,13 +141,23 @@ class ProgressBarUnpackerCallback(BaseUnpackerCallback):
     def on_start(self, archive_path, count):
         """
         The unpack just started.
+
+        If another progress bar is already displayed, this one stays silent.
         """
 
+        if not PROGRESS_BAR_LOCK.acquire(False):
+            return
+
         self.count = count
         self.current_file = ''
 
-        widgets = [os.path.basename(archive_path), ': ', SimpleProgress(), ' (', Percentage(), ')', CurrentFile(self, prefix=' - ')]
-        self.progressbar = ProgressBar(widgets=widgets, maxval=count)
+        if count is None:
+            widgets = [os.path.basename(archive_path), ': ', FileCount(), CurrentFile(self, prefix=' - ')]
+            self.progressbar = ProgressBar(widgets=widgets, maxval=sys.maxint)
+        else:
+            widgets = [os.path.basename(archive_path), ': ', SimpleProgress(), ' (', Percentage(), ')', CurrentFile(self, prefix=' - ')]
+            self.progressbar = ProgressBar(widgets=widgets, maxval=count)
+
         self.progressbar.start()
 
     def on_update(self, current_file, progress):
@@ -141,6 +165,9 @@ class ProgressBarUnpackerCallback(BaseUnpackerCallback):
         The unpack was updated.
         """
 
+        if not hasattr(self, 'progressbar'):
+            return
+
         self.current_file = current_file
         self.progressbar.update(progress)
 
@@ -149,9 +176,22 @@ class ProgressBarUnpackerCallback(BaseUnpackerCallback):
         The unpack finished.
         """
 
-        self.current_file = ''
-        self.progressbar.update(self.count)
-        self.progressbar.finish()
+        if not hasattr(self, 'progressbar'):
+            return
+
+        try:
+            self.current_file = ''
+
+            if self.count is None:
+                # Finishing fills the progress bar up to its maximum value.
+                self.progressbar.maxval = self.progressbar.currval
+            else:
+                self.progressbar.update(self.count)
+
+            self.progressbar.finish()
+        finally:
+            del self.progressbar
+            PROGRESS_BAR_LOCK.release()
 
     def on_exception(self, exception):
         """
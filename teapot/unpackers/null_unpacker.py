@@ -4,9 +4,11 @@ An unpacker that does nothing.
 
 from teapot.unpackers.unpacker import UnpackerImplementation
 from teapot.unpackers.unpacker import register_unpacker
+from teapot.unpackers.unpacker import is_selected
 
 from ..error import TeapotError
 from ..log import Highlight as hl
+from ..path import rmdir
 
 import os
 import shutil
@@ -19,10 +21,12 @@ class NullUnpacker(UnpackerImplementation):
     An unpacker class that just copy source trees.
     """
 
-    def unpack(self, archive_path, target_path, progress):
+    def unpack(self, archive_path, target_path, progress, includes=None, excludes=None):
         """
         Uncompress the archive.
 
+        Only the paths selected by `includes` and `excludes` are copied.
+
         Return the path of the extracted folder.
         """
 
@@ -34,7 +38,29 @@ class NullUnpacker(UnpackerImplementation):
         progress.on_start(archive_path=archive_path, count=1)
 
         progress.on_update(current_file=archive_path, progress=1)
-        shutil.copytree(archive_path, extracted_sources_path)
+
+        if os.path.isdir(extracted_sources_path):
+            rmdir(extracted_sources_path)
+
+        def ignore_unselected(path, names):
+            path = os.path.relpath(path, archive_path)
+
+            return [
+                name for name in names
+                if not is_selected(
+                    os.path.join(path, name),
+                    includes,
+                    excludes,
+                    directory=os.path.isdir(os.path.join(archive_path, path, name)),
+                )
+            ]
+
+        if includes is not None or excludes:
+            ignore = ignore_unselected
+        else:
+            ignore = None
+
+        shutil.copytree(archive_path, extracted_sources_path, ignore=ignore)
 
         progress.on_finish()
 
@@ -6,75 +6,691 @@ from teapot.unpackers.unpacker import UnpackerImplementation
 from teapot.unpackers.unpacker import register_unpacker
 
 from ..error import TeapotError
+from ..log import LOGGER
 from ..log import Highlight as hl
+from ..options import get_option
+from ..path import mkdir, rmdir, write_json, copy_range
+from ..digest import DigestCache
 
 import os
+import json
 import tarfile
+import tempfile
+import threading
+import subprocess
 
+from stat import S_ISDIR, S_ISLNK, S_ISREG
+from contextlib import closing
+from multiprocessing import cpu_count
+from distutils.spawn import find_executable
 
+
+# The magic numbers of the compressed files.
+MAGIC_NUMBERS = (
+    ('\x1f\x8b', 'gzip'),
+    ('BZh', 'bzip2'),
+    ('\xfd7zXZ\x00', 'xz'),
+)
+
+# The external commands that decompress a file to their standard output, by
+# compression, in order of preference.
+DECOMPRESSORS = {
+    'gzip': (('pigz', '-dc'),),
+    'bzip2': (('lbzip2', '-dc'), ('pbzip2', '-dc')),
+    'xz': (('xz', '-T0', '-dc'),),
+}
+
+# The single-threaded external decompressors, used when no parallel
+# decompressor is available.
+SERIAL_DECOMPRESSORS = {
+    'gzip': ('gzip', '-dc'),
+    'bzip2': ('bzip2', '-dc'),
+    'xz': ('xz', '-dc'),
+}
+
+_PROGRAMS = {}
+_PROGRAMS_LOCK = threading.Lock()
+
+
+def find_program(name):
+    """
+    Get the path of the program with the specified `name`, or None if it is
+    not in the PATH.
+    """
+
+    with _PROGRAMS_LOCK:
+        if name not in _PROGRAMS:
+            _PROGRAMS[name] = find_executable(name)
+
+        return _PROGRAMS[name]
+
+
+def get_compression(archive_path):
+    """
+    Get the compression of the archive at `archive_path`, or None if it is
+    not compressed.
+    """
+
+    with open(archive_path, 'rb') as archive_file:
+        header = archive_file.read(6)
+
+    for magic_number, compression in MAGIC_NUMBERS:
+        if header.startswith(magic_number):
+            return compression
+
+
+@register_unpacker(('application/x-tar', None))
 @register_unpacker(('application/x-gzip', None))
 @register_unpacker(('application/x-bzip2', None))
+@register_unpacker(('application/x-xz', None))
 class TarballUnpacker(UnpackerImplementation):
 
     """
     An unpacker class that deals with .tgz files.
+
+    The archive is read in a single forward pass: the members are extracted
+    as they are read, into a staging directory, while the common prefix of
+    their names is computed. The extracted tree is moved in place once the
+    archive was entirely read.
+
+    Unless the `external_decompressors` option is disabled, the archive is
+    decompressed by a parallel decompressor on machines with several
+    processors, or extracted by `bsdtar`, when they are available. Python's own `tarfile` is used otherwise: the data of
+    the regular files of uncompressed archives is then copied from the
+    archive by the kernel, without going through Python.
+
+    If the `transcode_archives` option is enabled, archives with a slow
+    compression are decompressed once, next to the archive, and the
+    uncompressed copy is extracted instead from then on.
+
+    When only some paths must be extracted, the archive is indexed first, so
+    that the members to extract are known before it is read. `bsdtar` is not
+    used then, as its patterns don't match like ours: the members of
+    uncompressed archives are read at their offsets, and the others are
+    skipped while the archive is read.
     """
 
-    def unpack(self, archive_path, target_path, progress):
+    # The size of the chunks read from external decompressors at once.
+    chunk_size = 1024 ** 2
+
+    # The compressions of the archives that are transcoded.
+    transcoded_compressions = ('bzip2', 'xz')
+
+    # The suffix of the transcoded copies of the archives.
+    transcoded_suffix = '.transcoded.tar'
+
+    def get_backends(self, compression):
         """
-        Uncompress the archive.
+        Get the available backends for archives with the specified
+        `compression`, in order of preference.
+
+        A backend is a tuple (name, command), where command is the
+        decompressor to pipe the archive through, if any.
         """
 
-        if not tarfile.is_tarfile(archive_path):
-            raise TeapotError(
-                "%s is not a valid tar archive.",
-                hl(archive_path),
-            )
+        backends = []
 
-        tar = tarfile.open(archive_path, 'r')
+        if get_option('external_decompressors'):
+            for command in DECOMPRESSORS.get(compression, ()):
+                if find_program(command[0]):
+                    backends.append((command[0], command))
 
-        # We get the common prefix for all archive members.
-        prefix = os.path.commonprefix(tar.getnames())
+            # `bsdtar` both decompresses and extracts natively, which is
+            # faster than extracting with Python, unless the archive can be
+            # decompressed on several processors.
+            if find_program('bsdtar'):
+                if cpu_count() > 1:
+                    backends.append(('bsdtar', None))
+                else:
+                    backends.insert(0, ('bsdtar', None))
 
-        # An archive member with the prefix as a name can exist in the archive or ends with a /.
-        while not prefix.endswith('/'):
-            try:
-                prefix_member = tar.getmember(prefix)
+        # The members of an uncompressed archive can be copied as they are.
+        # Python's `tarfile` can't read xz archives.
+        if compression is None:
+            backends.append(('zero-copy', None))
+        elif compression != 'xz':
+            backends.append(('tarfile', None))
+
+        return backends
+
+    def get_decompressor(self, compression):
+        """
+        Get the fastest available external decompressor for the specified
+        `compression`, or None if there is none.
+        """
+
+        commands = list(DECOMPRESSORS.get(compression, ()))
+
+        if compression in SERIAL_DECOMPRESSORS:
+            commands.append(SERIAL_DECOMPRESSORS[compression])
+
+        for command in commands:
+            if find_program(command[0]):
+                return command
+
+    def remove_stale_files(self, path):
+        """
+        Remove the transcoded archives and the indexes in `path` whose
+        archive is gone.
+        """
+
+        for name in os.listdir(path):
+            for suffix in (self.transcoded_suffix, self.transcoded_suffix + '.json', self.index_suffix):
+                if name.endswith(suffix) and not os.path.exists(os.path.join(path, name[:-len(suffix)])):
+                    LOGGER.debug("Removing stale file %s.", hl(name))
+                    os.remove(os.path.join(path, name))
 
-                if prefix_member.isdir:
                     break
 
-            except KeyError:
-                pass
+    def transcode(self, archive_path, compression):
+        """
+        Get the uncompressed copy of the archive, creating it if it does not
+        exist or if the archive changed since.
 
-            new_prefix = os.path.dirname(prefix)
+        Return its path, or None if no decompressor is available.
+        """
 
-            if prefix == new_prefix:
+        transcoded_path = archive_path + self.transcoded_suffix
+        info_path = transcoded_path + '.json'
+        stat_key = DigestCache.get_stat_key(os.stat(archive_path))
+
+        try:
+            with open(info_path) as f:
+                info = json.load(f)
+
+        except (IOError, ValueError):
+            info = {}
+
+        if info.get('archive_stat') == stat_key and os.path.isfile(transcoded_path):
+            return transcoded_path
+
+        command = get_option('external_decompressors') and self.get_decompressor(compression)
+
+        if not command:
+            LOGGER.debug("No decompressor available to transcode %s.", hl(archive_path))
+
+            return None
+
+        self.remove_stale_files(os.path.dirname(archive_path))
+
+        LOGGER.info("Transcoding %s to an uncompressed tarball...", hl(archive_path))
+
+        tmp_path = '%s.%s.tmp' % (transcoded_path, os.getpid())
+
+        try:
+            with open(tmp_path, 'wb') as tmp_file:
+                process = subprocess.Popen(
+                    list(command) + [archive_path],
+                    stdout=tmp_file,
+                    stderr=subprocess.PIPE,
+                )
+                stderr = process.communicate()[1]
+
+            if process.returncode != 0:
                 raise TeapotError(
-                    "Unable to find a common prefix in %s to extract from.",
+                    "Unable to decompress %s with %s: %s",
                     hl(archive_path),
+                    hl(command[0]),
+                    hl(stderr.strip()),
                 )
+
+            if os.name == 'nt' and os.path.exists(transcoded_path):
+                os.remove(transcoded_path)
+
+            os.rename(tmp_path, transcoded_path)
+
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        write_json(info_path, {'archive_stat': stat_key})
+
+        return transcoded_path
+
+    def build_index(self, archive_path):
+        """
+        Read the members of the archive.
+
+        Only the headers of uncompressed archives are read, while compressed
+        archives are decompressed entirely, unless they are transcoded.
+        """
+
+        compression = get_compression(archive_path)
+
+        if get_option('transcode_archives') and compression in self.transcoded_compressions:
+            transcoded_path = self.transcode(archive_path, compression)
+
+            if transcoded_path:
+                archive_path = transcoded_path
+                compression = None
+
+        if compression is None:
+            with closing(tarfile.open(archive_path, 'r:')) as tar:
+                return [self.get_index_entry(member) for member in tar]
+
+        command = get_option('external_decompressors') and self.get_decompressor(compression)
+
+        # Python's `tarfile` can't read xz archives.
+        if not command and compression == 'xz':
+            return None
+
+        with closing(self.iter_tarfile(archive_path, None, command or None)) as members:
+            return list(members)
+
+    def get_prefix(self, prefix, directories):
+        """
+        Get the directory that contains all the archive members, given their
+        common `prefix` and the names of the `directories` in the archive.
+        """
+
+        # An archive member with the prefix as a name can exist in the archive or ends with a /.
+        while not prefix.endswith('/') and prefix not in directories:
+            new_prefix = os.path.dirname(prefix)
+
+            if prefix == new_prefix:
+                return None
+
+            prefix = new_prefix
+
+        return prefix
+
+    def get_member_type(self, member):
+        """
+        Get the type of the specified `member` in an index.
+        """
+
+        if member.isdir():
+            return 'directory'
+        elif member.issym():
+            return 'symlink'
+        elif member.islnk():
+            return 'link'
+        elif member.isreg():
+            return 'file'
+        else:
+            return 'other'
+
+    def get_index_entry(self, member):
+        """
+        Get the index entry of the specified `member`.
+        """
+
+        return [member.name.rstrip('/'), member.size, self.get_member_type(member), member.offset]
+
+    def check_name(self, archive_path, name):
+        """
+        Check that the archive member with the specified `name` can be
+        extracted.
+        """
+
+        if os.path.isabs(name):
+            raise TeapotError(
+                (
+                    "Refusing to extract an archive (%s) that contains "
+                    "absolute filenames."
+                ),
+                hl(archive_path),
+            )
+
+    def iter_tarfile(self, archive_path, target_path, command=None, names=None):
+        """
+        Extract the archive with Python's `tarfile`, optionally reading it
+        from the output of the `command` decompressor.
+
+        If `target_path` is None, the members are only read. If `names` is
+        specified, only the members with these names are extracted.
+
+        Yield the index entry of every extracted member.
+        """
+
+        if command:
+            process = subprocess.Popen(
+                list(command) + [archive_path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            tar = tarfile.open(fileobj=process.stdout, mode='r|')
+        else:
+            process = None
+            tar = tarfile.open(archive_path, 'r|*')
+
+        try:
+            for member in tar:
+                if names is not None and member.name.rstrip('/') not in names:
+                    continue
+
+                self.check_name(archive_path, member.name)
+
+                if target_path is not None:
+                    tar.extract(member, path=target_path)
+
+                yield self.get_index_entry(member)
+
+            # Let the decompressor write the end of the archive.
+            if process:
+                for _ in iter(lambda: process.stdout.read(self.chunk_size), ''):
+                    pass
+
+        finally:
+            tar.close()
+
+            if process:
+                process.stdout.close()
+                stderr = process.stderr.read()
+                process.wait()
+
+        if process and process.returncode != 0:
+            raise TeapotError(
+                "Unable to decompress %s with %s: %s",
+                hl(archive_path),
+                hl(command[0]),
+                hl(stderr.strip()),
+            )
+
+    def iter_offsets(self, tar, offsets):
+        """
+        Read the members of `tar` at the specified `offsets`.
+        """
+
+        tar.firstmember = None
+
+        for offset in offsets:
+            tar.fileobj.seek(offset)
+            tar.offset = offset
+            member = tar.next()
+
+            if member is None:
+                raise TeapotError("No archive member at offset %s.", hl(offset))
+
+            yield member
+
+    def iter_zerocopy(self, archive_path, target_path, offsets=None, names=None):
+        """
+        Extract the uncompressed archive with Python's `tarfile`, copying the
+        data of the regular files straight from the archive to the extracted
+        files.
+
+        If `offsets` is specified, only the members at these offsets are
+        read, without reading the headers of the other members. Otherwise,
+        if `names` is specified, only the members with these names are
+        extracted.
+
+        Yield the index entry of every extracted member.
+        """
+
+        with open(archive_path, 'rb') as archive_file:
+            with closing(tarfile.open(archive_path, 'r:')) as tar:
+                if offsets is None:
+                    members = iter(tar)
+                else:
+                    members = self.iter_offsets(tar, offsets)
+
+                for member in members:
+                    if offsets is None and names is not None and member.name.rstrip('/') not in names:
+                        continue
+
+                    self.check_name(archive_path, member.name)
+
+                    # Sparse files are stored with holes: let `tarfile`
+                    # rebuild them.
+                    if member.isreg() and getattr(member, 'sparse', None) is None:
+                        path = os.path.join(target_path, member.name.rstrip('/').replace('/', os.sep))
+                        mkdir(os.path.dirname(path))
+
+                        with open(path, 'wb') as member_file:
+                            copy_range(archive_file, member.offset_data, member.size, member_file)
+
+                        tar.chown(member, path)
+                        tar.chmod(member, path)
+                        tar.utime(member, path)
+                    else:
+                        tar.extract(member, path=target_path)
+
+                    yield self.get_index_entry(member)
+
+    def get_file_info(self, path):
+        """
+        Get the size and the index type of the file at `path`.
+        """
+
+        stat = os.lstat(path)
+
+        if S_ISDIR(stat.st_mode):
+            return [0, 'directory']
+        elif S_ISLNK(stat.st_mode):
+            return [0, 'symlink']
+        elif S_ISREG(stat.st_mode):
+            return [stat.st_size, 'file']
+        else:
+            return [0, 'other']
+
+    def iter_bsdtar(self, archive_path, target_path):
+        """
+        Extract the archive with `bsdtar`.
+
+        Yield the index entry of every extracted member. As `bsdtar` only
+        reports their names, their size and type are those of the extracted
+        files, and their offset is unknown.
+        """
+
+        process = subprocess.Popen(
+            ['bsdtar', '-xvf', archive_path, '-C', target_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        errors = []
+        completed = False
+
+        try:
+            # The extracted members are reported on the error output.
+            for line in iter(process.stderr.readline, ''):
+                if line.startswith('x '):
+                    name = line[2:].rstrip('\n')
+                    self.check_name(archive_path, name)
+                    name = name.rstrip('/')
+
+                    yield [name] + self.get_file_info(os.path.join(target_path, name)) + [None]
+                else:
+                    errors.append(line.strip())
+
+            completed = True
+
+        finally:
+            if not completed and process.poll() is None:
+                process.kill()
+
+            process.wait()
+
+        if process.returncode != 0:
+            raise TeapotError(
+                "Unable to extract %s with %s: %s",
+                hl(archive_path),
+                hl('bsdtar'),
+                hl('\n'.join(errors)),
+            )
+
+    def get_members_prefix(self, archive_path, members):
+        """
+        Get the directory that contains all the specified index `members`.
+        """
+
+        names = [member[0] for member in members]
+        directories = set(member[0] for member in members if member[2] == 'directory')
+        prefix = self.get_prefix(os.path.commonprefix(names), directories)
+
+        if prefix is None:
+            raise TeapotError(
+                "Unable to find a common prefix in %s to extract from.",
+                hl(archive_path),
+            )
+
+        return prefix
+
+    def extract(self, archive_path, target_path, progress, backend, members=None, selected_members=None):
+        """
+        Extract the archive with the specified `backend`.
+
+        `members` are the members of the archive, from its index, if they are
+        known. If `selected_members` is specified, only these members are
+        extracted.
+
+        Return the extracted sources path and the extracted members of the
+        archive.
+        """
+
+        name, command = backend
+
+        LOGGER.debug("Extracting %s with %s.", hl(archive_path), hl(name))
+
+        # The prefix is known before the archive is read when it is indexed.
+        if members is not None:
+            prefix = self.get_members_prefix(archive_path, members)
+
+            if selected_members is None:
+                selected_members = members
+
+        staging_path = tempfile.mkdtemp(prefix='.unpack-', dir=target_path)
+
+        try:
+            names = None
+
+            if selected_members is not members:
+                names = set(member[0] for member in selected_members)
+
+            if name == 'bsdtar':
+                extracted_members = self.iter_bsdtar(archive_path, staging_path)
+            elif name == 'zero-copy':
+                offsets = None
+
+                if selected_members is not None and all(member[3] is not None for member in selected_members):
+                    offsets = [member[3] for member in selected_members]
+
+                extracted_members = self.iter_zerocopy(archive_path, staging_path, offsets, names)
             else:
-                prefix = new_prefix
+                extracted_members = self.iter_tarfile(archive_path, staging_path, command, names)
 
-        extracted_sources_path = os.path.join(target_path, prefix)
+            # Unless the archive is indexed, the number of members is unknown
+            # until it is read.
+            progress.on_start(archive_path=archive_path, count=None if members is None else len(selected_members))
 
-        progress.on_start(archive_path=archive_path, count=len(tar.getmembers()))
+            index = []
 
-        for index, member in enumerate(tar.getmembers()):
-            if os.path.isabs(member.name):
-                raise TeapotError(
-                    (
-                        "Refusing to extract an archive (%s) that contains "
-                        "absolute filenames."
-                    ),
-                    hl(archive_path),
-                )
+            with closing(extracted_members):
+                for member in extracted_members:
+                    progress.on_update(current_file=member[0], progress=len(index))
+                    index.append(member)
+
+            if members is None:
+                prefix = self.get_members_prefix(archive_path, index)
+
+            # Move the extracted tree in place.
+            for name in os.listdir(staging_path):
+                path = os.path.join(target_path, name)
+
+                if os.path.isdir(path):
+                    rmdir(path)
+                elif os.path.lexists(path):
+                    os.remove(path)
+
+                os.rename(os.path.join(staging_path, name), path)
+
+            progress.on_finish()
+
+        finally:
+            rmdir(staging_path)
+
+        return os.path.join(target_path, prefix), index
+
+    def unpack(self, archive_path, target_path, progress, includes=None, excludes=None):
+        """
+        Uncompress the archive.
+
+        Only the members selected by `includes` and `excludes` are extracted.
+        """
+
+        # The index is the one of the original archive, as the offsets of the
+        # members are the same in its transcoded copy.
+        original_archive_path = archive_path
+        compression = get_compression(archive_path)
+
+        if get_option('transcode_archives') and compression in self.transcoded_compressions:
+            transcoded_path = self.transcode(archive_path, compression)
+
+            if transcoded_path:
+                archive_path = transcoded_path
+                compression = None
+
+        if compression != 'xz' and not tarfile.is_tarfile(archive_path):
+            raise TeapotError(
+                "%s is not a valid tar archive.",
+                hl(archive_path),
+            )
+
+        backends = self.get_backends(compression)
+
+        if not backends:
+            raise TeapotError(
+                "Unable to extract %s: no program that can decompress %s archives was found.",
+                hl(archive_path),
+                hl(compression),
+            )
+
+        members = self.load_index(original_archive_path)
+
+        if members is None:
+            self.remove_stale_files(os.path.dirname(original_archive_path))
+
+        selective = includes is not None or bool(excludes)
+
+        # Reading the headers of an uncompressed archive is cheap: index it
+        # first, so that its prefix and number of members are known. The
+        # other archives are only read twice when some of their members must
+        # be selected, and only until they are indexed.
+        if members is None and (compression is None or selective):
+            members = self.build_index(archive_path)
+
+            if members is not None:
+                self.save_index(original_archive_path, members)
+
+        selected_members = None
+
+        if selective:
+            if members is None:
+                LOGGER.debug("Unable to index %s: extracting all its members.", hl(archive_path))
+            else:
+                prefix = self.get_members_prefix(archive_path, members)
+                selected_members = self.select_members(members, prefix, includes, excludes)
+
+                # Hard links are extracted from their target, which is not
+                # indexed.
+                if any(member[2] == 'link' for member in selected_members):
+                    LOGGER.debug("%s contains hard links: extracting all its members.", hl(archive_path))
+                    selected_members = None
+                # `bsdtar` can't select members.
+                elif all(backend[0] == 'bsdtar' for backend in backends):
+                    LOGGER.debug("%s can only be extracted with bsdtar: extracting all its members.", hl(archive_path))
+                    selected_members = None
+                else:
+                    backends = [backend for backend in backends if backend[0] != 'bsdtar'] or backends
+
+                    LOGGER.debug(
+                        "Extracting %s member(s) out of %s from %s.",
+                        hl(len(selected_members)),
+                        hl(len(members)),
+                        hl(archive_path),
+                    )
 
-            progress.on_update(current_file=member.name, progress=index)
-            tar.extract(member, path=target_path)
+        extracted_sources_path, index = self.extract(
+            archive_path,
+            target_path,
+            progress,
+            backends[0],
+            members,
+            selected_members,
+        )
 
-        progress.on_finish()
+        if members is None:
+            self.save_index(original_archive_path, index)
 
         return {
             'extracted_sources_path': extracted_sources_path,
@@ -2,24 +2,194 @@
 A base Unpacker class.
 """
 
+import os
+import json
+
+from fnmatch import fnmatchcase
+
 from ..memoized import MemoizedObject
 from ..log import Highlight as hl
+from ..path import write_json
+from ..digest import DigestCache
 
 from .callbacks import ProgressBarUnpackerCallback
 
 
+def split_member_path(path):
+    """
+    Split the specified `path` in its components.
+
+    Both slashes and backslashes are separators, and empty and current
+    directory components are dropped.
+    """
+
+    return [part for part in path.replace('\\', '/').split('/') if part not in ('', os.curdir)]
+
+
+def is_selected(path, includes=None, excludes=None, directory=False):
+    """
+    Check whether the member at `path`, relative to the extracted sources
+    path, must be extracted.
+
+    `includes` and `excludes` are shell-style patterns, relative to the
+    extracted sources path. A member is selected if it or one of its parent
+    directories matches an include pattern, and if neither it nor one of its
+    parent directories matches an exclude pattern. If `includes` is None,
+    all the members are included.
+
+    The files at the root of the extracted sources path, such as build
+    scripts, are always included. Directories that can contain members
+    matching an include pattern are selected too, if `directory` is truthy.
+    """
+
+    parts = split_member_path(path)
+    paths = ['/'.join(parts[:index]) for index in range(1, len(parts) + 1)]
+
+    # The extracted sources path itself is always extracted.
+    if not parts:
+        return True
+
+    if excludes and any(fnmatchcase(x, pattern) for x in paths for pattern in excludes):
+        return False
+
+    if includes is None or (len(parts) == 1 and not directory):
+        return True
+
+    for pattern in includes:
+        if any(fnmatchcase(x, pattern) for x in paths):
+            return True
+
+        if directory:
+            pattern_parts = split_member_path(pattern)
+
+            if len(parts) < len(pattern_parts) and all(map(fnmatchcase, parts, pattern_parts[:len(parts)])):
+                return True
+
+    return False
+
+
 class UnpackerImplementation(object):
 
     """
     Base class for all unpacker implementation classes.
+
+    The members of an archive can be stored in an index, next to it, so that
+    they are known without reading the archive again. Every member is a list
+    [name, size, type, offset], where type is one of 'file', 'directory',
+    'symlink', 'link' or 'other', and offset is the offset of the member
+    header in the archive (in the uncompressed stream for tarballs), or None
+    if it is unknown.
     """
 
-    def unpack(self, archive_path, target_path, progress):
+    # The suffix of the indexes of the archives.
+    index_suffix = '.index.json'
+
+    def get_index_path(self, archive_path):
+        """
+        Get the path of the index of the specified archive.
+        """
+
+        return archive_path + self.index_suffix
+
+    def load_index(self, archive_path):
+        """
+        Get the members of the specified archive from its index.
+
+        Return None if the archive has no index or if it changed since it was
+        indexed.
+        """
+
+        try:
+            with open(self.get_index_path(archive_path)) as f:
+                index = json.load(f)
+
+        except (IOError, ValueError):
+            return None
+
+        if not isinstance(index, dict):
+            return None
+
+        # Indexes that stored their names as UTF-8 lost the names that were
+        # not valid UTF-8.
+        if index.get('names_encoding') != 'latin-1':
+            return None
+
+        if index.get('archive_stat') != DigestCache.get_stat_key(os.stat(archive_path)):
+            return None
+
+        return [[member[0].encode('latin-1')] + member[1:] for member in index.get('members', [])]
+
+    def save_index(self, archive_path, members):
+        """
+        Write the index of the specified archive.
+
+        The names are stored as latin-1 so that any byte string survives the
+        round trip through JSON.
+        """
+
+        def to_unicode(name):
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+
+            return name.decode('latin-1')
+
+        write_json(self.get_index_path(archive_path), {
+            'archive_stat': DigestCache.get_stat_key(os.stat(archive_path)),
+            'names_encoding': 'latin-1',
+            'members': [[to_unicode(member[0])] + member[1:] for member in members],
+        })
+
+    def build_index(self, archive_path):
+        """
+        Read the members of the specified archive.
+
+        Return None if the archive has no members that can be listed.
+        """
+
+        return None
+
+    def select_members(self, members, prefix, includes=None, excludes=None):
+        """
+        Get the index `members` that are selected by the `includes` and
+        `excludes` patterns, relative to `prefix`.
+        """
+
+        return [
+            member for member in members
+            if is_selected(
+                member[0][len(prefix):],
+                includes,
+                excludes,
+                directory=member[2] == 'directory',
+            )
+        ]
+
+    def get_members(self, archive_path):
+        """
+        Get the members of the specified archive, from its index if it is
+        up-to-date.
+
+        Return None if the archive has no members that can be listed.
+        """
+
+        members = self.load_index(archive_path)
+
+        if members is None:
+            members = self.build_index(archive_path)
+
+            if members is not None:
+                self.save_index(archive_path, members)
+
+        return members
+
+    def unpack(self, archive_path, target_path, progress, includes=None, excludes=None):
         """
         Unpack the specified archive.
 
         `archive_path` is the path of the archive to unpack.
         `target_path` is the path to extract the archive to.
+        `includes` and `excludes` are the patterns of the paths to extract,
+        relative to the extracted sources path. See `is_selected()`.
 
         It returns the unpack manifest.
         """
@@ -48,33 +218,50 @@ class Unpacker(MemoizedObject):
         """
 
         self._unpacker_impl = unpacker_impl_class()
-        self.progress = progress_class()
+        self.progress_class = progress_class
 
     def __str__(self):
         return mimetype_to_str(self.mimetype)
 
-    def unpack(self, archive_path, target_path):
+    def unpack(self, archive_path, target_path, includes=None, excludes=None):
         """
         Unpack the specified archive.
 
         `archive_path` is the path of the archive to unpack.
         `target_path` is the path to extract the archive to.
+        `includes` and `excludes` are the patterns of the paths to extract,
+        relative to the extracted sources path. If `includes` is None, all
+        the paths that are not excluded are extracted.
 
         It returns the unpack manifest.
         """
 
+        # Several unpacks may run concurrently: each gets its own callback.
+        progress = self.progress_class()
+
         try:
             return self._unpacker_impl.unpack(
                 archive_path=archive_path,
                 target_path=target_path,
-                progress=self.progress,
+                progress=progress,
+                includes=includes,
+                excludes=excludes,
             )
 
         except Exception as ex:
-            self.progress.on_exception(ex)
+            progress.on_exception(ex)
 
             raise
 
+    def get_members(self, archive_path):
+        """
+        Get the members of the specified archive.
+
+        Return None if the archive has no members that can be listed.
+        """
+
+        return self._unpacker_impl.get_members(archive_path)
+
 
 class register_unpacker(object):
     """
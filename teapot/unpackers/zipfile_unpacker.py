@@ -4,12 +4,24 @@ An unpacker that deals with .zip files.
 
 from teapot.unpackers.unpacker import UnpackerImplementation
 from teapot.unpackers.unpacker import register_unpacker
+from teapot.unpackers.unpacker import is_selected
 
 from ..error import TeapotError
+from ..log import LOGGER
 from ..log import Highlight as hl
+from ..path import mkdir, copy_range
 
 import os
+import stat
+import shutil
+import struct
 import zipfile
+import threading
+
+from contextlib import closing
+from itertools import imap
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 
 @register_unpacker(('application/zip', None))
@@ -17,11 +29,106 @@ class ZipFileUnpacker(UnpackerImplementation):
 
     """
     An unpacker class that deals with .zip files.
+
+    As the members of a zip archive are compressed independently, they are
+    extracted concurrently: the directories are created first, then the
+    files are extracted by a pool of threads, each with its own handle on
+    the archive.
+
+    The members that are stored without compression are copied from the
+    archive by the kernel, without going through Python.
     """
 
-    def unpack(self, archive_path, target_path, progress):
+    # The maximum number of members extracted concurrently.
+    extract_threads = 8
+
+    # The size of the chunks extracted at once.
+    chunk_size = 1024 ** 2
+
+    def get_member_path(self, target_path, name):
+        """
+        Get the path a member with the specified `name` is extracted to.
+
+        Like `ZipFile.extract()`, drive letters and relative components are
+        ignored, so that members can't be extracted out of `target_path`.
+        """
+
+        name = os.path.splitdrive(name.replace('\\', '/'))[1]
+        parts = [part for part in name.split('/') if part not in ('', os.curdir, os.pardir)]
+
+        return os.path.join(target_path, *parts)
+
+    def get_index_entry(self, info):
+        """
+        Get the index entry of the member described by `info`.
+        """
+
+        if info.filename.endswith('/'):
+            member_type = 'directory'
+        elif stat.S_ISLNK(info.external_attr >> 16):
+            member_type = 'symlink'
+        else:
+            member_type = 'file'
+
+        return [info.filename.rstrip('/'), info.file_size, member_type, info.header_offset]
+
+    def build_index(self, archive_path):
+        """
+        Read the members of the archive from its central directory.
+        """
+
+        with closing(zipfile.ZipFile(archive_path, 'r')) as zipf:
+            return [self.get_index_entry(info) for info in zipf.infolist()]
+
+    def get_data_offset(self, zipf, info):
+        """
+        Get the offset of the data of the member described by `info` in
+        `zipf`.
+        """
+
+        # The extra field of the local header may differ from the one in the
+        # central directory.
+        zipf.fp.seek(info.header_offset)
+        header = zipf.fp.read(zipfile.sizeFileHeader)
+
+        if len(header) != zipfile.sizeFileHeader or not header.startswith(zipfile.stringFileHeader):
+            raise zipfile.BadZipfile("Bad magic number for file header of %r" % info.filename)
+
+        fields = struct.unpack(zipfile.structFileHeader, header)
+
+        return (
+            info.header_offset +
+            zipfile.sizeFileHeader +
+            fields[zipfile._FH_FILENAME_LENGTH] +
+            fields[zipfile._FH_EXTRA_FIELD_LENGTH]
+        )
+
+    def extract_member(self, zipf, info, path):
+        """
+        Extract the file member described by `info` from `zipf` to `path`.
+
+        Members stored without compression nor encryption are copied as they
+        are: their CRC is not checked then.
+        """
+
+        if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+            offset = self.get_data_offset(zipf, info)
+
+            with open(path, 'wb') as target_file:
+                copy_range(zipf.fp, offset, info.file_size, target_file)
+
+            return
+
+        with zipf.open(info) as source_file:
+            with open(path, 'wb') as target_file:
+                shutil.copyfileobj(source_file, target_file, self.chunk_size)
+
+    def unpack(self, archive_path, target_path, progress, includes=None, excludes=None):
         """
         Uncompress the archive.
+
+        Only the members selected by `includes` and `excludes` are extracted:
+        the others are not even decompressed.
         """
 
         if not zipfile.is_zipfile(archive_path):
@@ -48,15 +155,83 @@ class ZipFileUnpacker(UnpackerImplementation):
             )
 
         extracted_sources_path = os.path.join(target_path, prefix)
-
-        progress.on_start(archive_path=archive_path, count=len(zipf.infolist()))
-
-        for index, info in enumerate(zipf.infolist()):
+        infos = zipf.infolist()
+
+        if self.load_index(archive_path) is None:
+            self.save_index(archive_path, [self.get_index_entry(info) for info in infos])
+
+        if includes is not None or excludes:
+            infos = [
+                info for info in infos
+                if is_selected(
+                    info.filename[len(prefix):],
+                    includes,
+                    excludes,
+                    directory=info.filename.endswith('/'),
+                )
+            ]
+
+        files = []
+        directories = set()
+
+        for info in infos:
             if os.path.isabs(info.filename):
                 raise ValueError('Refusing to extract archive that contains absolute filenames.')
 
-            progress.on_update(current_file=info.filename, progress=index)
-            zipf.extract(info, path=target_path)
+            path = self.get_member_path(target_path, info.filename)
+
+            if info.filename.endswith('/'):
+                directories.add(path)
+            else:
+                directories.add(os.path.dirname(path))
+                files.append((info, path))
+
+        progress.on_start(archive_path=archive_path, count=len(infos))
+
+        # Create the directories first, so that the threads don't race to
+        # create them.
+        for path in sorted(directories):
+            mkdir(path)
+
+        local = threading.local()
+        handles = []
+
+        def extract(member):
+            info, path = member
+
+            if not hasattr(local, 'zipf'):
+                local.zipf = zipfile.ZipFile(archive_path, 'r')
+                handles.append(local.zipf)
+
+            self.extract_member(local.zipf, info, path)
+
+            return info.filename
+
+        threads = min(self.extract_threads, cpu_count(), len(files))
+
+        LOGGER.debug("Extracting %s with %s thread(s).", hl(archive_path), hl(max(threads, 1)))
+
+        if threads > 1:
+            pool = ThreadPool(threads)
+            filenames = pool.imap_unordered(extract, files, chunksize=16)
+        else:
+            pool = None
+            local.zipf = zipf
+            filenames = imap(extract, files)
+
+        try:
+            for index, filename in enumerate(filenames, len(infos) - len(files)):
+                progress.on_update(current_file=filename, progress=index)
+
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+            for handle in handles:
+                handle.close()
+
+            zipf.close()
 
         progress.on_finish()
 